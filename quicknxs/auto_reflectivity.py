@@ -140,7 +140,9 @@ class ReflectivityBuilder(object):
       last_lambda=live_ds.lambda_center
     else:
       self.current_index=start_idx
-      ds=qreduce.NXSData(start_idx, use_caching=False)
+      ds=qreduce.NXSData(start_idx, use_caching=False,
+                         event_chunk_size=instrument.event_chunk_size,
+                         disk_cache=instrument.disk_cache)
       last_ai=self.get_ai(ds)
       last_channels=len(ds)
       last_lambda=ds.lambda_center
@@ -228,7 +230,9 @@ class ReflectivityBuilder(object):
 
     logging.info('Extracting reflectivity for index %i.'%self.current_index)
     # load the dataset
-    data=qreduce.NXSData(dsinfo.file_path, use_caching=False)
+    data=qreduce.NXSData(dsinfo.file_path, use_caching=False,
+                         event_chunk_size=instrument.event_chunk_size,
+                         disk_cache=instrument.disk_cache)
     # search for fitting direct beams in database
     results=self.db.find_direct_beams(data)
     if len(results)==0:
@@ -242,14 +246,15 @@ class ReflectivityBuilder(object):
     compat=numpy.array([abs(r.s1w-dsinfo.s1w)+abs(r.s3w-dsinfo.s3w) for r in results])
     match=results[compat.argmin()]
     # read run for normalization
-    norm_data=qreduce.NXSData(match.file_path, use_caching=False)
+    norm_data=qreduce.NXSData(match.file_path, use_caching=False,
+                              event_chunk_size=instrument.event_chunk_size,
+                              disk_cache=instrument.disk_cache)
     norm=qreduce.Reflectivity(norm_data[0],
                              x_pos=match.xpix, x_width=9,
                              y_pos=match.ycenter, y_width=match.ywidth,
                              number=str(match.file_id),
                              )
 
-    refls=[]
     P0, PN=self.get_cut_pts(data)
     # create first channel reflectivity to determine the scaling factor
     r0=qreduce.Reflectivity(data[0],
@@ -268,14 +273,13 @@ class ReflectivityBuilder(object):
       scale, _xfit, _yfit=qcalc.get_scaling(r0, self.reflectivity_items[-1][0], 1, polynom=3)
 
     # extract reflectivities for all states
-    for i in range(self.reflectivity_states):
-      refls.append(qreduce.Reflectivity(data[i],
-                                        x_pos=dsinfo.xpix, x_width=9,
-                                        y_pos=dsinfo.ycenter, y_width=dsinfo.ywidth,
-                                        number=str(dsinfo.file_id),
-                                        normalization=norm, scale=scale,
-                                        P0=P0, PN=PN,
-                                        ))
+    refls=qreduce.Reflectivity.from_channels(data, range(self.reflectivity_states),
+                                      x_pos=dsinfo.xpix, x_width=9,
+                                      y_pos=dsinfo.ycenter, y_width=dsinfo.ywidth,
+                                      number=str(dsinfo.file_id),
+                                      normalization=norm, scale=scale,
+                                      P0=P0, PN=PN,
+                                      )
     # adding the dataset was successful, add it and increment the index.
     self.reflectivity_items.append(refls)
     self.current_index+=1
@@ -303,14 +307,15 @@ class ReflectivityBuilder(object):
     compat=numpy.array([abs(r.s1w-live_ds[0].logs['S1HWidth'])+
                         abs(r.s3w-live_ds[0].logs['S3HWidth']) for r in results])
     match=results[compat.argmin()]
-    norm_data=qreduce.NXSData(match.file_path, use_caching=True)
+    norm_data=qreduce.NXSData(match.file_path, use_caching=True,
+                              event_chunk_size=instrument.event_chunk_size,
+                              disk_cache=instrument.disk_cache)
     norm=qreduce.Reflectivity(norm_data[0],
                              x_pos=match.xpix, x_width=9,
                              y_pos=match.ycenter, y_width=match.ywidth,
                              number=str(match.file_id),
                              )
 
-    refls=[]
     P0, PN=self.get_cut_pts(live_ds)
     r0=qreduce.Reflectivity(live_ds[0],
                             x_pos=xpix, x_width=9,
@@ -332,14 +337,13 @@ class ReflectivityBuilder(object):
       # try to match both datasets by fitting a polynomiral to the overlapping region
       scale, _xfit, _yfit=qcalc.get_scaling(r0, self.reflectivity_items[-1][0], 1, polynom=3)
 
-    for i in range(self.reflectivity_states):
-      refls.append(qreduce.Reflectivity(live_ds[i],
-                                        x_pos=xpix, x_width=9,
-                                        y_pos=ycenter, y_width=ywidth,
-                                        number=str(live_ds.number),
-                                        normalization=norm, scale=scale,
-                                        P0=P0, PN=PN,
-                                        ))
+    refls=qreduce.Reflectivity.from_channels(live_ds, range(self.reflectivity_states),
+                                      x_pos=xpix, x_width=9,
+                                      y_pos=ycenter, y_width=ywidth,
+                                      number=str(live_ds.number),
+                                      normalization=norm, scale=scale,
+                                      P0=P0, PN=PN,
+                                      )
     return refls
 
   def finish_reflectivity(self):
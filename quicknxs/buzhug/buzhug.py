@@ -109,6 +109,7 @@ except NameError:
 from buzhug_files import *
 import buzhug_algos
 import buzhug_info
+from buzhug_index import SortedIndex
 
 version = "1.8"
 
@@ -317,6 +318,9 @@ class TimeFormatError(Exception):
 class Base:
 
     BLOCKSIZE = 131072
+    # maximum fraction of the records selected with indexes, above which
+    # the field files are browsed instead
+    INDEX_MAX_FRACTION = 0.1
     
 
     types_map = [ (int,IntegerFile),(float,FloatFile),
@@ -332,6 +336,11 @@ class Base:
         self.f_decode = {} # key = data class, value = function from_block
         self.info_name = os.path.join(basename,'__info__')
         self.pos_name = os.path.join(basename,'__pos__')
+        self.indexes_name = os.path.join(basename,'__indexes__')
+        self._index = {} # key = field name, value = SortedIndex
+        self._indexes_stat = None
+        # set by create_index, stale indexes are rebuilt before changes
+        self._maintain_indexes = False
         for (c_obj,c_file) in self.types_map:
                 self._register_class(c_obj,c_file)
         # from_string[_class] is the function used to convert a string
@@ -424,6 +433,7 @@ class Base:
         buzhug_info.save_info(self)
         # create class for records with all values set
         self._full_rec = makeRecordClass(self,self.record_class,self.field_names)
+        self._index = {}
         return self
 
     def open(self):
@@ -459,8 +469,78 @@ class Base:
         self._open_files()
         # read default values
         self.defaults = buzhug_info.read_defaults(self)
+        self._open_indexes()
         return self
 
+    def _open_indexes(self):
+        self._index = {}
+        self._indexes_stat = self._get_indexes_stat()
+        if self._indexes_stat is not None:
+            for f in open(self.indexes_name,'rb').read().split():
+                self._index[f] = SortedIndex(self,f).open()
+
+    def _get_indexes_stat(self):
+        try:
+            info = os.stat(self.indexes_name)
+        except OSError:
+            return None
+        return (info.st_mtime,info.st_size)
+
+    def _save_indexes(self):
+        out = open(self.indexes_name,'wb')
+        out.write('\n'.join(self._index.keys()))
+        out.close()
+        self._indexes_stat = self._get_indexes_stat()
+
+    def _reload_indexes(self):
+        """Open the indexes created or dropped by other processes"""
+        if self._get_indexes_stat() != self._indexes_stat:
+            self._open_indexes()
+
+    def _check_indexes(self):
+        """Called before the base is changed. Open the indexes created by
+        other processes and, in the process maintaining the indexes, rebuild
+        the ones that miss changes of the base. Only the indexes which are
+        current at this point are updated with the change"""
+        self._reload_indexes()
+        for index in self._index.values():
+            if not index.prepare() and self._maintain_indexes:
+                try:
+                    index.create()
+                except (IOError,OSError):
+                    # stays stale, select browses the field files
+                    continue
+                index.prepare()
+
+    def create_index(self,*field_names):
+        """Create persistent sorted indexes on the specified fixed-length
+        fields. The indexes are kept up to date by insert, update and delete
+        and used by select for value ranges and equality of these fields
+        Only the process writing to the base should create the indexes, it
+        also rebuilds existing indexes that are stale"""
+        for f in field_names:
+            if not f in self.field_names[2:]:
+                raise NameError,"No field named %s" %f
+            if not hasattr(self._file[f],'block_len'):
+                raise TypeError,"Indexes are only allowed for fixed " \
+                    "length fields (found %s)" %self.fields[f]
+        self._reload_indexes()
+        self._maintain_indexes = True
+        for f in field_names:
+            if not f in self._index:
+                self._index[f] = SortedIndex(self,f).create()
+            elif not self._index[f].is_current():
+                self._index[f].create()
+        self._save_indexes()
+
+    def drop_index(self,field_name):
+        """Remove the index of the specified field"""
+        self._reload_indexes()
+        if not field_name in self._index:
+            raise NameError,"No index for field %s" %field_name
+        self._index.pop(field_name).destroy()
+        self._save_indexes()
+
     def _open_files(self):
         self._file = {}
         for f in self.field_names:
@@ -523,6 +603,7 @@ class Base:
         for (k,v) in kw.iteritems():
             self._validate(k,v)
             rec[k] = v
+        self._check_indexes()
         # initial version = 0
         rec['__version__'] = 0
         # get position in field files
@@ -536,6 +617,8 @@ class Base:
         self._file['__id__'].insert(_id)
         # line_num is the line number in the position file
         self._id_pos.insert(line_num)
+        for f,index in self._index.iteritems():
+            index.change(added=[(self.f_encode[self.fields[f]](rec[f]),_id)])
         return _id
 
     def set_string_format(self, class_, format): #@ReservedAssignment
@@ -635,9 +718,15 @@ class Base:
             records = [records]
         _ids = [ r.__id__ for r in records ]
         _ids.sort()
+        self._check_indexes()
+        removed = dict([ (f,[]) for f in self._index ])
 
         # mark blocks in field files as deleted
         for _id in _ids:
+            if self._index:
+                current = self[_id]
+                for f in self._index:
+                    removed[f].append((current[self.field_names.index(f)],_id))
             # get the line number in the position file
             _line_in_pos = self._id_pos.get_value_at_pos(_id*5)
             # get the positions in field files
@@ -653,6 +742,8 @@ class Base:
             # mark line in _id_pos as deleted
             self._id_pos.mark_as_deleted(_id*5)
         self._pos.deleted_lines.sort()
+        for f,index in self._index.iteritems():
+            index.change(removed=removed[f])
 
     def cleanup(self):
         """Physically remove the deleted items in field files
@@ -765,6 +856,11 @@ class Base:
             del args[k]
 
         if _request is None:
+            self._reload_indexes()
+            if [ k for k in args.keys() if k in self._index ]:
+                res = self._index_select(**args)
+                if res is not None:
+                    return res,list(self.field_names)
             f_args = [ k for k in args.keys() 
                 if hasattr(self._file[k],'block_len') ]
             # if there is at least one fixed length field to search, use the
@@ -843,6 +939,66 @@ class Base:
         # return the list of selected items, with return fields set
         return _res,_names
 
+    def _index_select(self,**args):
+        """Select the records with the indexes of the fields in args
+        The ids of the records in the ranges of all indexed fields are taken
+        from the indexes, the blocks of the other fields are compared to
+        the arguments for each of these records
+        Return None if the indexes leave too many records, browsing the
+        field files is faster in that case, or if an index is stale"""
+        ranges = {}
+        for k,v in args.iteritems():
+            if isinstance(v,(list,tuple)):
+                if not len(v)==2:
+                    raise ValueError,"If argument is a list, only 2 values " \
+                        "should be passed (found %s)" %len(v)
+                for x in v:
+                    self._validate(k,x)
+                ranges[k] = [ self.f_encode[self.fields[k]](x)
+                    for x in sorted(v) ]
+            else:
+                block = self.file_types[self.fields[k]]().to_block(v)
+                ranges[k] = [block,block]
+        _ids = None
+        for k,(s1,s2) in ranges.iteritems():
+            if k in self._index:
+                found = self._index[k].search(s1,s2)
+                if found is None:
+                    return None
+                found = set(found)
+                if _ids is None:
+                    _ids = found
+                else:
+                    _ids &= found
+        if len(_ids) > self.INDEX_MAX_FRACTION*len(self):
+            return None
+        checks = [ (self.field_names.index(k),s1,s2)
+            for k,(s1,s2) in ranges.iteritems() if not k in self._index ]
+        res = {}
+        for _id in _ids:
+            try:
+                rec = self[_id]
+            except IndexError:
+                # deleted by another process after the index was read
+                continue
+            for ix,s1,s2 in checks:
+                if not s1 <= rec[ix] <= s2:
+                    break
+            else:
+                res[_id] = rec
+        return res
+
+    def has_value(self,field_name,value):
+        """Check if any record has the value for the specified field
+        Uses the index of the field if there is one"""
+        self._reload_indexes()
+        if field_name in self._index:
+            block = self.f_encode[self.fields[field_name]](value)
+            found = self._index[field_name].search(block,block)
+            if found is not None:
+                return len(found)>0
+        return len(self.select([field_name],**{field_name:value}))>0
+
     def update(self,record,**kw):
         """Update the record with the values in kw
         If only fixed length fields have changed, simply put the new values
@@ -870,13 +1026,15 @@ class Base:
             raise UpdateError,'The record was not selected for update'
 
         _id = record.__id__
+        self._check_indexes()
         # line number of the record in position file
         _line_in_pos = self._id_pos.get_value_at_pos(5*_id)
         
         # if the record was selected for update it has a __version__
         # attribute. If the version for the same id in the position
         # file is not the same, refuse to update
-        current_version = self[_id].__version__
+        current = self[_id]
+        current_version = current.__version__
         if not record.__version__ == current_version:
             raise ConflictError,'The record has changed since selection'
 
@@ -922,6 +1080,15 @@ class Base:
             # add a deleted row
             self._del_rows.insert(field_pos[0]/5)
 
+        for f,index in self._index.iteritems():
+            old_block = current[self.field_names.index(f)]
+            if f in kw and self.f_encode[self.fields[f]](kw[f]) != old_block:
+                index.change([(old_block,_id)],
+                    [(self.f_encode[self.fields[f]](kw[f]),_id)])
+            else:
+                # store the new state of the base
+                index.change()
+
     def add_field(self,field_name,field_type,after=None,default=None):
         """Add a new field after the specified field, or in the beginning if
         no field is specified"""
@@ -960,6 +1127,8 @@ class Base:
             raise ValueError,"Field __id__ can't be removed"
         if field_name == '__version__':
             raise ValueError,"Field __version__ can't be removed"
+        if field_name in self._index:
+            self.drop_index(field_name)
         indx = self.field_names.index(field_name)
         self.field_names.remove(field_name)
         del self.defaults[field_name]
@@ -1167,4 +1336,20 @@ class TS_Base(Base):
             _releaseLock()
         return res
 
+    def create_index(self,*args,**kw):
+        _acquireLock()
+        try:
+            res = Base.create_index(self,*args,**kw)
+        finally:
+            _releaseLock()
+        return res
+
+    def drop_index(self,*args,**kw):
+        _acquireLock()
+        try:
+            res = Base.drop_index(self,*args,**kw)
+        finally:
+            _releaseLock()
+        return res
+
     
@@ -0,0 +1,182 @@
+"""Persistent sorted secondary indexes
+
+An index on a fixed-length field is a sorted list of (block,id) pairs,
+where block is the string representation of the value in the field file.
+As these representations preserve the order of the values, records with
+s1 <= block <= s2 are found by bisection instead of browsing the field file
+
+The sorted list is saved in file __index_<field>__ of the base directory.
+Changes are appended to the journal __index_<field>.log__ and merged into
+the sorted file when the journal gets too long. Both files are checked for
+changes made by other processes before each search
+
+Every insert, update and delete writes the __version__ field file. The
+size and modification time of this file after the last change taken into
+account are stored with the index and each journal entry. If they differ
+from the current ones, the base was changed without updating the index,
+e.g. by a process which opened the base before the index was created, and
+the index is not used until it is rebuilt
+"""
+
+import os
+import sys
+import marshal
+from bisect import bisect_left, bisect_right
+
+class SortedIndex:
+
+    # minimum number of journal entries before it is merged in the index file
+    MIN_JOURNAL = 1000
+
+    def __init__(self,base,field):
+        self.base = base
+        self.field = field
+        self.path = os.path.join(base.name,'__index_%s__' %field)
+        self.journal_path = os.path.join(base.name,'__index_%s.log__' %field)
+        self.version_path = os.path.join(base.name,'__version__')
+        self.items = []
+        self.stamp = None # stamp of the base data the items correspond to
+        self._stat = None # (mtime,size) of the index file when read
+        self._offset = 0 # position in journal up to which changes are applied
+        self._journal_entries = 0
+        self._prepared = False # index was current before the base is changed
+
+    def create(self):
+        """Build the index from the records in the base"""
+        # records changed while browsing the base make the index stale
+        self.stamp = self._get_stat(self.version_path)
+        ix = self.base.field_names.index(self.field)
+        self.items = [ (rec[ix],rec.__id__) for rec in self.base ]
+        self.items.sort()
+        self.compact()
+        return self
+
+    def open(self):
+        self._load()
+        return self
+
+    def _load(self):
+        """Read the index file and apply all changes in the journal"""
+        index_file = open(self.path,'rb')
+        data = marshal.load(index_file)
+        self._stat = self._get_stat(self.path)
+        index_file.close()
+        if isinstance(data,tuple):
+            self.stamp,self.items = data
+        else:
+            # index without stamp, never used before it is rebuilt
+            self.stamp,self.items = None,data
+        self._offset = 0
+        self._journal_entries = 0
+        self._read_journal()
+
+    def _get_stat(self,path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return (info.st_mtime,info.st_size)
+
+    def _read_journal(self):
+        """Apply the changes in the journal after the current offset"""
+        if not os.path.exists(self.journal_path):
+            return
+        journal = open(self.journal_path,'rb')
+        journal.seek(self._offset)
+        while True:
+            try:
+                removed,added,stamp = marshal.load(journal)
+            except (EOFError,ValueError,TypeError):
+                # end of file or incomplete entry still being written
+                break
+            self._apply(removed,added)
+            self.stamp = stamp
+            self._offset = journal.tell()
+            self._journal_entries += 1
+        journal.close()
+
+    def refresh(self):
+        """Read the changes made to the index by other processes"""
+        journal_stat = self._get_stat(self.journal_path)
+        if self._get_stat(self.path) != self._stat or \
+                (journal_stat is not None and journal_stat[1] < self._offset):
+            # index file was rewritten
+            self._load()
+        elif journal_stat is not None and journal_stat[1] > self._offset:
+            self._read_journal()
+
+    def is_current(self):
+        """Check if the index includes all changes of the base"""
+        self.refresh()
+        return self.stamp is not None and \
+            self.stamp == self._get_stat(self.version_path)
+
+    def prepare(self):
+        """Called before the base is changed, return True if the index
+        is current and the change can be applied to it"""
+        self._prepared = self.is_current()
+        return self._prepared
+
+    def _apply(self,removed,added):
+        for item in removed:
+            pos = bisect_left(self.items,item)
+            if pos < len(self.items) and self.items[pos] == item:
+                del self.items[pos]
+        for item in added:
+            pos = bisect_left(self.items,item)
+            if pos == len(self.items) or self.items[pos] != item:
+                self.items.insert(pos,item)
+
+    def change(self,removed=[],added=[]):
+        """Remove and add lists of (block,id) pairs after the records were
+        changed in the base. Must be called after each change of the base,
+        even if no pair changed, to store the new stamp of the base
+        If the index was stale when prepare was called or the journal can't
+        be written the index stays stale"""
+        if not self._prepared:
+            return
+        self._prepared = False
+        stamp = self._get_stat(self.version_path)
+        try:
+            journal = open(self.journal_path,'ab')
+            marshal.dump((removed,added,stamp),journal)
+            journal.close()
+        except IOError:
+            return
+        self._apply(removed,added)
+        self.stamp = stamp
+        self._offset = os.path.getsize(self.journal_path)
+        self._journal_entries += 1
+        if self._journal_entries > max(self.MIN_JOURNAL,len(self.items)/4):
+            try:
+                self.compact()
+            except (IOError,OSError):
+                pass
+
+    def compact(self):
+        """Write the sorted list to the index file and reset the journal"""
+        tmp_path = self.path+'.tmp'
+        tmp_file = open(tmp_path,'wb')
+        marshal.dump((self.stamp,self.items),tmp_file)
+        tmp_file.close()
+        if os.path.exists(self.path) and sys.platform.startswith('win'):
+            os.remove(self.path)
+        os.rename(tmp_path,self.path)
+        open(self.journal_path,'wb').close()
+        self._stat = self._get_stat(self.path)
+        self._offset = 0
+        self._journal_entries = 0
+
+    def search(self,s1,s2):
+        """Return the ids of the records with s1 <= block <= s2
+        or None if the index is stale"""
+        if not self.is_current():
+            return None
+        start = bisect_left(self.items,(s1,))
+        end = bisect_right(self.items,(s2,sys.maxint))
+        return [ _id for block,_id in self.items[start:end] ]
+
+    def destroy(self):
+        for path in [self.path,self.journal_path]:
+            if os.path.exists(path):
+                os.remove(path)
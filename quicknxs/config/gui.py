@@ -10,6 +10,8 @@ interface='default'
 geometry=None
 state=None
 splitters=([240, 505, 239], [298, 438], [240, 169, 360])
+# memory used to cache datasets of recently read files [MB]
+cache_size=2048
 
 # plot options
 color_selection=0
@@ -46,8 +46,35 @@ DATABASE_ADDITIONAL_FIELDS=[
                            ]
 
 database_file=u'/SNS/REF_M/shared/quicknxs_database'
+# storage of the database, 'buzhug' or 'numpy' for memory mapped columns with fast
+# range queries, which are created from the buzhug database in the same folder
+database_backend='buzhug'
+# create the database records from the file headers and the stored X-Y projection,
+# without reading the 3D data
+database_header_only=True
+# folder with detector sensitivity maps usable as sensitivity_correction by name
+sensitivity_path=u'/SNS/REF_M/shared/quicknxs_sensitivity'
+
+# number of events read and binned at once from event mode files to limit memory usage,
+# None reads all events of a channel at once
+event_chunk_size=10000000
+# read the channels of a file in parallel using a 'thread' or 'process' pool,
+# None reads them one after another
+channel_pool=None
+# directory to store binned datasets for fast readout in later sessions and other programs,
+# None disables the on-disk cache
+disk_cache=None
+# keep histogram files open and only read the data regions used for reduction
+lazy_histogram=False
+# number of processes used to smooth off-specular data for the export,
+# None uses one for each CPU
+smooth_processes=None
 
 DATABASE_DIRECT_BEAM_COMPARE=[
                               ('s1h', 'S1VHeight', float, 1.0),
                               ('s2h', 'S2VHeight', float, 1.0),
                                ]
+
+# fields of the buzhug database with sorted indexes for fast range queries
+DATABASE_INDEX_FIELDS=['file_id', 'ai', 'lambda_center',
+                       's1w', 's1h', 's2w', 's2h', 's3w', 's3h']
@@ -5,14 +5,385 @@ direct beam measurements.
 '''
 
 import os
+import ast
+from multiprocessing import Pool, cpu_count
 from numpy import *
-from .buzhug import Base
+from .buzhug import Base, ResultSet
 from .qreduce import NXSData
 from .qcalc import get_xpos, get_yregion
 from .config import instrument as config
 from .decorators import log_call
 from logging import debug
 
+class ColumnRecord(list):
+  '''
+  Record of a ColumnBase selection with access to the values by field name.
+  '''
+  fields=[]
+
+  def __getattr__(self, key):
+    try:
+      return self[self.fields.index(key)]
+    except ValueError:
+      raise AttributeError, 'No attribute named %s'%key
+
+  def __repr__(self):
+    return '<'+' '.join(['%s:%s'%(key, value) for key, value in zip(self.fields, self)])+'>'
+
+class ColumnResultSet(ResultSet):
+  '''
+  Selection result of a ColumnBase, supports the same sort_by orders as buzhug.
+  '''
+
+  def sort_by(self, order):
+    keys=[]
+    direction='+'
+    for item in order.replace('+', ' + ').replace('-', ' - ').split():
+      if item in ['+', '-']:
+        direction=item
+      elif item in self.names:
+        keys.append((self.names.index(item), direction))
+      else:
+        raise ValueError, "Unknown sort field :%s"%item
+    # stable sorts from the last to the first key
+    for index, direction in reversed(keys):
+      self.sort(key=lambda rec: rec[index], reverse=(direction=='-'))
+    return self
+
+class _VectorizedRequest(ast.NodeTransformer):
+  '''
+  Replace boolean operators and chained comparisons of a request string
+  with numpy functions so it can be evaluated for whole columns.
+  '''
+
+  def _call(self, name, args):
+    return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args,
+                    keywords=[], starargs=None, kwargs=None)
+
+  def visit_BoolOp(self, node):
+    self.generic_visit(node)
+    if isinstance(node.op, ast.And):
+      return self._call('_and', node.values)
+    return self._call('_or', node.values)
+
+  def visit_UnaryOp(self, node):
+    self.generic_visit(node)
+    if isinstance(node.op, ast.Not):
+      return self._call('logical_not', [node.operand])
+    return node
+
+  def visit_Compare(self, node):
+    self.generic_visit(node)
+    if len(node.ops)==1:
+      return node
+    items=[node.left]+node.comparators
+    return self._call('_and', [ast.Compare(left=items[i], ops=[op], comparators=[items[i+1]])
+                               for i, op in enumerate(node.ops)])
+
+class ColumnBase(object):
+  '''
+  Database storing each field as a binary column file in a directory,
+  which are memory mapped as numpy arrays so selections are evaluated
+  as vectorized masks. String fields are stored as utf-8 data with a
+  column of end offsets. Implements the part of the buzhug Base
+  interface used by the DatabaseHandler.
+  '''
+  INFO_FILE='__columns__'
+  TYPES={'int': (int, '<i8'), 'float': (float, '<f8'), 'bool': (bool, '|b1'),
+         'str': (str, None), 'unicode': (unicode, None)}
+  STRING_TYPES=[str, unicode]
+
+  def __init__(self, path):
+    self.name=path
+    self.info_name=os.path.join(path, self.INFO_FILE)
+    self.field_names=[]
+    self.fields={}
+    self._columns={}
+    self._value_sets={}
+
+  def create(self, *fields):
+    '''
+    Create an empty base with (field_name, field_type) items.
+    '''
+    if os.path.exists(self.info_name):
+      raise IOError, "Base %s already exists"%self.name
+    if not os.path.exists(self.name):
+      os.makedirs(self.name)
+    types=dict([(value[0], key) for key, value in self.TYPES.items()])
+    info=[]
+    for name, ftype in fields:
+      if ftype not in types:
+        raise TypeError, "Field type %s not supported"%ftype
+      info.append('%s:%s'%(name, types[ftype]))
+      open(self._column_file(name), 'wb').close()
+      if ftype in self.STRING_TYPES:
+        open(self._string_file(name), 'wb').close()
+    open(self.info_name, 'wb').write('\n'.join(info)+'\n')
+    return self.open()
+
+  def open(self):
+    if not os.path.exists(self.info_name):
+      raise IOError, "No column base in directory %s"%self.name
+    self.field_names=[]
+    self.fields={}
+    for line in open(self.info_name, 'rb').read().split():
+      name, ftype=line.split(':', 1)
+      self.field_names.append(name)
+      self.fields[name]=self.TYPES[ftype][0]
+    self._columns={}
+    self._value_sets={}
+    return self
+
+  def close(self):
+    self._columns={}
+    self._value_sets={}
+
+  def _column_file(self, name):
+    return os.path.join(self.name, name+'.col')
+
+  def _string_file(self, name):
+    return os.path.join(self.name, name+'.str')
+
+  def _dtype(self, name):
+    if self.fields[name] in self.STRING_TYPES:
+      # end offsets of the strings
+      return dtype('<i8')
+    return dtype([item[1] for item in self.TYPES.values() if item[0] is self.fields[name]][0])
+
+  def _get_column(self, name):
+    '''
+    Return the memory mapped column file, which is mapped again if
+    its size changed e.g. by inserts of another process.
+    '''
+    fname=self._column_file(name)
+    size=os.path.getsize(fname)
+    if name in self._columns and self._columns[name][0]==size:
+      return self._columns[name][1]
+    ftype=self._dtype(name)
+    if size<ftype.itemsize:
+      column=zeros(0, dtype=ftype)
+    else:
+      column=memmap(fname, dtype=ftype, mode='r', shape=(size//ftype.itemsize,))
+    self._columns[name]=(size, column)
+    return column
+
+  def _get_strings(self, name, indices):
+    '''
+    Decode the strings of a field for the given record indices.
+    '''
+    column=self._get_column(name)
+    ends=array(column[indices])
+    starts=array(column[maximum(indices-1, 0)])
+    starts[indices==0]=0
+    output=[]
+    if len(indices)==0:
+      return output
+    # read the data range covering all strings at once
+    offset=starts.min()
+    data=open(self._string_file(name), 'rb')
+    data.seek(offset)
+    data_range=data.read(ends.max()-offset)
+    data.close()
+    for start, end in zip((starts-offset).tolist(), (ends-offset).tolist()):
+      value=data_range[start:end]
+      if self.fields[name] is unicode:
+        value=value.decode('utf8')
+      output.append(value)
+    return output
+
+  def __len__(self):
+    if not self.field_names:
+      return 0
+    return min([os.path.getsize(self._column_file(name))//self._dtype(name).itemsize
+                for name in self.field_names])
+
+  def _repair(self):
+    '''
+    Remove items of an interrupted insert so all columns have the same length.
+    '''
+    length=len(self)
+    for name in self.field_names:
+      fname=self._column_file(name)
+      size=length*self._dtype(name).itemsize
+      if os.path.getsize(fname)>size:
+        open(fname, 'r+b').truncate(size)
+      if self.fields[name] in self.STRING_TYPES:
+        end=0
+        if length>0:
+          end=int(self._get_column(name)[length-1])
+        if os.path.getsize(self._string_file(name))>end:
+          open(self._string_file(name), 'r+b').truncate(end)
+
+  def insert(self, *args, **kw):
+    '''
+    Insert one record with the values ordered as the fields or given as keywords.
+    '''
+    if args and kw:
+      raise SyntaxError, "Can't use both positional and keyword arguments"
+    if kw:
+      args=[kw.get(name, None) for name in self.field_names]
+    if len(args)!=len(self.field_names):
+      raise TypeError, "Expected %s arguments, found %s"%(len(self.field_names), len(args))
+    self.insert_many([args])
+    return len(self)-1
+
+  def insert_many(self, records):
+    '''
+    Insert several records with the values ordered as the fields.
+    '''
+    self._repair()
+    values=zip(*records)
+    if not values:
+      return
+    # the string data is written first, so an interrupted insert is repaired
+    # by cutting all columns to the shortest one
+    for name, items in zip(self.field_names, values):
+      if self.fields[name] in self.STRING_TYPES:
+        data=open(self._string_file(name), 'ab')
+        end=os.path.getsize(self._string_file(name))
+        ends=[]
+        for item in items:
+          if item is None:
+            item=''
+          if type(item) is unicode:
+            item=item.encode('utf8')
+          data.write(item)
+          end+=len(item)
+          ends.append(end)
+        data.close()
+        array(ends, dtype=self._dtype(name)).tofile(open(self._column_file(name), 'ab'))
+    for name, items in zip(self.field_names, values):
+      if self.fields[name] not in self.STRING_TYPES:
+        items=[{int: 0, float: nan, bool: False}[self.fields[name]] if item is None else item
+               for item in items]
+        array(items, dtype=self._dtype(name)).tofile(open(self._column_file(name), 'ab'))
+
+  def import_base(self, base):
+    '''
+    Insert all records of a buzhug base with the same fields in the order of insertion.
+    '''
+    records=base.select(['__id__']+self.field_names)
+    records.sort_by('+__id__')
+    self.insert_many([[getattr(record, name) for name in self.field_names] for record in records])
+
+  def __call__(self, **kw):
+    return self.select(None, None, **kw)
+
+  def has_value(self, name, value):
+    '''
+    Check if any record has the given value of a field using a set of all values,
+    which is extended by the records inserted since the last call.
+    '''
+    length=len(self)
+    known, values=self._value_sets.get(name, (0, set()))
+    if length<known:
+      known, values=0, set()
+    if length>known:
+      if self.fields[name] in self.STRING_TYPES:
+        values.update(self._get_strings(name, arange(known, length)))
+      else:
+        values.update(self._get_column(name)[known:length].tolist())
+      self._value_sets[name]=(length, values)
+    return value in values
+
+  def select(self, names=None, request=None, **args):
+    '''
+    Select records using field_name=value or field_name=[low, high] keywords and/or
+    a request string with the values given as keywords, as for buzhug.
+    Only field names are supported, all fields of the records are returned.
+    '''
+    length=len(self)
+    mask=ones(length, dtype=bool)
+    if request is None:
+      for key, value in args.items():
+        if key not in self.fields:
+          raise NameError, "Unknown field %s"%key
+        if self.fields[key] in self.STRING_TYPES:
+          column=array(self._get_strings(key, arange(length)), dtype=object)
+        else:
+          column=self._get_column(key)[:length]
+        if isinstance(value, (list, tuple)):
+          low, high=sorted(value)
+          mask&=(column>=low)&(column<=high)
+        else:
+          mask&=(column==value)
+    else:
+      mask&=self._evaluate(request, length, args)
+    return self._get_records(where(mask)[0])
+
+  def _evaluate(self, request, length, args):
+    '''
+    Evaluate a request string for all records, vectorized if possible.
+    '''
+    tree=ast.parse(request, mode='eval')
+    used=set([node.id for node in ast.walk(tree) if isinstance(node, ast.Name)])
+    names=[name for name in self.field_names if name in used]
+    namespace=dict(args)
+    for name in names:
+      if self.fields[name] in self.STRING_TYPES:
+        namespace[name]=array(self._get_strings(name, arange(length)), dtype=object)
+      else:
+        namespace[name]=self._get_column(name)[:length]
+    try:
+      tree=_VectorizedRequest().visit(tree)
+      code=compile(ast.fix_missing_locations(tree), '<request>', 'eval')
+      namespace.update({'_and': lambda *items: reduce(logical_and, items),
+                        '_or': lambda *items: reduce(logical_or, items),
+                        'logical_not': logical_not})
+      result=eval(code, {}, namespace)
+      if not isinstance(result, ndarray):
+        return ones(length, dtype=bool)*bool(result)
+      return result.astype(bool)
+    except Exception:
+      # request can not be evaluated for the columns, test each record
+      code=compile(request, '<request>', 'eval')
+      result=zeros(length, dtype=bool)
+      for i in range(length):
+        record=dict(args)
+        record.update([(name, namespace[name][i]) for name in names])
+        result[i]=bool(eval(code, {}, record))
+      return result
+
+  def _get_records(self, indices):
+    '''
+    Create a ColumnResultSet of the records at the given indices.
+    '''
+    values=[]
+    for name in self.field_names:
+      if self.fields[name] in self.STRING_TYPES:
+        values.append(self._get_strings(name, indices))
+      else:
+        values.append(self._get_column(name)[indices].tolist())
+    class _Record(ColumnRecord):
+      fields=list(self.field_names)
+    return ColumnResultSet(list(self.field_names), [_Record(item) for item in zip(*values)])
+
+def _load_dataset(file_id):
+  '''
+  Read the dataset with the given file index to create its database record.
+  '''
+  return NXSData(file_id, use_caching=False,
+                 event_chunk_size=config.event_chunk_size,
+                 disk_cache=config.disk_cache,
+                 header_only=config.database_header_only)
+
+def _create_record(file_id):
+  '''
+  Load a dataset and create its database record, executed in the pool process.
+  
+  :returns: file index and record or None if the record could not be created
+  '''
+  try:
+    dataset=_load_dataset(file_id)
+    if dataset is None:
+      return file_id, None
+    return file_id, DatabaseHandler().get_record(dataset)
+  except KeyboardInterrupt:
+    raise KeyboardInterrupt
+  except:
+    debug('Could not create record for dataset with index %i:'%file_id, exc_info=True)
+    return file_id, None
+
 class DatabaseHandler(object):
   '''
   Objects with database handling methods to store and process information about
@@ -30,13 +401,42 @@ class DatabaseHandler(object):
 
   @log_call
   def create_db(self):
-    self.db=Base(config.database_file)
-    self.db.create(*self.fields)
+    if config.database_backend=='numpy':
+      self.db=ColumnBase(config.database_file)
+      self.db.create(*self.fields)
+      if os.path.exists(os.path.join(config.database_file, '__info__')):
+        # create the columns from an existing buzhug database in the same folder
+        base=Base(config.database_file).open()
+        self.db.import_base(base)
+        base.close()
+    else:
+      self.db=Base(config.database_file)
+      self.db.create(*self.fields)
 
   @log_call
   def load_db(self):
-    self.db=Base(config.database_file)
-    self.db.open()
+    if config.database_backend=='numpy':
+      self.db=ColumnBase(config.database_file)
+      self.db.open()
+    else:
+      self.db=Base(config.database_file)
+      self.db.open()
+
+  def create_indexes(self):
+    '''
+    Create the sorted buzhug indexes used for range queries, or rebuild them if
+    they are not up to date. Only called from the process writing to the database,
+    which then keeps the indexes up to date.
+    '''
+    db=self.get_database()
+    if config.database_backend=='numpy':
+      return
+    fields=[field for field in config.DATABASE_INDEX_FIELDS if field in db.field_names]
+    try:
+      db.create_index(*fields)
+    except (IOError, OSError):
+      # no write access to the database folder
+      debug('Could not create database indices for %s'%repr(fields), exc_info=True)
 
   @log_call
   def close_db(self):
@@ -45,7 +445,11 @@ class DatabaseHandler(object):
       self.db=None
 
   def get_database(self):
-    if self.db is None and os.path.exists(config.database_file):
+    if config.database_backend=='numpy':
+      exists=os.path.exists(os.path.join(config.database_file, ColumnBase.INFO_FILE))
+    else:
+      exists=os.path.exists(config.database_file)
+    if self.db is None and exists:
       self.load_db()
     elif self.db is None:
       self.create_db()
@@ -95,11 +499,11 @@ class DatabaseHandler(object):
     '''
     db=self.get_database()
     if type(dataset) is int:
-      if len(db(file_id=dataset))>0:
+      if self.exists(dataset):
         debug('Item already in database %s'%repr(dataset))
         return True
       try:
-        dataset=NXSData(dataset, use_caching=False)
+        dataset=_load_dataset(dataset)
       except KeyboardInterrupt:
         raise KeyboardInterrupt
       except:
@@ -113,12 +517,60 @@ class DatabaseHandler(object):
     except:
       debug('Could not create record for dataset %s:'%repr(dataset), exc_info=True)
       return None
-    if len(db(file_id=dataset.number))>0:
+    if self.exists(dataset.number):
       debug('Item already in database %s'%repr(dataset))
       return True
     db.insert(*record)
     return True
 
+  @log_call
+  def add_records(self, file_ids, processes=None, callback=None, stop_event=None):
+    '''
+    Create the records of several datasets in a pool of worker processes and
+    insert them from this process, which stays the only one writing to the database.
+    The records are inserted in the order of file_ids, so an interrupted run
+    can be resumed by calling it again with the same indices.
+    The pool is forked, so no other threads should be running when it is called.
+    
+    :param list file_ids: File indices to add, indices already in the database are skipped
+    :param int processes: Number of worker processes, defaults to one for each CPU
+    :param callback: Function called with (file_id, added, done, total) after each dataset
+    :param threading.Event stop_event: Stop adding records when this event is set
+    
+    :returns: list of the file indices added to the database
+    '''
+    db=self.get_database()
+    file_ids=[file_id for file_id in file_ids if not self.exists(file_id)]
+    if not file_ids:
+      return []
+    if processes is None:
+      processes=cpu_count()
+    pool=Pool(min(processes, len(file_ids)))
+    added=[]
+    try:
+      # imap keeps the order of the indices while the workers read ahead
+      for done, (file_id, record) in enumerate(pool.imap(_create_record, file_ids)):
+        # the record index is the number stored in the file, as for add_record
+        if record is not None and not self.exists(record[0]):
+          db.insert(*record)
+          added.append(file_id)
+        if callback is not None:
+          callback(file_id, record is not None, done+1, len(file_ids))
+        if stop_event is not None and stop_event.is_set():
+          break
+    finally:
+      pool.terminate()
+      pool.join()
+    return added
+
+  def exists(self, file_id):
+    '''
+    Check if a dataset with the given file index is in the database, without
+    running a selection over all records.
+    '''
+    db=self.get_database()
+    return db.has_value('file_id', int(file_id))
+
   def __del__(self):
     if self.db is None:
       self.close_db()
@@ -6,6 +6,7 @@ on the file system.
 
 import os
 import logging
+from time import time
 from threading import Thread, Event
 from . import database, qreduce
 from .config import instrument
@@ -29,6 +30,8 @@ class DatabaseUpdater(Thread):
     self.quit_event=Event()
     self.quit_event.clear()
     self.db=database.DatabaseHandler()
+    # this thread is the only writer and maintains the indexes
+    self.db.create_indexes()
 
     # define which file index will be indexed first
     # this can be either given on command line, read from the database
@@ -57,9 +60,9 @@ class DatabaseUpdater(Thread):
     Check if file index is in database without trying to add it.
     '''
     if idx is None:
-      return len(self.db(file_id=self.current_index))>0
+      return self.db.exists(self.current_index)
     else:
-      return len(self.db(file_id=idx))>0
+      return self.db.exists(idx)
 
   def check(self):
     '''
@@ -82,6 +85,42 @@ class DatabaseUpdater(Thread):
       # check if the file actually exists before trying to add it
       fname=qreduce.locate_file(self.current_index, verbose=False)
 
+  def backfill(self, processes=None, end_index=None):
+    '''
+    Add all available files from current_index up to end_index, which defaults
+    to the index of the live data file, creating the records in parallel.
+    Files already in the database are skipped, so an interrupted backfill
+    continues where it stopped.
+    The worker processes are forked, so this has to be called before any other
+    thread is started. A child forked while another thread holds a lock, e.g.
+    of a logging handler, would block forever.
+    '''
+    if end_index is None:
+      if not os.path.exists(instrument.LIVE_DATA):
+        return
+      live_ds=qreduce.NXSData(instrument.LIVE_DATA)
+      if live_ds is None:
+        return
+      end_index=live_ds.number
+    # indices already in the database are skipped by add_records
+    file_ids=[i for i in range(self.current_index, end_index)
+              if qreduce.locate_file(i, verbose=False) is not None]
+    logging.info('Backfill of files with index %i to %i.'%(self.current_index, end_index-1))
+    self._backfill_start=time()
+    self.db.add_records(file_ids, processes=processes, callback=self._backfill_progress,
+                        stop_event=self.quit_event)
+    if not self.quit_event.is_set():
+      self.current_index=max(self.current_index, end_index)
+
+  def _backfill_progress(self, file_id, added, done, total):
+    remaining=(time()-self._backfill_start)/done*(total-done)
+    if added:
+      logging.info('Backfill %i/%i: file index %i added, %.0fs remaining.'%(done, total,
+                                                                         file_id, remaining))
+    else:
+      logging.info('Backfill %i/%i: could not add file index %i, %.0fs remaining.'%(done, total,
+                                                                                 file_id, remaining))
+
   def check_live_index(self):
     '''
     Make sure we can step over missing files with self.check().
@@ -9,7 +9,7 @@ from tempfile import gettempdir
 from zipfile import ZipFile, ZIP_DEFLATED
 from cStringIO import StringIO
 from time import sleep, time
-from numpy import hstack, array, where, histogram2d, log10, meshgrid, sqrt
+from numpy import array, log10
 from logging import warning, debug, info
 
 import smtplib
@@ -33,6 +33,7 @@ from .plot_dialog import Ui_Dialog as UiPlot
 from .reduce_dialog import Ui_Dialog as UiReduction
 from .smooth_dialog import Ui_Dialog as UiSmooth
 from .qreduce import GISANS
+from .qcalc import gisans_slices
 from .qio import Exporter
 from .decorators import log_call, log_output
 from . import genx_data
@@ -77,21 +78,48 @@ class Reducer(object):
     self.exported_files_plots=[]
     self.exported_files_data=[]
 
+    # off-specular maps that are only written to ASCII files are streamed
+    # one dataset at a time instead of keeping all of them in memory
+    stream_offspec=not (opts['exportOffSpecularSmoothed'] or opts['matlab'] or opts['numpy'] or
+                        opts['plot'] or (opts['mantidplot'] and FROM_MANTID))
+
     # calculate and collect reflectivities
     self.exporter=Exporter(self.channels, self.refls,
-                           sample_length=opts['sampleSize'])
-    info('Re-reading all datasets...')
-    self.exporter.read_data()
-
-    if opts['exportSpecular']:
+                           sample_length=opts['sampleSize'], preload=False)
+    if not stream_offspec:
+      info('Re-reading all datasets...')
+      self.exporter.read_data()
+
+    # when streaming, the reflectivity is extracted in the same readout of each file
+    stream_specular=stream_offspec and opts['exportSpecular'] and \
+                    (opts['exportOffSpecular'] or opts['exportOffSpecularCorr'])
+    if opts['exportSpecular'] and not stream_specular:
       info('Extracting reflectivity...')
       self.exporter.extract_reflectivity()
     if opts['exportOffSpecular'] or opts['exportOffSpecularSmoothed']:
-      info('Extracting off-specular data...')
-      self.exporter.extract_offspecular()
+      if stream_offspec:
+        info('Extracting and writing off-specular data...')
+        self.exporter.stream_offspecular(opts['foldername'], opts['naming'],
+                                         multi_ascii=opts['multiAscii'],
+                                         combined_ascii=opts['combinedAscii'],
+                                         check_exists=self.check_exists,
+                                         specular=stream_specular)
+        stream_specular=False
+      else:
+        info('Extracting off-specular data...')
+        self.exporter.extract_offspecular()
     if opts['exportOffSpecularCorr']:
-      info('Extracting corrected off-specular data...')
-      self.exporter.extract_offspecular_corr()
+      if stream_offspec:
+        info('Extracting and writing corrected off-specular data...')
+        self.exporter.stream_offspecular(opts['foldername'], opts['naming'],
+                                         multi_ascii=opts['multiAscii'],
+                                         combined_ascii=opts['combinedAscii'],
+                                         corrected=True,
+                                         check_exists=self.check_exists,
+                                         specular=stream_specular)
+      else:
+        info('Extracting corrected off-specular data...')
+        self.exporter.extract_offspecular_corr()
     if opts['exportOffSpecularSmoothed']:
       self.smooth_offspec()
       if not opts['exportOffSpecular']:
@@ -156,9 +184,9 @@ class Reducer(object):
     '''
     output_data=dict([(channel, []) for channel in self.channels])
     for refli in self.refls:
-      opts=refli.options
-      index=opts['number']
-      fdata=self.exporter.raw_data[index]
+      opts=dict(refli.options)
+      opts['gisans_lean']=True
+      fdata=self.exporter.get_raw_data(refli)
       for channel in self.channels:
         gisans=GISANS(fdata[channel], **opts)
         output_data[channel].append(gisans)
@@ -177,8 +205,8 @@ class Reducer(object):
         for refli in self.refls:
           opts=dict(refli.options)
           opts['gisans_no_DP']=False
-          index=opts['number']
-          fdata=self.exporter.raw_data[index]
+          opts['gisans_lean']=True
+          fdata=self.exporter.get_raw_data(refli)
           for channel in self.channels:
             gisans=GISANS(fdata[channel], **opts)
             output_data[channel].append(gisans)
@@ -212,7 +240,7 @@ class Reducer(object):
                       info_start=pbinfo+self.channels[0],
                       maximum=100*len(self.channels))
     pb.show()
-    self.exporter.smooth_offspec(settings, pb)
+    self.exporter.smooth_offspec(settings, pb, processes=instrument.smooth_processes)
     pb.destroy()
 
   @log_call
@@ -789,6 +817,8 @@ class GISANSCalculation(QThread):
     send a signal aver each subframe has been finished.
   '''
   frameFinished=pyqtSignal(int)
+  # number of subframes projected together
+  chunk_size=4
 
   def __init__(self, datasets, lmin, lmax, lsteps, gridQy=50, gridQz=50):
     QThread.__init__(self)
@@ -800,45 +830,13 @@ class GISANSCalculation(QThread):
 
   def run(self):
     self.results=[]
-    for i in range(self.lsteps):
-      result=self.calc_single(i)
-      self.results.append(result)
-      self.frameFinished.emit(i)
-
-  def calc_single(self, i):
-    lsize=(self.lmax-self.lmin)/self.lsteps
-    lmin=self.lmin+i*lsize
-    lmax=self.lmin+(i+1)*lsize
-
-    data=self.datasets[0]
-    P0=len(data.lamda)-data.options['P0']
-    PN=data.options['PN']
-    # filter the points
-    region=where((data.lamda[PN:P0]>=lmin)&(data.lamda[PN:P0]<=lmax))
-    I=data.S[:, :, region].flatten()
-    dI=data.dS[:, :, region].flatten()
-    qy=data.Qy[:, :, region].flatten()
-    qz=data.Qz[:, :, region].flatten()
-    for data in self.datasets[1:]:
-      # add points from all datasets
-      P0=len(data.lamda)-data.options['P0']
-      PN=data.options['PN']
-      # filter the points
-      region=where((data.lamda[PN:P0]>=lmin)&(data.lamda[PN:P0]<=lmax))
-      I=hstack([I, data.S[:, :, region].flatten()])
-      dI=hstack([dI, data.dS[:, :, region].flatten()])
-      qy=hstack([qy, data.Qy[:, :, region].flatten()])
-      qz=hstack([qz, data.Qz[:, :, region].flatten()])
-    Isum, ignore, ignore=histogram2d(qy, qz, bins=self.grid, weights=I)
-    dIsum, ignore, ignore=histogram2d(qy, qz, bins=self.grid, weights=dI**2)
-    Npoints, Qy, Qz=histogram2d(qy, qz, bins=self.grid)
-    Isum[Npoints>0]/=Npoints[Npoints>0]
-    dIsum=sqrt(dIsum)
-    dIsum[Npoints>0]/=Npoints[Npoints>0]
-    Qy=(Qy[:-1]+Qy[1:])/2.
-    Qz=(Qz[:-1]+Qz[1:])/2.
-    Qz, Qy=meshgrid(Qz, Qy)
-    return Isum, Qy, Qz, lmin, lmax, dIsum
+    # project a few subframes at a time so the first ones are shown early
+    for first in range(0, self.lsteps, self.chunk_size):
+      last=min(first+self.chunk_size, self.lsteps)
+      self.results+=gisans_slices(self.datasets, self.lmin, self.lmax, self.lsteps,
+                                  self.grid, first, last)
+      for i in range(first, last):
+        self.frameFinished.emit(i)
 
 
 class GISANSDialog(QDialog):
@@ -859,7 +857,7 @@ class GISANSDialog(QDialog):
     self.ui.splitter.setSizes([350, 250])
     self.drawLambda()
     self.ui.iMax.setValue(log10(datasets[0].S.max()*2.))
-    self.ui.iMin.setValue(log10(datasets[0].S[datasets[0].I>0].min()/40.))
+    self.ui.iMin.setValue(log10(datasets[0].S[datasets[0].S>0].min()/40.))
 
   @log_call
   def drawLambda(self):
@@ -135,6 +135,7 @@ class MainGUI(QtGui.QMainWindow):
     self.y_position_indicator.setMinimumWidth(100)
     self.ui.statusbar.addPermanentWidget(self.y_position_indicator)
 
+    NXSData.MAX_CACHE_BYTES=gui.cache_size*1024**2
     self.cache_indicator=QtGui.QLabel("Cache Size: 0.0MB")
     self.ui.statusbar.addPermanentWidget(self.cache_indicator)
     button=QtGui.QPushButton('Empty Cache')
@@ -343,12 +344,24 @@ class MainGUI(QtGui.QMainWindow):
 
     self._norm_selected=None
     info(u"Reading file %s..."%(filename))
-    data=NXSData(filename,
-          bin_type=self.ui.eventBinMode.currentIndex(),
-          bins=self.ui.eventTofBins.value(),
-          callback=self.updateEventReadout,
-          event_split_bins=event_split_bins,
-          event_split_index=event_split_index)
+    if event_split_bins is None:
+      data=NXSData(filename,
+            bin_type=self.ui.eventBinMode.currentIndex(),
+            bins=self.ui.eventTofBins.value(),
+            callback=self.updateEventReadout,
+            event_chunk_size=instrument.event_chunk_size,
+            disk_cache=instrument.disk_cache,
+            channel_pool=instrument.channel_pool,
+            lazy_histogram=instrument.lazy_histogram)
+    else:
+      # read all time slices at once, so stepping through them uses the cache
+      data=NXSData.read_split(filename,
+            bin_type=self.ui.eventBinMode.currentIndex(),
+            bins=self.ui.eventTofBins.value(),
+            callback=self.updateEventReadout,
+            event_split_bins=event_split_bins,
+            event_chunk_size=instrument.event_chunk_size,
+            disk_cache=instrument.disk_cache)[event_split_index]
     self._fileOpenDone(data, filename, do_plot)
 
   @log_input
@@ -365,7 +378,11 @@ class MainGUI(QtGui.QMainWindow):
       data=NXSMultiData(filenames,
             bin_type=self.ui.eventBinMode.currentIndex(),
             bins=self.ui.eventTofBins.value(),
-            callback=self.updateEventReadout)
+            callback=self.updateEventReadout,
+            event_chunk_size=instrument.event_chunk_size,
+            disk_cache=instrument.disk_cache,
+            channel_pool=instrument.channel_pool,
+            lazy_histogram=instrument.lazy_histogram)
     except:
       warning('Could not open files to sum them up:', exc_info=True)
       return
@@ -442,7 +459,7 @@ class MainGUI(QtGui.QMainWindow):
     """
     Empty the NXSData readout cache.
     """
-    NXSData._cache=[]
+    NXSData.clear_cache()
     self.cache_indicator.setText('Cache Size: 0.0MB')
 
 ####### Plot related methods
@@ -1098,6 +1115,7 @@ class MainGUI(QtGui.QMainWindow):
     region=where(norm.Rraw>(norm.Rraw.max()*0.1))[0]
     options['P0']=len(norm.Rraw)-region[-1]
     options['PN']=region[0]
+    options['gisans_lean']=True
     if self._gisansThread:
       self._gisansThread.finished.disconnect()
       self._gisansThread.terminate()
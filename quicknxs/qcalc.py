@@ -12,7 +12,7 @@ from .qreduce import Reflectivity, MRDataset
 
 # used for * imports
 __all__=['get_total_reflection', 'get_scaling', 'get_xpos', 'get_yregion',
-         'smooth_data', 'refine_gauss']
+         'smooth_data', 'refine_gauss', 'gisans_slices']
 
 @log_both
 def get_total_reflection(refl, return_npoints=False):
@@ -238,12 +238,15 @@ def refine_gauss(data, pos, width, return_params=False):
 
 @log_input
 def smooth_data(settings, x, y, I, sigmas=3.,
-                axis_sigma_scaling=None, xysigma0=0.06, callback=None):
+                axis_sigma_scaling=None, xysigma0=0.06, callback=None, rows=None):
   '''
   Smooth a irregular spaced dataset onto a regular grid.
   Takes each intensities with a distance < 3*sigma
   to a given grid point and averages their intensities
   weighted by the gaussian of the distance.
+  
+  The points are sorted into cells of the grid size beforehand, so only the
+  points of the cells within the search range are compared to each grid point.
 
   :param dict settings: Contains options for 'grid', 'sigma' and 'region' of the algorithm
   :param numpy.ndarray x: x-values of the original data
@@ -253,6 +256,8 @@ def smooth_data(settings, x, y, I, sigmas=3.,
   :param int axis_sigma_scaling: Defines how the sigmas change with the x/y value
   :param float xysigma0: x/y value where the given sigmas are used
   :param callback: Optional function to be called to display the calculation progress
+  :param tuple rows: Only calculate the grid lines from rows[0] to rows[1]-1,
+                     used to split the calculation into parallel tasks
   '''
   gridx, gridy=settings['grid']
   sigmax, sigmay=settings['sigma']
@@ -262,26 +267,129 @@ def smooth_data(settings, x, y, I, sigmas=3.,
   Xout, Yout=meshgrid(xout, yout)
   Iout=zeros_like(Xout)
   ssigmax, ssigmay=sigmax**2, sigmay**2
+  # squared sigmas for each grid point
+  if axis_sigma_scaling:
+    if axis_sigma_scaling==1: XYout=Xout
+    elif axis_sigma_scaling==2: XYout=Yout
+    elif axis_sigma_scaling==3: XYout=Xout+Yout
+    ssigmaxs=ssigmax/xysigma0*XYout
+    ssigmays=ssigmay/xysigma0*XYout
+  else:
+    XYout=ones_like(Xout)
+    ssigmaxs=ssigmax*XYout
+    ssigmays=ssigmay*XYout
+  x=asarray(x, dtype=float).flatten()
+  y=asarray(y, dtype=float).flatten()
+  I=asarray(I).flatten()
+  valid=isfinite(x)&isfinite(y)
+  x, y, I=x[valid], y[valid], I[valid]
+  if rows is None:
+    rows=(0, gridy)
+  row_from, row_to=rows
+  calc_rows=zeros(Xout.shape, dtype=bool)
+  calc_rows[row_from:row_to]=True
+  # grid points with zero x/y value are skipped, with negative sigmas
+  # all points are within the search range and without finite sigmas none
+  positive=(ssigmaxs>0)&(ssigmays>0)&isfinite(ssigmaxs)&isfinite(ssigmays)&calc_rows
+  negative=logical_not(positive|isnan(ssigmaxs)|isnan(ssigmays)|(XYout==0))&calc_rows
+  if not positive.any() or len(x)==0:
+    return _smooth_data_all(Xout, Yout, Iout, negative, ssigmaxs, ssigmays,
+                            x, y, I, sigmas, callback)
+  Rx=sigmas*sqrt(ssigmaxs[positive]).max()
+  Ry=sigmas*sqrt(ssigmays[positive]).max()
+  # size of the cells the points are sorted into
+  if gridx>1 and x1!=x2:
+    cx=abs(x2-x1)/float(gridx-1)
+  else:
+    cx=Rx
+  if gridy>1 and y1!=y2:
+    cy=abs(y2-y1)/float(gridy-1)
+  else:
+    cy=Ry
+  gcx=floor((xout-x1)/cx+0.5).astype(int)
+  gcy=floor((yout[row_from:row_to]-y1)/cy+0.5).astype(int)
+  # only cells within the search range of any grid point are needed
+  kx=int(ceil(Rx/cx))+1
+  ky=int(ceil(Ry/cy))+1
+  cxmin=gcx.min()-kx
+  cymin=gcy.min()-ky
+  ncx=gcx.max()+kx-cxmin+1
+  ncy=gcy.max()+ky-cymin+1
+  pcx=floor((x-x1)/cx+0.5)
+  pcy=floor((y-y1)/cy+0.5)
+  inside=(pcx>=cxmin)&(pcx<cxmin+ncx)&(pcy>=cymin)&(pcy<cymin+ncy)
+  pcx=pcx[inside].astype(int)-cxmin
+  pcy=pcy[inside].astype(int)-cymin
+  # sort points by cell, points of a row of cells are consecutive
+  cell=pcy*ncx+pcx
+  order=argsort(cell, kind='mergesort')
+  xs, ys, Is=x[inside][order], y[inside][order], I[inside][order]
+  cell_start=hstack([[0], bincount(cell, minlength=ncx*ncy).cumsum()])
+
+  for i in range(row_from, row_to):
+    if callback is not None and (i-row_from)%5==0:
+      progress=float(i-row_from)/(row_to-row_from)
+      callback(progress)
+    j=where(positive[i])[0]
+    if len(j)==0:
+      continue
+    ssigmaxi=ssigmaxs[i, j]
+    ssigmayi=ssigmays[i, j]
+    xg=xout[j]
+    yg=yout[i]
+    # range of cell rows to search for each grid point,
+    # with a small margin for rounding errors
+    Ryi=sigmas*sqrt(ssigmayi)
+    row_low=maximum(floor((yg-Ryi-y1)/cy+0.5-1e-6).astype(int)-cymin, 0)
+    row_high=minimum(floor((yg+Ryi-y1)/cy+0.5+1e-6).astype(int)-cymin, ncy-1)
+    # list all (grid point, cell row) combinations
+    nrows=maximum(row_high-row_low+1, 0)
+    gidx=repeat(arange(len(j)), nrows)
+    rows=arange(nrows.sum())+repeat(row_low-(nrows.cumsum()-nrows), nrows)
+    # the y-distance of the cell row limits the x-range to search
+    dy=maximum(abs(y1+(rows+cymin)*cy-yg)-0.5*cy*(1.+1e-6), 0.)
+    dx=sqrt(ssigmaxi[gidx]*maximum(sigmas**2-dy**2/ssigmayi[gidx], 0.))
+    col_low=maximum(floor((xg[gidx]-dx-x1)/cx+0.5-1e-6).astype(int)-cxmin, 0)
+    col_high=minimum(floor((xg[gidx]+dx-x1)/cx+0.5+1e-6).astype(int)-cxmin, ncx-1)
+    start=cell_start[rows*ncx+col_low]
+    stop=maximum(cell_start[rows*ncx+col_high+1], start)
+    # list all (grid point, data point) combinations in these cells
+    npoints=stop-start
+    pg=repeat(gidx, npoints)
+    pt=arange(npoints.sum())+repeat(start-(npoints.cumsum()-npoints), npoints)
+    if (ssigmaxi==ssigmaxi[0]).all() and (ssigmayi==ssigmayi[0]).all():
+      # same sigmas for the whole line
+      ssigmaxi=ssigmaxi[0]
+      ssigmayi=ssigmayi[0]
+    else:
+      ssigmaxi=ssigmaxi[pg]
+      ssigmayi=ssigmayi[pg]
+    rij=(xs[pt]-xg[pg])**2/ssigmaxi+(ys[pt]-yg)**2/ssigmayi # normalized distance^2
+    take=rij<sigmas**2 # take points up to 3 sigma distance
+    pg=pg[take]
+    Pij=exp(-0.5*rij[take])
+    ntaken=bincount(pg, minlength=len(j))
+    Psum=bincount(pg, weights=Pij, minlength=len(j))
+    PIsum=bincount(pg, weights=Pij*Is[pt[take]], minlength=len(j))
+    use=ntaken>0
+    Iout[i, j[use]]=PIsum[use]/Psum[use]
+  return _smooth_data_all(Xout, Yout, Iout, negative, ssigmaxs, ssigmays, x, y, I, sigmas)
+
+def _smooth_data_all(Xout, Yout, Iout, select, ssigmaxs, ssigmays, x, y, I, sigmas,
+                     callback=None):
+  '''
+  Calculate the smoothed intensity of the selected grid points of smooth_data comparing
+  each grid point with all points. Used for negative or infinite sigmas, where the
+  search range of a grid point is not limited.
+  '''
   imax=len(Xout)
   for i in range(imax):
     if callback is not None and i%5==0:
       progress=float(i)/imax
       callback(progress)
-    for j in range(len(Xout[0])):
-      xij=Xout[i, j]
-      yij=Yout[i, j]
-      if axis_sigma_scaling:
-        if axis_sigma_scaling==1: xyij=xij
-        elif axis_sigma_scaling==2: xyij=yij
-        elif axis_sigma_scaling==3: xyij=xij+yij
-        if xyij==0:
-          continue
-        ssigmaxi=ssigmax/xysigma0*xyij
-        ssigmayi=ssigmay/xysigma0*xyij
-        rij=(x-xij)**2/ssigmaxi+(y-yij)**2/ssigmayi # normalized distance^2
-      else:
-        rij=(x-xij)**2/ssigmax+(y-yij)**2/ssigmay # normalized distance^2
-      take=where(rij<sigmas**2) # take points up to 3 sigma distance
+    for j in where(select[i])[0]:
+      rij=(x-Xout[i, j])**2/ssigmaxs[i, j]+(y-Yout[i, j])**2/ssigmays[i, j]
+      take=where(rij<sigmas**2)
       if len(take[0])==0:
         continue
       Pij=exp(-0.5*rij[take])
@@ -289,6 +397,100 @@ def smooth_data(settings, x, y, I, sigmas=3.,
       Iout[i, j]=(Pij*I[take]).sum()
   return Xout, Yout, Iout
 
+@log_input
+def gisans_slices(datasets, lmin, lmax, lsteps, grid=(51, 51), first=0, last=None):
+  '''
+  Project the intensity of GISANS datasets onto a Qy/Qz grid for several
+  wavelength slices. The histograms of all slices are calculated by one
+  bincount, using the same binning as histogram2d for each slice.
+
+  :param list datasets: GISANS objects to combine
+  :param float lmin: Lower wavelength limit of the first slice
+  :param float lmax: Upper wavelength limit of the last slice
+  :param int lsteps: Number of slices
+  :param tuple grid: Number of bins in Qy and Qz
+  :param int first: Index of the first slice to calculate
+  :param int last: Index after the last slice to calculate, defaults to lsteps
+  
+  :returns: list of (Isum, Qy, Qz, lmin, lmax, dIsum) for each calculated slice
+  '''
+  if last is None:
+    last=lsteps
+  lsize=(lmax-lmin)/lsteps
+  slice_min=array([lmin+i*lsize for i in range(first, last)])
+  slice_max=array([lmin+(i+1)*lsize for i in range(first, last)])
+  lsteps=len(slice_min)
+  nby, nbz=grid[0]+2, grid[1]+2 # including outlier bins as histogramdd
+  regions=[]
+  for data in datasets:
+    P0=len(data.lamda)-data.options['P0']
+    PN=data.options['PN']
+    lamda=data.lamda[PN:P0]
+    # points on the border between two slices are used for both
+    islice, region=where((lamda>=slice_min[:, newaxis])&(lamda<=slice_max[:, newaxis]))
+    borders=hstack([[0], bincount(islice, minlength=lsteps).cumsum()])
+    regions.append((region, borders))
+
+  # calculate the Q-range of each slice
+  qmin=zeros((2, lsteps))+inf
+  qmax=zeros((2, lsteps))-inf
+  for data, (region, borders) in zip(datasets, regions):
+    for i in range(lsteps):
+      if borders[i]==borders[i+1]:
+        continue
+      for j, Q in enumerate(data.get_Qyz(region[borders[i]:borders[i+1]])):
+        qmin[j, i]=min(qmin[j, i], Q.min())
+        qmax[j, i]=max(qmax[j, i], Q.max())
+  edges=[[], []]
+  for j, nb in enumerate(grid):
+    for i in range(lsteps):
+      if qmin[j, i]>qmax[j, i]:
+        # no points in this slice
+        qmin[j, i], qmax[j, i]=0., 1.
+      elif qmin[j, i]==qmax[j, i]:
+        qmin[j, i]-=0.5
+        qmax[j, i]+=0.5
+      edges[j].append(linspace(qmin[j, i], qmax[j, i], nb+1))
+
+  # histogram index of each point, the order of points within a slice is kept
+  # so the sums are the same as for separate histograms
+  index=[]
+  for data, (region, borders) in zip(datasets, regions):
+    dindex=zeros(data.S.shape[:2]+region.shape, dtype=int)
+    for i in range(lsteps):
+      if borders[i]==borders[i+1]:
+        continue
+      dindex[:, :, borders[i]:borders[i+1]]=i*nby*nbz
+      Qyz=data.get_Qyz(region[borders[i]:borders[i+1]])
+      for Q, qedges, scale in zip(Qyz, [edges[0][i], edges[1][i]], [nbz, 1]):
+        qindex=searchsorted(qedges, Q, side='right')
+        # points on the last edge belong to the last bin
+        qindex[Q==qedges[-1]]-=1
+        dindex[:, :, borders[i]:borders[i+1]]+=qindex*scale
+    index.append(dindex.flatten())
+  index=hstack(index)
+  I=hstack([data.S[:, :, region].flatten() for data, (region, ignore) in zip(datasets, regions)])
+  dI=hstack([data.dS[:, :, region].flatten() for data, (region, ignore) in zip(datasets, regions)])
+  shape=(lsteps, nby, nbz)
+  size=lsteps*nby*nbz
+  Isum=bincount(index, weights=I, minlength=size).astype(float).reshape(shape)[:, 1:-1, 1:-1]
+  dIsum=bincount(index, weights=dI**2, minlength=size).astype(float).reshape(shape)[:, 1:-1, 1:-1]
+  Npoints=bincount(index, minlength=size).astype(float).reshape(shape)[:, 1:-1, 1:-1]
+
+  output=[]
+  for i in range(lsteps):
+    Isumi=Isum[i].copy()
+    dIsumi=sqrt(dIsum[i])
+    Npointsi=Npoints[i]
+    Isumi[Npointsi>0]/=Npointsi[Npointsi>0]
+    dIsumi[Npointsi>0]/=Npointsi[Npointsi>0]
+    Qy, Qz=edges[0][i], edges[1][i]
+    Qy=(Qy[:-1]+Qy[1:])/2.
+    Qz=(Qz[:-1]+Qz[1:])/2.
+    Qz, Qy=meshgrid(Qz, Qy)
+    output.append((Isumi, Qy, Qz, slice_min[i], slice_max[i], dIsumi))
+  return output
+
 ######## helper functions ###############
 def _gauss_residuals(p, fjac=None, data=None, width=1):
   '''
@@ -7,9 +7,12 @@ such headers.
 
 import os
 import sys
+import shutil
+import tempfile
 import subprocess
 import numpy as np
 from logging import debug, info
+from multiprocessing import Pool, cpu_count
 from time import strftime
 from zipfile import ZipFile
 from cPickle import loads, dumps
@@ -31,6 +34,26 @@ for path in output_templates.gp_font_paths:
   if os.path.exists(path):
     GP_ENVIRONMENT.update({'GDFONTPATH': path})
 
+_SMOOTH_DATA=None
+
+def _smooth_init(channel_data):
+  '''
+  Store the data to be smoothed in the pool process.
+  '''
+  global _SMOOTH_DATA
+  _SMOOTH_DATA=channel_data
+
+def _smooth_tile(args):
+  '''
+  Smooth one tile of grid lines of a channel, executed in the pool process.
+  '''
+  settings, index, rows=args
+  x, y, I, axis_sigma_scaling, xysigma0=_SMOOTH_DATA[index]
+  ignore, ignore, Iout=smooth_data(settings, x, y, I, sigmas=settings['sigmas'],
+                                   axis_sigma_scaling=axis_sigma_scaling,
+                                   xysigma0=xysigma0, rows=rows)
+  return index, rows, Iout[rows[0]:rows[1]]
+
 class HeaderCreator(object):
   '''
   Class to create file headers from a set of Reflectivity objects.
@@ -558,7 +581,7 @@ class Exporter(object):
   but can also be helpful for scripts which export data.
   '''
 
-  def __init__(self, channels, refls, sample_length=10.):
+  def __init__(self, channels, refls, sample_length=10., preload=True):
     self.norms=[]
     for refli in refls:
       if refli.options['normalization'] not in self.norms:
@@ -569,53 +592,92 @@ class Exporter(object):
     for ref in self.refls:
       ref.options.update(self.additional_options)
     self.file_header=HeaderCreator(self.refls)
-    self.read_data()
+    self.raw_data={}
+    self.ipts_str=u''
+    self._set_indices()
+    if preload:
+      self.read_data()
     self.output_data={}
+    self.streamed_data={}
     self.exported_files_all=[]
     self.exported_files_data=[]
     self.exported_files_plots=[]
 
+  def _set_indices(self):
+    self.indices=[refli.options['number'] for refli in self.refls]
+    self.indices.sort()
+    self.ind_str="+".join(map(str, self.indices))
+
   @log_call
   def read_data(self):
     '''
     Read the raw data of all files. This means that for multiple
     extraction routines the data is only read once.
     '''
-    self.indices=[]
     self.raw_data={}
     for refli in self.refls:
-      if type(refli.origin) is list:
-        flist=[origin[0] for origin in refli.origin]
-        self.raw_data[refli.options['number']]=NXSMultiData(flist, **refli.read_options)
-        self.indices.append(refli.options['number'])
-      else:
-        self.raw_data[refli.options['number']]=NXSData(refli.origin[0], **refli.read_options)
-        self.indices.append(refli.options['number'])
-    self.indices.sort()
-    self.ind_str="+".join(map(str, self.indices))
-    self.ipts_str=self.raw_data.values()[0].experiment
+      self.raw_data[refli.options['number']]=self._read_file(refli)
+    self._set_indices()
+
+  def _read_file(self, refli, cache=True):
+    '''
+    Read the raw data of one reflectivity. If cache is False, files which
+    are not in the memory cache are read without adding them to it.
+    '''
+    if type(refli.origin) is list:
+      reader=NXSMultiData
+      origin=[item[0] for item in refli.origin]
+    else:
+      reader=NXSData
+      origin=refli.origin[0]
+    options=refli.read_options
+    if not cache and not reader.is_cached(origin, **options):
+      options=dict(options, use_caching=False)
+    fdata=reader(origin, **options)
+    if not self.ipts_str:
+      self.ipts_str=fdata.experiment
+    return fdata
+
+  def get_raw_data(self, refli, cache=True):
+    '''
+    Return the raw data of one reflectivity, which is read from file
+    if it has not been preloaded by read_data.
+    '''
+    index=refli.options['number']
+    if index in self.raw_data:
+      return self.raw_data[index]
+    return self._read_file(refli, cache)
 
   @log_call
   def extract_reflectivity(self):
     '''
     Extract the specular reflectivity for all datasets.
     '''
+    output_data=self._init_specular()
+    for refli in self.refls:
+      self._add_specular(output_data, self.get_raw_data(refli), refli.options)
+    self._store_specular(output_data)
+
+  def _init_specular(self):
     output_data=dict([(channel, []) for channel in self.channels])
     output_data['column_units']=[u'Å⁻¹', 'a.u.', 'a.u.', u'Å⁻¹', 'rad']
     output_data['column_names']=['Qz', 'R', 'dR', 'dQz', u'αi']
+    return output_data
 
-    for refli in self.refls:
-      opts=refli.options
-      index=opts['number']
-      fdata=self.raw_data[index]
-      for channel in self.channels:
-        res=Reflectivity(fdata[channel], **opts)
-        Qz, R, dR, dQz=res.Q, res.R, res.dR, res.dQ
-        P0=len(Qz)-opts['P0']
-        PN=opts['PN']
-        rdata=np.vstack([Qz[PN:P0], R[PN:P0], dR[PN:P0], dQz[PN:P0],
-                      0.*Qz[PN:P0]+res.ai]).transpose()
-        output_data[channel].append(rdata)
+  def _add_specular(self, output_data, fdata, opts):
+    '''
+    Extract the specular reflectivity of all channels of one dataset.
+    '''
+    results=Reflectivity.from_channels(fdata, channels=self.channels, **opts)
+    for channel, res in zip(self.channels, results):
+      Qz, R, dR, dQz=res.Q, res.R, res.dR, res.dQ
+      P0=len(Qz)-opts['P0']
+      PN=opts['PN']
+      rdata=np.vstack([Qz[PN:P0], R[PN:P0], dR[PN:P0], dQz[PN:P0],
+                    0.*Qz[PN:P0]+res.ai]).transpose()
+      output_data[channel].append(rdata)
+
+  def _store_specular(self, output_data):
     for channel in self.channels:
       d=np.vstack(output_data[channel])
       # sort dataset for Qz
@@ -637,21 +699,11 @@ class Exporter(object):
 
     ki_max=0.01
     for refli in self.refls:
-      opts=refli.options
-      index=opts['number']
-      fdata=self.raw_data[index]
-      P0=len(fdata[0].tof)-opts['P0']
-      PN=opts['PN']
+      fdata=self.get_raw_data(refli)
       for channel in self.channels:
-        offspec=OffSpecular(fdata[channel], **opts)
-        Qx, Qz, ki_z, kf_z, S, dS=(offspec.Qx, offspec.Qz, offspec.ki_z, offspec.kf_z,
-                                   offspec.S, offspec.dS)
-
-        rdata=np.array([Qx[:, PN:P0], Qz[:, PN:P0], ki_z[:, PN:P0], kf_z[:, PN:P0],
-                      ki_z[:, PN:P0]-kf_z[:, PN:P0], S[:, PN:P0], dS[:, PN:P0]],
-                    copy=False).transpose((1, 2, 0))
+        rdata, ki_maxi=self._offspec_map(fdata, channel, refli.options)
         output_data[channel].append(rdata)
-        ki_max=max(ki_max, ki_z.max())
+        ki_max=max(ki_max, ki_maxi)
     output_data['ki_max']=ki_max
     self.output_data['OffSpec']=output_data
 
@@ -665,6 +717,21 @@ class Exporter(object):
     output_data['column_units']=[u'Å⁻¹', u'Å⁻¹', u'Å⁻¹', u'Å⁻¹', u'Å⁻¹', 'a.u.', 'a.u.']
     output_data['column_names']=['Qx', 'Qz', 'ki_z', 'kf_z', 'ki_z-kf_z', 'I', 'dI']
 
+    corrector=self._get_tail_corrector()
+    ki_max=0.01
+    for refli in self.refls:
+      fdata=self.get_raw_data(refli)
+      for channel in self.channels:
+        rdata, ki_maxi=self._offspec_map(fdata, channel, refli.options, corrector)
+        output_data[channel].append(rdata)
+        ki_max=max(ki_max, ki_maxi)
+    output_data['ki_max']=ki_max
+    self.output_data['OffSpecCorr']=output_data
+
+  def _get_tail_corrector(self):
+    '''
+    Create the detector tail correction from the first normalization.
+    '''
     corr_ds=self.norms[0]
     if type(corr_ds.origin) is list:
       flist=[origin[0] for origin in corr_ds.origin]
@@ -672,34 +739,150 @@ class Exporter(object):
     else:
       corr_data=NXSData(corr_ds.origin[0], **corr_ds.read_options)[0]
     debug('Correction from normalization '+repr(corr_data))
-    corrector=DetectorTailCorrector(corr_data.xdata, x0=corr_ds.options['x_pos'])
+    return DetectorTailCorrector(corr_data.xdata, x0=corr_ds.options['x_pos'])
 
+  def _offspec_map(self, fdata, channel, opts, corrector=None):
+    '''
+    Calculate the off-specular map of one channel as x×ToF×7 array.
+
+    :returns: map and maximum ki_z
+    '''
+    P0=len(fdata[0].tof)-opts['P0']
+    PN=opts['PN']
+    offspec=OffSpecular(fdata[channel], **opts)
+    Qx, Qz, ki_z, kf_z, S, dS=(offspec.Qx, offspec.Qz, offspec.ki_z, offspec.kf_z,
+                               offspec.S, offspec.dS)
+    if corrector is not None:
+      debug('sum(S) before '+repr(S.sum()))
+      S=corrector(S)
+      debug('sum(S) after '+repr(S.sum()))
+    rdata=np.array([Qx[:, PN:P0], Qz[:, PN:P0], ki_z[:, PN:P0], kf_z[:, PN:P0],
+                  ki_z[:, PN:P0]-kf_z[:, PN:P0], S[:, PN:P0], dS[:, PN:P0]],
+                copy=False).transpose((1, 2, 0))
+    return rdata, ki_z.max()
+
+  @log_call
+  def stream_offspecular(self, directory=paths.results,
+                         naming=paths.export_name,
+                         multi_ascii=True,
+                         combined_ascii=False,
+                         corrected=False,
+                         check_exists=lambda ignore: True,
+                         specular=False,
+                         ):
+    '''
+    Extract the off-specular scattering and write it to ASCII files one
+    dataset at a time, without keeping the maps or the raw data in memory.
+    The files are the same as for extract_offspecular/extract_offspecular_corr
+    followed by export_data. Only a summary needed for the gnuplot scripts
+    is stored in streamed_data.
+    If specular is True, the specular reflectivity is extracted from the same
+    readout as with extract_reflectivity.
+    '''
+    if corrected:
+      key='OffSpecCorr'
+      corrector=self._get_tail_corrector()
+    else:
+      key='OffSpec'
+      corrector=None
+    column_units=[u'Å⁻¹', u'Å⁻¹', u'Å⁻¹', u'Å⁻¹', u'Å⁻¹', 'a.u.', 'a.u.']
+    column_names=['Qx', 'Qz', 'ki_z', 'kf_z', 'ki_z-kf_z', 'I', 'dI']
+    ofname=os.path.join(directory, naming)
+    data_comment=self.file_header.get_data_comment(column_names, column_units).encode('utf8')
+    multi_files={}
+    if multi_ascii:
+      for channel in self.channels:
+        output=ofname.replace('{item}', key).replace('{state}', channel)\
+                     .replace('{instrument}', instrument.NAME)\
+                     .replace('{type}', 'dat').replace('{numbers}', self.ind_str)
+        if not check_exists(output):
+          continue
+        of=open(output, 'wb')
+        of.write((self.file_header.as_comments()%{
+                              'datatype': key,
+                              'indices': self.ind_str,
+                              'states': channel,
+                              }).encode('utf8'))
+        of.write(data_comment)
+        multi_files[channel]=(output, of)
+    combined_output=None
+    if combined_ascii:
+      combined_output=ofname.replace('{item}', key).replace('{state}', 'all')\
+                   .replace('{instrument}', instrument.NAME)\
+                   .replace('{type}', 'dat').replace('{numbers}', self.ind_str)
+      if check_exists(combined_output):
+        # the channels are written one after another, so the data is
+        # collected in temporary files until all datasets are processed
+        combined_files=dict([(channel, tempfile.TemporaryFile(dir=directory))
+                             for channel in self.channels])
+      else:
+        combined_output=None
+
+    if specular:
+      specular_data=self._init_specular()
     ki_max=0.01
+    z_range=[np.inf, -np.inf]
     for refli in self.refls:
-      opts=refli.options
-      index=opts['number']
-      fdata=self.raw_data[index]
-      P0=len(fdata[0].tof)-opts['P0']
-      PN=opts['PN']
+      # files not in the cache are not added to it, so they can be released
+      fdata=self.get_raw_data(refli, cache=False)
+      if specular:
+        self._add_specular(specular_data, fdata, refli.options)
       for channel in self.channels:
-        offspec=OffSpecular(fdata[channel], **opts)
-        Qx, Qz, ki_z, kf_z, S, dS=(offspec.Qx, offspec.Qz, offspec.ki_z, offspec.kf_z,
-                                   offspec.S, offspec.dS)
-        debug('sum(S) before '+repr(S.sum()))
-        S=corrector(S)
-        debug('sum(S) after '+repr(S.sum()))
-        rdata=np.array([Qx[:, PN:P0], Qz[:, PN:P0], ki_z[:, PN:P0], kf_z[:, PN:P0],
-                      ki_z[:, PN:P0]-kf_z[:, PN:P0], S[:, PN:P0], dS[:, PN:P0]],
-                    copy=False).transpose((1, 2, 0))
-        output_data[channel].append(rdata)
-        ki_max=max(ki_max, ki_z.max())
-    output_data['ki_max']=ki_max
-    self.output_data['OffSpecCorr']=output_data
+        rdata, ki_maxi=self._offspec_map(fdata, channel, refli.options, corrector)
+        ki_max=max(ki_max, ki_maxi)
+        z=rdata[:, :, 5]
+        z_range[1]=max(z_range[1], z.max())
+        if (z>0).any():
+          z_range[0]=min(z_range[0], z[z>0].min())
+        if channel in multi_files:
+          self._write_map(multi_files[channel][1], rdata)
+        if combined_output is not None:
+          self._write_map(combined_files[channel], rdata)
+        del(rdata)
+      # release the file before the next one is read
+      del(fdata)
+    if specular:
+      self._store_specular(specular_data)
+
+    for channel in self.channels:
+      if channel in multi_files:
+        output, of=multi_files[channel]
+        of.write(u'\n\n'.encode('utf8'))
+        of.close()
+        self.exported_files_all.append(output);self.exported_files_data.append(output)
+    if combined_output is not None:
+      of=open(combined_output, 'wb')
+      of.write((self.file_header.as_comments()%{
+                            'datatype': key,
+                            'indices': self.ind_str,
+                            'states': u", ".join(self.channels),
+                            }).encode('utf8'))
+      for channel in self.channels:
+        of.write((u'# Start of channel %s\n'%channel).encode('utf8'))
+        of.write(data_comment)
+        tmp=combined_files[channel]
+        tmp.write(u'\n\n'.encode('utf8'))
+        tmp.seek(0)
+        shutil.copyfileobj(tmp, of)
+        tmp.close()
+        of.write((u'# End of channel %s\n\n\n'%channel).encode('utf8'))
+      of.close()
+      self.exported_files_all.append(combined_output);self.exported_files_data.append(combined_output)
+    # channel items are empty as the maps have not been kept
+    summary=dict([(channel, []) for channel in self.channels])
+    summary.update(dict(column_units=column_units, column_names=column_names,
+                        ki_max=ki_max, z_range=z_range))
+    self.streamed_data[key]=summary
 
   @log_call
-  def smooth_offspec(self, settings, pb=None):
+  def smooth_offspec(self, settings, pb=None, processes=1):
     '''
     Create a smoothed dataset from the offspecular scattering.
+    
+    :param dict settings: Smoothing options, see qcalc.smooth_data
+    :param pb: Progress dialog to show the progress of the calculation
+    :param int processes: Number of parallel processes to use for smoothing,
+                          None uses one for each CPU
     '''
     output_data={}
     pbinfo="Smoothing Channel "
@@ -707,10 +890,8 @@ class Exporter(object):
       odata=self.output_data['OffSpecCorr']
     else:
       odata=self.output_data['OffSpec']
-    for i, channel in enumerate(self.channels):
-      if pb is not None:
-        pb.info.setText(pbinfo+channel)
-        pb.add=100*i
+    channel_data=[]
+    for channel in self.channels:
       data=np.hstack(odata[channel])
       I=data[:, :, 5].flatten()
       Qzmax=data[:, :, 2].max()*2.
@@ -735,12 +916,56 @@ class Exporter(object):
         output_data['column_names']=['ki_z', 'kf_z', 'I']
         axis_sigma_scaling=3
         xysigma0=Qzmax/6.
-      x, y, I=smooth_data(settings, x, y, I, callback=(pb and pb.progress), sigmas=settings['sigmas'],
-                          axis_sigma_scaling=axis_sigma_scaling, xysigma0=xysigma0)
-      output_data[channel]=[np.array([x, y, I]).transpose((1, 2, 0))]
+      channel_data.append((x, y, I, axis_sigma_scaling, xysigma0))
+    if processes==1:
+      for i, channel in enumerate(self.channels):
+        if pb is not None:
+          pb.info.setText(pbinfo+channel)
+          pb.add=100*i
+        x, y, I, axis_sigma_scaling, xysigma0=channel_data[i]
+        x, y, I=smooth_data(settings, x, y, I, callback=(pb and pb.progress), sigmas=settings['sigmas'],
+                            axis_sigma_scaling=axis_sigma_scaling, xysigma0=xysigma0)
+        output_data[channel]=[np.array([x, y, I]).transpose((1, 2, 0))]
+    else:
+      if pb is not None:
+        pb.info.setText(pbinfo+', '.join(self.channels))
+        pb.add=0
+      results=self._smooth_parallel(settings, channel_data, processes, pb)
+      for channel, result in zip(self.channels, results):
+        output_data[channel]=[np.array(result).transpose((1, 2, 0))]
     output_data['ki_max']=self.output_data['OffSpec']['ki_max']
     self.output_data['OffSpecSmooth']=output_data
 
+  def _smooth_parallel(self, settings, channel_data, processes, pb=None):
+    '''
+    Smooth the data of all channels in a process pool, splitting
+    the output grid of each channel into tiles of grid lines.
+    '''
+    gridx, gridy=settings['grid']
+    if processes is None:
+      processes=cpu_count()
+    # about two tiles for each process, so processes finishing early get more work
+    ntiles=max(1, min(gridy, (2*processes)//len(channel_data)+1))
+    tiles=[(gridy*k)//ntiles for k in range(ntiles+1)]
+    tasks=[(settings, index, (tiles[k], tiles[k+1]))
+           for index in range(len(channel_data)) for k in range(ntiles)]
+    x1, x2, y1, y2=settings['region']
+    Xout, Yout=np.meshgrid(np.linspace(x1, x2, gridx), np.linspace(y1, y2, gridy))
+    results=[[Xout, Yout, np.zeros_like(Xout)] for ignore in channel_data]
+    pool=Pool(processes, initializer=_smooth_init, initargs=(channel_data,))
+    try:
+      done=0
+      for index, rows, Itile in pool.imap_unordered(_smooth_tile, tasks):
+        results[index][2][rows[0]:rows[1]]=Itile
+        done+=rows[1]-rows[0]
+        if pb is not None:
+          # progress of all channels combined, 1 for each channel finished
+          pb.progress(float(done)/gridy)
+    finally:
+      pool.close()
+      pool.join()
+    return results
+
   @log_call
   def export_data(self, directory=paths.results,
                   naming=paths.export_name,
@@ -775,15 +1000,7 @@ class Exporter(object):
                                                      output_data['column_units'])
                     ).encode('utf8'))
           # write the data
-          if type(value) is not list:
-            np.savetxt(of, value, delimiter='\t', fmt='%-18e')
-          else:
-            for filemap in value:
-              # separate first dimension steps by empty line
-              for scan in filemap:
-                np.savetxt(of, scan, delimiter='\t', fmt='%-18e')
-                of.write(u'\n'.encode('utf8'))
-            of.write(u'\n\n'.encode('utf8'))
+          self._write_value(of, value)
           of.close()
           self.exported_files_all.append(output);self.exported_files_data.append(output)
       if combined_ascii:
@@ -805,16 +1022,7 @@ class Exporter(object):
             of.write((self.file_header.get_data_comment(output_data['column_names'],
                                                        output_data['column_units'])
                       ).encode('utf8'))
-            value=output_data[channel]
-            if type(value) is not list:
-              np.savetxt(of, value, delimiter='\t', fmt='%-18e')
-            else:
-              for filemap in value:
-                # separate first dimension steps by empty line
-                for scan in filemap:
-                  np.savetxt(of, scan, delimiter='\t', fmt='%-18e')
-                  of.write(u'\n'.encode('utf8'))
-              of.write(u'\n\n'.encode('utf8'))
+            self._write_value(of, output_data[channel])
             of.write((u'# End of channel %s\n\n\n'%channel).encode('utf8'))
           of.close()
           self.exported_files_all.append(output);self.exported_files_data.append(output)
@@ -842,6 +1050,25 @@ class Exporter(object):
         np.savez(output, **dictdata)
         self.exported_files_all.append(output);self.exported_files_data.append(output)
 
+  @staticmethod
+  def _write_value(of, value):
+    '''
+    Write the data of one channel to an open ASCII file.
+    '''
+    if type(value) is not list:
+      np.savetxt(of, value, delimiter='\t', fmt='%-18e')
+    else:
+      for filemap in value:
+        Exporter._write_map(of, filemap)
+      of.write(u'\n\n'.encode('utf8'))
+
+  @staticmethod
+  def _write_map(of, filemap):
+    # separate first dimension steps by empty line
+    for scan in filemap:
+      np.savetxt(of, scan, delimiter='\t', fmt='%-18e')
+      of.write(u'\n'.encode('utf8'))
+
   def dictize_data(self, output_data):
     '''
     Create a dictionary for export of data for e.g. Matlab files.
@@ -866,7 +1093,7 @@ class Exporter(object):
     '''
     Create gnuplot scripts in images for all exported datasets.
     '''
-    for title, output_data in self.output_data.items():
+    for title, output_data in self.output_data.items()+self.streamed_data.items():
         self._create_gnuplot_script(output_data, title, directory, naming, check_exists)
 
   def replace_gp(self, text):
@@ -957,11 +1184,16 @@ class Exporter(object):
           params['pix_x']=1400*cols
       zmax=1e-6
       zmin=1e6
-      for channel in self.channels:
-        for data in output_data[channel]:
-          z=data[:, :, line_params['z']-1]
-          zmax=max(zmax, z.max())
-          zmin=min(zmin, z[z>0].min())
+      if 'z_range' in output_data:
+        # streamed data is not kept in memory
+        zmax=max(zmax, output_data['z_range'][1])
+        zmin=min(zmin, output_data['z_range'][0])
+      else:
+        for channel in self.channels:
+          for data in output_data[channel]:
+            z=data[:, :, line_params['z']-1]
+            zmax=max(zmax, z.max())
+            zmin=min(zmin, z[z>0].min())
       params['zmin']="%.1e"%(zmin*0.8)
       params['zmax']="%.1e"%zmax
       plotlines=''
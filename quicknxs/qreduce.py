@@ -17,12 +17,19 @@ storing the result as well as some intermediate data in itself as attributes.
 import os
 import zlib
 import h5py
+import json
 import base64
+import hashlib
+import tempfile
+from collections import OrderedDict
 from copy import deepcopy
 from glob import glob
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from numpy import *
 from numpy.version import version as npversion
 from platform import node
+from threading import Lock
 from time import time, strptime, mktime
 from xml.dom import minidom
 # ignore zero devision error
@@ -85,10 +92,45 @@ MAPPING_EFIELD=(
 
 # don't save RAM by compression when on analysis cluster or mrac computer as they have plenty
 USE_COMPRESSION=not ('biganalysis' in node() or 'mrac' in node())
+COMPRESSION_BLOCK=16 # number of x-pixels compressed together, each block contains full ToF spectra
+MAX_DECOMPRESSED=4 # number of datasets kept decompressed for better GUI response
+MAX_SUMMED_AREA=4 # number of datasets for which summed-area tables are kept for fast region sums
+MAX_BG_MASKS=16 # number of polygon background masks kept for reuse
+MAX_GISANS_CHUNK=2**22 # number of points for which Q is calculated at once in lean GISANS mode
+
+# available compression backends as (compress, decompress) functions, zlib is always available
+def _zlib_compress(data):
+  return zlib.compress(data.tostring(), 1)
+def _zlib_decompress(string, dtype):
+  return fromstring(zlib.decompress(string), dtype=dtype)
+COMPRESSORS={'zlib': (_zlib_compress, _zlib_decompress)}
+try:
+  import blosc
+except ImportError:
+  pass
+else:
+  def _blosc_compress(data):
+    return blosc.compress(data.tostring(), typesize=data.dtype.itemsize,
+                          clevel=5, shuffle=blosc.SHUFFLE, cname='lz4')
+  def _blosc_decompress(string, dtype):
+    return fromstring(blosc.decompress(string), dtype=dtype)
+  COMPRESSORS['blosc']=(_blosc_compress, _blosc_decompress)
+try:
+  import lz4.block
+except ImportError:
+  pass
+else:
+  def _lz4_compress(data):
+    return lz4.block.compress(data.tostring())
+  def _lz4_decompress(string, dtype):
+    return fromstring(lz4.block.decompress(string), dtype=dtype)
+  COMPRESSORS['lz4']=(_lz4_compress, _lz4_decompress)
+# use the fastest backend available
+COMPRESSOR=[name for name in ['blosc', 'lz4', 'zlib'] if name in COMPRESSORS][0]
 
 # used for * imports
 __all__=['NXSData', 'MRDataset', 'Reflectivity', 'OffSpecular', 'GISANS', 'time_from_header',
-         'locate_file']
+         'locate_file', 'create_sensitivity', 'save_sensitivity', 'load_sensitivity']
 
 _bincount=bincount
 def bincount(x, weights=None, minlength=None):
@@ -105,6 +147,67 @@ def bincount(x, weights=None, minlength=None):
   else:
     return _bincount(x, weights, minlength)
 
+def _cache_encode(value, arrays):
+  '''
+  Convert a value to JSON types for the on-disk cache. Arrays and long byte strings
+  are stored in the arrays dictionary and referenced by name.
+  '''
+  if isinstance(value, ndarray):
+    if value.dtype.hasobject:
+      raise TypeError, 'Object arrays can not be stored in the disk cache'
+    name='array%i'%len(arrays)
+    arrays[name]=value
+    return {'__array__': name}
+  elif isinstance(value, generic):
+    return {'__scalar__': value.dtype.str, 'value': _cache_encode(value.item(), arrays)}
+  elif isinstance(value, dtype):
+    return {'__dtype__': value.str}
+  elif isinstance(value, str):
+    if len(value)>1024:
+      name='array%i'%len(arrays)
+      arrays[name]=fromstring(value, dtype=uint8)
+      return {'__bytes__': name}
+    return {'__str__': value.decode('latin-1')}
+  elif isinstance(value, tuple):
+    return {'__tuple__': [_cache_encode(item, arrays) for item in value]}
+  elif isinstance(value, list):
+    return [_cache_encode(item, arrays) for item in value]
+  elif isinstance(value, dict):
+    return {'__dict__': [[_cache_encode(key, arrays), _cache_encode(item, arrays)]
+                         for key, item in value.items()],
+            'nice': isinstance(value, NiceDict)}
+  elif value is None or isinstance(value, (bool, int, long, float, unicode)):
+    return value
+  raise TypeError, 'Type %s can not be stored in the disk cache'%type(value).__name__
+
+def _cache_decode(value, arrays):
+  '''
+  Restore a value stored with _cache_encode.
+  '''
+  if isinstance(value, list):
+    return [_cache_decode(item, arrays) for item in value]
+  elif not isinstance(value, dict):
+    return value
+  elif '__array__' in value:
+    return arrays[value['__array__']]
+  elif '__scalar__' in value:
+    return dtype(str(value['__scalar__'])).type(_cache_decode(value['value'], arrays))
+  elif '__dtype__' in value:
+    return dtype(str(value['__dtype__']))
+  elif '__bytes__' in value:
+    return arrays[value['__bytes__']].tostring()
+  elif '__str__' in value:
+    return value['__str__'].encode('latin-1')
+  elif '__tuple__' in value:
+    return tuple([_cache_decode(item, arrays) for item in value['__tuple__']])
+  elif '__dict__' in value:
+    output=[(_cache_decode(key, arrays), _cache_decode(item, arrays))
+            for key, item in value['__dict__']]
+    if value['nice']:
+      return NiceDict(output)
+    return dict(output)
+  raise ValueError, 'Unknown item in disk cache header'
+
 class OptionsDocMeta(type):
   '''
   Metaclass to update docstring to dynamically include keyword arguments
@@ -172,19 +275,33 @@ class NXSData(object):
 
   DEFAULT_OPTIONS=dict(bin_type=0, bins=40, use_caching=True, callback=None,
                        event_split_bins=None, event_split_index=0,
-                       event_tof_overwrite=None)
+                       event_tof_overwrite=None, event_chunk_size=None,
+                       channel_pool=None, disk_cache=None, lazy_histogram=False,
+                       header_only=False)
   _OPTIONS_DESCRTIPTION=dict(
     bin_type="linear in ToF'/'1: linear in Q' - use linear or 1/x spacing for ToF channels in event mode",
     bins='Number of ToF bins for event mode',
-    use_caching='If files should be cached for faster future readouts (last 20 files)',
+    use_caching='If files should be cached in memory for faster future readouts (see MAX_CACHE and MAX_CACHE_BYTES)',
     event_split_bins='Number of items, to split the events in time or None for no splitting',
     event_split_index='Index of the splitted item to be returned, when event_split_bin is not None',
     event_tof_overwrite='Optional array of ToF edges to be used instead of the ones created from bins and bin_type',
+    event_chunk_size='Number of events read and binned at once in event mode to limit the memory usage, None reads all events',
+    channel_pool="'thread' or 'process' to read the channels of a file in parallel, None reads them one after another",
+    disk_cache='Directory used to store binned datasets for fast readout in later sessions, None disables the on-disk cache',
+    lazy_histogram='Only read the data regions needed for a reduction from histogram files, when they are used',
+    header_only='Only read the header information, ToF channels and the stored X-Y projection without any 3D data',
     callback='Function called to update e.g. a progress bar',
     )
   COUNT_THREASHOLD=0.01 #: Relative number of counts needed for a state to be interpreted as actual data
   MAX_CACHE=100 #: Number of datasets that are kept in the cache
-  _cache=[]
+  MAX_CACHE_BYTES=2*1024**3 #: Maximum memory used by the datasets in the cache in bytes
+  MAX_DISK_CACHE=10*1024**3 #: Maximum size of the on-disk cache directory in bytes
+  # least recently used cache of (object, nbytes) with (origin, frozen options) as keys
+  _cache=OrderedDict()
+  _cache_stats=dict(hits=0, misses=0, evictions=0, nbytes=0)
+  # options that don't change the resulting data and are ignored for caching
+  _CACHE_IGNORE_OPTIONS=['callback', 'use_caching', 'disk_cache', 'event_chunk_size', 'channel_pool',
+                         'lazy_histogram']
 
   @log_both
   def __new__(cls, filename, **options):
@@ -197,13 +314,15 @@ class NXSData(object):
       return XMLData(filename, **options)
     all_options=cls._get_all_options(options)
     filename=os.path.abspath(filename)
-    cached_names=[item.origin for item in cls._cache]
-    if all_options['use_caching'] and filename in cached_names:
-      cache_index=cached_names.index(filename)
-      cached_object=cls._cache[cache_index]
-      compare_options=dict(all_options)
-      compare_options['callback']=None
-      if cached_object._options==compare_options:
+    if all_options['use_caching']:
+      cached_object=cls._get_cached(filename, all_options)
+      if cached_object is not None:
+        return cached_object
+    if all_options['disk_cache']:
+      cached_object=cls._get_disk_cached(filename, all_options)
+      if cached_object is not None:
+        if all_options['use_caching']:
+          cls._add_cached(cached_object)
         return cached_object
     # else
     self=object.__new__(cls)
@@ -220,17 +339,390 @@ class NXSData(object):
     if not self._read_file(filename):
       return None
     if all_options['use_caching']:
-      if filename in cached_names:
-        cache_index=cached_names.index(filename)
-        cls._cache.pop(cache_index)
-      # make sure cache does not get bigger than MAX_CACHE items or 80% of available memory
-      while len(cls._cache)>=cls.MAX_CACHE:
-        cls._cache.pop(0)
-      cls._cache.append(self)
+      cls._add_cached(self)
     # remove callback function to make the object Pickleable
     self._options['callback']=None
+    if all_options['disk_cache']:
+      cls._add_disk_cached(self)
     return self
 
+  @classmethod
+  def read_split(cls, filename, split_indices=None, **options):
+    '''
+    Read the events of a file only once and create the objects for several
+    time slices, each identical to the result of reading the file with the
+    according event_split_index option. Slices already in the cache
+    are not read again and newly read slices are added to the cache.
+    
+    :param str filename: Path to the event mode file or run number
+    :param list split_indices: Indices of the slices to return, None for all slices
+    
+    :returns: list of objects corresponding to split_indices, None for slices that could not be read
+    '''
+    if type(filename) is int:
+      fn=locate_file(filename, histogram=False)
+      if fn is None:
+        raise RuntimeError, 'No file found for index %i'%filename
+      filename=fn
+    all_options=cls._get_all_options(options)
+    if not all_options['event_split_bins']:
+      raise ValueError, 'event_split_bins needs to be set to read time slices'
+    if not filename.endswith('event.nxs'):
+      raise ValueError, 'Time slices can only be read from event mode files'
+    filename=os.path.abspath(filename)
+    if split_indices is None:
+      split_indices=range(all_options['event_split_bins'])
+    output={}
+    read_indices=[]
+    for split_index in split_indices:
+      slice_options=dict(all_options)
+      slice_options['event_split_index']=split_index
+      cached_object=None
+      if all_options['use_caching']:
+        cached_object=cls._get_cached(filename, slice_options)
+      if cached_object is None and all_options['disk_cache']:
+        cached_object=cls._get_disk_cached(filename, slice_options)
+        if cached_object is not None and all_options['use_caching']:
+          cls._add_cached(cached_object)
+      if cached_object is not None:
+        output[split_index]=cached_object
+      elif split_index not in read_indices:
+        read_indices.append(split_index)
+    if read_indices:
+      output.update(cls._read_split_file(filename, read_indices, all_options))
+    return [output.get(split_index, None) for split_index in split_indices]
+
+  @classmethod
+  def _read_split_file(cls, filename, split_indices, all_options):
+    '''
+    Load the time slices of an event mode file.
+    
+    :returns: dictionary of split index and object for each slice that could be read
+    '''
+    start=time()
+    callback=all_options['callback']
+    if callback:
+      callback(0.)
+    objects={}
+    for split_index in split_indices:
+      self=object.__new__(cls)
+      self._options=dict(all_options)
+      self._options['event_split_index']=split_index
+      self._channel_names=[]
+      self._channel_origin=[]
+      self._channel_data=[]
+      self.measurement_type=""
+      self.origin=filename
+      self._read_times=[]
+      objects[split_index]=self
+    first=objects[split_indices[0]]
+    file_info=first._open_channels(filename)
+    if file_info is None:
+      return {}
+    nxs, channels, mapping, is_ancient=file_info
+    # get runtime for event mode splitting
+    total_duration=time_from_header('', nxs=nxs)
+
+    progress=0.1
+    if callback:
+      callback(progress)
+    i=1
+    empty_channels=dict([(split_index, []) for split_index in split_indices])
+    for dest, channel in mapping:
+      if channel not in channels:
+        continue
+      datasets=MRDataset.from_event_split(nxs[channel], all_options, split_indices,
+                                          callback=callback,
+                                          callback_offset=progress,
+                                          callback_scaling=0.9/len(channels),
+                                          tof_overwrite=all_options['event_tof_overwrite'],
+                                          total_duration=total_duration)
+      for split_index, data in zip(split_indices, datasets):
+        if data is None:
+          # no data in channel for this slice, don't add it
+          empty_channels[split_index].append(dest)
+          continue
+        self=objects[split_index]
+        data.read_options=self._options
+        self._channel_data.append(data)
+        self._channel_names.append(dest)
+        self._channel_origin.append(channel)
+      progress=0.1+0.9*float(i)/len(channels)
+      if callback:
+        callback(progress)
+      i+=1
+    if not is_ancient:
+      nxs.close()
+    for split_index in split_indices:
+      self=objects[split_index]
+      self.measurement_type=first.measurement_type
+      self._read_times.append(time()-start)
+      if empty_channels[split_index]:
+        warn('No counts for state %s in time slice %i'%(','.join(empty_channels[split_index]),
+                                                       split_index))
+      if all_options['use_caching']:
+        cls._add_cached(self)
+      # remove callback function to make the object Pickleable
+      self._options['callback']=None
+      if all_options['disk_cache']:
+        cls._add_disk_cached(self)
+    return objects
+
+  @classmethod
+  def _freeze_options(cls, all_options):
+    '''
+    Return a hashable representation of the options that change the data read from a file.
+    '''
+    frozen_options=[]
+    for key, value in sorted(all_options.items()):
+      if key in cls._CACHE_IGNORE_OPTIONS:
+        continue
+      if isinstance(value, ndarray):
+        value=(value.dtype.str, value.shape, hashlib.sha1(value.tostring()).hexdigest())
+      frozen_options.append((key, value))
+    return tuple(frozen_options)
+
+  @classmethod
+  def _cache_key(cls, origin, all_options):
+    if type(origin) is list:
+      origin=tuple(origin)
+    return (origin, cls._freeze_options(all_options))
+
+  @classmethod
+  def _get_cached(cls, origin, all_options):
+    '''
+    Return the cached object read from origin with the same options or None.
+    '''
+    key=cls._cache_key(origin, all_options)
+    try:
+      item=cls._cache.pop(key)
+    except KeyError:
+      cls._cache_stats['misses']+=1
+      return None
+    # reinsert as most recently used item
+    cls._cache[key]=item
+    cls._cache_stats['hits']+=1
+    # the object may have grown since it was added
+    cls._update_cache_sizes()
+    while len(cls._cache)>1 and cls._cache_stats['nbytes']>cls.MAX_CACHE_BYTES:
+      cls._evict_cached()
+    return item[0]
+
+  @classmethod
+  def _evict_cached(cls):
+    '''
+    Remove the least recently used item from the cache and close its files.
+    '''
+    obj, nbytes=cls._cache.popitem(last=False)[1]
+    obj.close()
+    cls._cache_stats['nbytes']-=nbytes
+    cls._cache_stats['evictions']+=1
+
+  @classmethod
+  def _update_cache_sizes(cls):
+    '''
+    Update the memory used by the cached objects, which grows when projections
+    are calculated or data is set after they were added.
+    '''
+    total=0
+    for key, (obj, ignore) in cls._cache.items():
+      nbytes=obj.nbytes
+      cls._cache[key]=(obj, nbytes)
+      total+=nbytes
+    cls._cache_stats['nbytes']=total
+
+  @classmethod
+  def _add_cached(cls, obj):
+    '''
+    Add an object to the cache, replacing any item from the same file
+    read with the same options. The least recently used items are removed
+    to keep the cache below MAX_CACHE items and MAX_CACHE_BYTES of memory.
+    '''
+    key=cls._cache_key(obj.origin, obj._options)
+    if key in cls._cache:
+      del cls._cache[key]
+    cls._update_cache_sizes()
+    nbytes=obj.nbytes
+    if nbytes>cls.MAX_CACHE_BYTES:
+      debug('Dataset too large for the cache: %i bytes'%nbytes)
+      return
+    while len(cls._cache)>0 and (len(cls._cache)>=cls.MAX_CACHE or
+                                 (cls._cache_stats['nbytes']+nbytes)>cls.MAX_CACHE_BYTES):
+      cls._evict_cached()
+    cls._cache[key]=(obj, nbytes)
+    cls._cache_stats['nbytes']+=nbytes
+
+  @classmethod
+  def clear_cache(cls):
+    '''
+    Remove all datasets from the cache and reset the statistics.
+    '''
+    for obj, ignore in cls._cache.values():
+      obj.close()
+    cls._cache.clear()
+    cls._cache_stats.update(hits=0, misses=0, evictions=0, nbytes=0)
+
+  @classmethod
+  def is_cached(cls, filename, **options):
+    '''
+    Check if a file, or a list of files for NXSMultiData, read with the given options
+    is in the memory cache, without changing the cache statistics.
+    '''
+    if type(filename) is list:
+      origin=sorted(filename)
+    else:
+      origin=os.path.abspath(filename)
+    return cls._cache_key(origin, cls._get_all_options(options)) in cls._cache
+
+  @classmethod
+  def get_cache_stats(cls):
+    '''
+    Return the number of cache hits, misses and evicted items as well
+    as the number of items and memory used by the cache.
+    '''
+    cls._update_cache_sizes()
+    stats=dict(cls._cache_stats)
+    stats['items']=len(cls._cache)
+    return stats
+
+  @classmethod
+  def _disk_cache_key(cls, filename, all_options):
+    '''
+    Create a unique key for a file and read options, which changes
+    when the file gets modified. Returns None if the file does not exist.
+    '''
+    try:
+      stat=os.stat(filename)
+    except OSError:
+      return None
+    return repr((cls.__name__, filename, stat.st_mtime, stat.st_size,
+                 cls._freeze_options(all_options)))
+
+  @classmethod
+  def _get_disk_cached(cls, filename, all_options):
+    '''
+    Return the object read from filename with the same options from the
+    on-disk cache or None.
+    '''
+    if not filename.endswith('.nxs'):
+      return None
+    key=cls._disk_cache_key(filename, all_options)
+    if key is None:
+      return None
+    cache_file=os.path.join(all_options['disk_cache'], hashlib.sha1(key).hexdigest()+'.cache')
+    if not os.path.exists(cache_file):
+      return None
+    try:
+      # only arrays and a JSON header are read, so files in a shared
+      # cache folder can't execute code as pickles could
+      with load(cache_file, allow_pickle=False) as cache:
+        arrays=dict([(name, cache[name]) for name in cache.files])
+      header=json.loads(arrays.pop('__header__').tostring().decode('utf8'))
+      cache_data=_cache_decode(header, arrays)
+    except (IOError, OSError):
+      return None
+    except Exception:
+      debug('Could not read cache file %s'%cache_file, exc_info=True)
+      return None
+    if cache_data['key']!=key:
+      return None
+    try:
+      # mark as recently used for the eviction of old items
+      os.utime(cache_file, None)
+    except OSError:
+      pass
+    self=object.__new__(cls)
+    self._options=dict(all_options)
+    self._options['callback']=None
+    self._channel_names=cache_data['channel_names']
+    self._channel_origin=cache_data['channel_origin']
+    self._channel_data=[]
+    for state in cache_data['channel_data']:
+      data=object.__new__(MRDataset)
+      data.__dict__.update(state)
+      data.read_options=self._options
+      self._channel_data.append(data)
+    self.measurement_type=cache_data['measurement_type']
+    self.origin=filename
+    self._read_times=[]
+    debug('Read %s from disk cache'%filename)
+    return self
+
+  @classmethod
+  def _add_disk_cached(cls, obj):
+    '''
+    Store an object in the on-disk cache and remove the least recently
+    used items if the cache gets bigger than MAX_DISK_CACHE.
+    The file is written to a temporary name first and than renamed,
+    so other processes never read incomplete items.
+    '''
+    if not obj.origin.endswith('.nxs'):
+      return
+    key=cls._disk_cache_key(obj.origin, obj._options)
+    if key is None:
+      return
+    cache_dir=obj._options['disk_cache']
+    cache_file=os.path.join(cache_dir, hashlib.sha1(key).hexdigest()+'.cache')
+    channel_data=[]
+    for data in obj._channel_data:
+      state=data.__getstate__()
+      state.pop('read_options', None)
+      channel_data.append(state)
+    cache_data=dict(key=key,
+                    channel_names=obj._channel_names,
+                    channel_origin=obj._channel_origin,
+                    channel_data=channel_data,
+                    measurement_type=obj.measurement_type)
+    arrays={}
+    try:
+      header=json.dumps(_cache_encode(cache_data, arrays))
+    except TypeError:
+      debug('Could not store dataset in disk cache', exc_info=True)
+      return
+    arrays['__header__']=fromstring(header.encode('utf8'), dtype=uint8)
+    try:
+      if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      fh, tmp_file=tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+      fh=os.fdopen(fh, 'wb')
+      try:
+        savez(fh, **arrays)
+      finally:
+        fh.close()
+      try:
+        os.rename(tmp_file, cache_file)
+      except OSError:
+        # on Windows rename fails if the file exists
+        os.remove(tmp_file)
+    except (IOError, OSError):
+      warn('Could not write cache file %s'%cache_file, exc_info=True)
+      return
+    cls._clean_disk_cache(cache_dir)
+
+  @classmethod
+  def _clean_disk_cache(cls, cache_dir):
+    '''
+    Remove the least recently used items from the on-disk cache until
+    it is smaller than MAX_DISK_CACHE. Items removed by other processes
+    are ignored.
+    '''
+    items=[]
+    for cache_file in glob(os.path.join(cache_dir, '*.cache')):
+      try:
+        stat=os.stat(cache_file)
+      except OSError:
+        continue
+      items.append((stat.st_mtime, stat.st_size, cache_file))
+    items.sort()
+    total_size=sum([item[1] for item in items])
+    while total_size>cls.MAX_DISK_CACHE and len(items)>1:
+      ignore, size, cache_file=items.pop(0)
+      try:
+        os.remove(cache_file)
+      except OSError:
+        pass
+      total_size-=size
+
   @classmethod
   def _get_all_options(cls, options):
     all_options=dict(cls.DEFAULT_OPTIONS)
@@ -249,11 +741,122 @@ class NXSData(object):
     start=time()
     if self._options['callback']:
       self._options['callback'](0.)
+    file_info=self._open_channels(filename)
+    if file_info is None:
+      return False
+    nxs, channels, mapping, is_ancient=file_info
+
+    # get runtime for event mode splitting
+    total_duration=time_from_header('', nxs=nxs)
+
+    progress=0.1
+    if self._options['callback']:
+      self._options['callback'](progress)
+    self._read_times.append(time()-start)
+    i=1
+    empty_channels=[]
+    if self._options['channel_pool'] and len(channels)>1 and not is_ancient and \
+        not self._options['header_only']:
+      self._read_channels_pooled(filename, mapping, channels, total_duration)
+      mapping=[] # all channels have been read
+    for dest, channel in mapping:
+      if channel not in channels:
+        continue
+      raw_data=nxs[channel]
+      if self._options['header_only'] and not is_ancient and 'data_x_y' in raw_data['bank1']:
+        data=MRDataset.from_header(raw_data, self._options, filename.endswith('event.nxs'),
+                                   tof_overwrite=self._options['event_tof_overwrite'])
+      elif filename.endswith('event.nxs'):
+        data=MRDataset.from_event(raw_data, self._options,
+                                  callback=self._options['callback'],
+                                  callback_offset=progress,
+                                  callback_scaling=0.9/len(channels),
+                                  tof_overwrite=self._options['event_tof_overwrite'],
+                                  total_duration=total_duration)
+        if data is None:
+          # no data in channel, don't add it
+          empty_channels.append(dest)
+          continue
+      elif filename.endswith('histo.nxs'):
+        data=MRDataset.from_histogram(raw_data, self._options)
+      else:
+        data=MRDataset.from_old_format(raw_data, self._options)
+      self._channel_data.append(data)
+      self._channel_names.append(dest)
+      self._channel_origin.append(channel)
+      progress=0.1+0.9*float(i)/len(channels)
+      if self._options['callback']:
+        self._options['callback'](progress)
+      i+=1
+      self._read_times.append(time()-self._read_times[-1]-start)
+    #print time()-start
+    if not is_ancient:
+      nxs.close()
+    if empty_channels:
+      warn('No counts for state %s'%(','.join(empty_channels)))
+    return True
+
+  def _read_channels_pooled(self, filename, mapping, channels, total_duration):
+    '''
+    Read the channels of a Nexus file in parallel using a thread or process pool.
+    Each worker opens the file itself, the results are added in mapping order.
+    
+    :param str filename: Path to file to read
+    :param list mapping: Channel mapping of the measurement type
+    :param list channels: Channels with data in the file
+    :param float total_duration: Runtime used for event mode splitting
+    '''
+    start=time()
+    items=[(dest, channel) for dest, channel in mapping if channel in channels]
+    # the callback function can not be passed to other processes
+    read_options=dict(self._options)
+    read_options['callback']=None
+    args=[(filename, channel, read_options, total_duration) for ignore, channel in items]
+    if self._options['channel_pool']=='process':
+      pool=Pool(min(len(items), cpu_count()))
+    elif self._options['channel_pool']=='thread':
+      pool=ThreadPool(min(len(items), cpu_count()))
+    else:
+      raise ValueError, "channel_pool needs to be 'thread', 'process' or None"
+    results={}
+    try:
+      # update the progress from the main thread when any channel is finished
+      for i, data in pool.imap_unordered(_read_channel, enumerate(args)):
+        results[i]=data
+        if self._options['callback']:
+          self._options['callback'](0.1+0.9*float(len(results))/len(items))
+        self._read_times.append(time()-start)
+    finally:
+      pool.close()
+      pool.join()
+    empty_channels=[]
+    for i, (dest, channel) in enumerate(items):
+      data=results[i]
+      if data is None:
+        # no data in channel, don't add it
+        empty_channels.append(dest)
+        continue
+      data.read_options=self._options
+      self._channel_data.append(data)
+      self._channel_names.append(dest)
+      self._channel_origin.append(channel)
+    if empty_channels:
+      warn('No counts for state %s'%(','.join(empty_channels)))
+
+  def _open_channels(self, filename):
+    '''
+    Open a Nexus file, analyze the channels with data and set the measurement type.
+    
+    :param str filename: Path to file to read
+    
+    :returns: file object, list of channels, channel mapping and if the file has the ancient format
+              or None if the file can not be read
+    '''
     try:
       nxs=h5py.File(filename, mode='r')
     except IOError:
       debug('Could not read nxs file %s'%filename, exc_info=True)
-      return False
+      return None
     # analyze channels
     channels=nxs.keys()
     debug('Channels in file: '+repr(channels))
@@ -269,13 +872,13 @@ class NXSData(object):
       max_counts=max([nxs[channel][u'total_counts'].value[0] for channel in channels])
     except KeyError:
       warn('total_counts not defined in channels')
-      return False
+      return None
     for channel in list(channels):
       if nxs[channel][u'total_counts'].value[0]<(self.COUNT_THREASHOLD*max_counts):
         channels.remove(channel)
     if len(channels)==0:
       debug('No valid channels in file')
-      return False
+      return None
     ana=nxs[channels[0]]['instrument/analyzer/AnalyzerLift/value'].value[0]
     pol=nxs[channels[0]]['instrument/polarizer/PolLift/value'].value[0]
     try:
@@ -314,49 +917,7 @@ class NXSData(object):
     for channel in channels:
       if not channel in [m[1] for m in mapping]:
         mapping.append((channel.lstrip('entry-'), channel))
-
-    # get runtime for event mode splitting
-    total_duration=time_from_header('', nxs=nxs)
-
-    progress=0.1
-    if self._options['callback']:
-      self._options['callback'](progress)
-    self._read_times.append(time()-start)
-    i=1
-    empty_channels=[]
-    for dest, channel in mapping:
-      if channel not in channels:
-        continue
-      raw_data=nxs[channel]
-      if filename.endswith('event.nxs'):
-        data=MRDataset.from_event(raw_data, self._options,
-                                  callback=self._options['callback'],
-                                  callback_offset=progress,
-                                  callback_scaling=0.9/len(channels),
-                                  tof_overwrite=self._options['event_tof_overwrite'],
-                                  total_duration=total_duration)
-        if data is None:
-          # no data in channel, don't add it
-          empty_channels.append(dest)
-          continue
-      elif filename.endswith('histo.nxs'):
-        data=MRDataset.from_histogram(raw_data, self._options)
-      else:
-        data=MRDataset.from_old_format(raw_data, self._options)
-      self._channel_data.append(data)
-      self._channel_names.append(dest)
-      self._channel_origin.append(channel)
-      progress=0.1+0.9*float(i)/len(channels)
-      if self._options['callback']:
-        self._options['callback'](progress)
-      i+=1
-      self._read_times.append(time()-self._read_times[-1]-start)
-    #print time()-start
-    if not is_ancient:
-      nxs.close()
-    if empty_channels:
-      warn('No counts for state %s'%(','.join(empty_channels)))
-    return True
+    return nxs, channels, mapping, is_ancient
 
   def _get_ancient(self, filename):
     '''
@@ -438,12 +999,19 @@ class NXSData(object):
     for item in self.values():
       yield item
 
+  def close(self):
+    '''
+    Close the files opened by lazy datasets of all channels.
+    '''
+    for item in self:
+      item.close()
+
   @classmethod
   def get_cachesize(cls):
     """
     Return the total amount of memory used by the cached datasets.
     """
-    return sum([ds.nbytes for ds in cls._cache])
+    return sum([item[0].nbytes for item in cls._cache.values()])
 
   def __nbytes(self): return sum([ds.nbytes for ds in self])
   nbytes=property(__nbytes, doc='size of the data stored in memory for all states of this file')
@@ -481,15 +1049,13 @@ class NXSMultiData(NXSData):
       raise ValueError, 'File names needs to be an iterable of length > 0'
     all_options=cls._get_all_options(options)
     all_options['callback']=None
-    cached_names=[item.origin for item in cls._cache]
-    if all_options['use_caching'] and filenames in cached_names:
-      cache_index=cached_names.index(filenames)
-      cached_object=cls._cache[cache_index]
-      if cached_object._options==all_options:
+    filenames.sort()
+    if all_options['use_caching']:
+      cached_object=cls._get_cached(filenames, all_options)
+      if cached_object is not None:
         return cached_object
 
     options['use_caching']=False # caching would return NXSData type objects
-    filenames.sort()
     if 'callback' in options and options['callback'] is not None:
       cls._callback=options['callback']
       cls._progress_items=len(filenames)
@@ -509,13 +1075,7 @@ class NXSMultiData(NXSData):
     for item in self:
       item.read_options=all_options
     if all_options['use_caching']:
-      if filenames in cached_names:
-        cache_index=cached_names.index(filenames)
-        cls._cache.pop(cache_index)
-      # make sure cache does not get bigger than MAX_CACHE items or 80% of available memory
-      while len(cls._cache)>=cls.MAX_CACHE:
-        cls._cache.pop(0)
-      cls._cache.append(self)
+      cls._add_cached(self)
     return self
 
   def _add_data(self, other):
@@ -680,9 +1240,6 @@ class MRDataset(object):
   ai=None #: incident angle
   dpix=0 #: pixel of direct beam position at dangle0
   lambda_center=3.37 #: central wavelength of measurement band [Å]
-  xydata=None #: 2D array of intensity projected on X-Y
-  xtofdata=None #: 2D array of intensity projected on X-ToF
-  data=None #: 3D array of intensity in X, Y and ToF
   logs={} #: Log information of instrument parameters
   log_units={} #: Units of the parameters given in logs
   experiment='' #: Name of the experiment
@@ -697,6 +1254,11 @@ class MRDataset(object):
   _Q=None
   _I=None
   _dI=None
+  _data=None #: 3D array of counts
+  _xydata=None #: X-Y projection, calculated from the 3D data on first access if not set
+  _xtofdata=None #: X-ToF projection, calculated from the 3D data on first access if not set
+  _h5_source=None #: file name and dataset path of lazy histogram data
+  _h5file=None
   _active_area_x=None #: active pixels for x direction
   _active_area_y=None #: active pixels for y direction
 
@@ -719,9 +1281,14 @@ class MRDataset(object):
 
     output.tof_edges=data['bank1/time_of_flight'].value
     # the data arrays
-    output.data=data['bank1/data'].value.astype(float) # 3D dataset
-    output.xydata=data['bank1']['data_x_y'].value.transpose().astype(float) # 2D dataset
-    output.xtofdata=data['bank1']['data_x_time_of_flight'].value.astype(float) # 2D dataset
+    # the data arrays, projections are converted to float on first access
+    if read_options['lazy_histogram']:
+      # only read the regions of the 3D dataset when used
+      output._h5_source=(data.file.filename, data['bank1/data'].name)
+    else:
+      output.data=data['bank1/data'].value # 3D dataset
+    output.xydata=data['bank1']['data_x_y'].value.transpose() # 2D dataset
+    output.xtofdata=data['bank1']['data_x_time_of_flight'].value # 2D dataset
 
     try:
       mon_tof_from=data['monitor1']['time_of_flight'].value.astype(float)*\
@@ -734,6 +1301,25 @@ class MRDataset(object):
       output.mon_data=None
     return output
 
+  @classmethod
+  @log_call
+  def from_header(cls, data, read_options, event_mode=False, tof_overwrite=None):
+    '''
+    Create object from the header information of a histogram or event mode Nexus file,
+    using the stored X-Y projection without reading the 3D data or binning the events.
+    The ToF channels are the same as for a full readout.
+    '''
+    output=cls()
+    output.read_options=read_options
+    output.from_event_mode=event_mode
+    output._collect_info(data)
+    if event_mode:
+      output.tof_edges=output._get_event_tof_edges(data, tof_overwrite)
+    else:
+      output.tof_edges=data['bank1/time_of_flight'].value
+    output.xydata=data['bank1']['data_x_y'].value.transpose() # 2D dataset
+    return output
+
   @classmethod
   @log_call
   def from_old_format(cls, data, read_options):
@@ -746,10 +1332,8 @@ class MRDataset(object):
 
     # first ToF edge is 0, prevent that
     output.tof_edges=data['bank1/time_of_flight'].value[1:]
-    # the data arrays
-    output.data=data['bank1/data'].value.astype(float)[:, :, 1:] # 3D dataset
-    output.xydata=output.data.sum(axis=2).transpose()
-    output.xtofdata=output.data.sum(axis=1)
+    # the data arrays, projections are calculated on first access
+    output.data=data['bank1/data'].value[:, :, 1:] # 3D dataset
     return output
 
   @classmethod
@@ -767,83 +1351,186 @@ class MRDataset(object):
     output=cls()
     output.read_options=read_options
     output.from_event_mode=True
-    bin_type=read_options['bin_type']
-    bins=read_options['bins']
     output._collect_info(data)
-
-    if tof_overwrite is None:
-      lcenter=data['DASlogs/LambdaRequest/value'].value[0]
-      # ToF region for this specific central wavelength
-      tmin=output.dist_mod_det/H_OVER_M_NEUTRON*(lcenter-1.6)*1e-4
-      tmax=output.dist_mod_det/H_OVER_M_NEUTRON*(lcenter+1.6)*1e-4
-      if bin_type==0: # constant Δλ
-        tof_edges=linspace(tmin, tmax, bins+1)
-      elif bin_type==1: # constant ΔQ
-        tof_edges=1./linspace(1./tmin, 1./tmax, bins+1)
-      elif bin_type==2: # constant Δλ/λ
-        tof_edges=tmin*(((tmax/tmin)**(1./bins))**arange(bins+1))
-      else:
-        raise ValueError, 'Unknown bin type %i'%bin_type
-    else:
-      tof_edges=tof_overwrite
+    tof_edges=output._get_event_tof_edges(data, tof_overwrite)
 
     # Histogram the data
     # create ToF edges for the binning and correlate pixel indices with pixel position
-    tof_ids=array(data['bank1_events/event_id'].value, dtype=int)
-    tof_time=data['bank1_events/event_time_offset'].value
+    event_ids=data['bank1_events/event_id']
+    event_times=data['bank1_events/event_time_offset']
+    start_idx=0
+    stop_idx=event_ids.shape[0]
     # read the corresponding proton charge of each pulse
     tof_pc=data['DASlogs/proton_charge/value'].value
     if read_options['event_split_bins']:
-      split_bins=read_options['event_split_bins']
       split_index=read_options['event_split_index']
-      # read the relative time in seconds from measurement start to event
-      tof_real_time=data['bank1_events/event_time_zero'].value
-      tof_idx_to_id=data['bank1_events/event_index'].value
-      if total_duration is None:
-        split_step=float(tof_real_time[-1]+0.01)/split_bins
-      else:
-        split_step=float(total_duration+0.01)/split_bins
-      try:
-        start_id, stop_id=where(((tof_real_time>=(split_index*split_step))&
-                                 (tof_real_time<((split_index+1)*split_step))))[0][[0,-1]]
-      except IndexError:
+      split_ranges=MRDataset._get_event_split_ranges(data, read_options['event_split_bins'],
+                                                     total_duration)
+      if not 0<=split_index<len(split_ranges) or split_ranges[split_index] is None:
         debug('No pulses in selected range')
         return None
-
-      if start_id==0:
-        start_idx=0
-      else:
-        start_idx=tof_idx_to_id[start_id-1]
-      stop_idx=tof_idx_to_id[stop_id]
-      debug('Event split with %.1f<=t<%.1f yielding pulse/tof indices: [%i:%i]/[%i:%i]'
-            %((split_index*split_step), ((split_index+1)*split_step),
-              start_id, stop_id+1, start_idx, stop_idx)
-            )
+      start_id, stop_id, start_idx, stop_idx=split_ranges[split_index]
       tof_pc=tof_pc[start_id:stop_id+1]
 
-      tof_ids=tof_ids[start_idx:stop_idx]
-      tof_time=tof_time[start_idx:stop_idx]
       # correct the total count value for the number of neutrons in the selected range
-      output.total_counts=tof_time.shape[0]
+      output.total_counts=max(0, stop_idx-start_idx)
       if output.total_counts==0:
         debug('No counts in selected range')
         return None
     # calculate total proton charge in the selected area
     output.proton_charge=tof_pc.sum()
     dimension=data['bank1/data_x_y'].shape
-    Ixyt=MRDataset.bin_events(tof_ids, tof_time, tof_edges, dimension,
-                              callback, callback_offset, callback_scaling)
+    output._bin_event_range(event_ids, event_times, start_idx, stop_idx, tof_edges, dimension,
+                            callback, callback_offset, callback_scaling)
+    return output
 
-    # create projections for the 2D datasets
-    Ixy=Ixyt.sum(axis=2)
-    Ixt=Ixyt.sum(axis=1)
-    # store the data
-    output.tof_edges=tof_edges
-    output.data=Ixyt.astype(float) # 3D dataset
-    output.xydata=Ixy.transpose().astype(float) # 2D dataset
-    output.xtofdata=Ixt.astype(float) # 2D dataset
+  @classmethod
+  @log_call
+  def from_event_split(cls, data, read_options, split_indices,
+                       callback=None, callback_offset=0., callback_scaling=1.,
+                       total_duration=None,
+                       tof_overwrite=None):
+    '''
+    Load several time slices from a Nexus file containing event information
+    reading the events only once. The event range of each slice is taken from
+    the event_index pulse boundaries, each result is the same as returned by
+    from_event with the according event_split_index option.
+    
+    :param list split_indices: Indices of the slices to be created
+    
+    :returns: list of objects corresponding to split_indices, None for slices without counts
+    '''
+    template=cls()
+    template.from_event_mode=True
+    template._collect_info(data)
+    template.read_options=read_options
+    tof_edges=template._get_event_tof_edges(data, tof_overwrite)
+    # the options can contain a callback, which should not be copied for each slice
+    template.read_options=None
+
+    event_ids=data['bank1_events/event_id']
+    event_times=data['bank1_events/event_time_offset']
+    tof_pc=data['DASlogs/proton_charge/value'].value
+    dimension=data['bank1/data_x_y'].shape
+    split_ranges=MRDataset._get_event_split_ranges(data, read_options['event_split_bins'],
+                                                   total_duration)
+    slice_ranges=[]
+    for split_index in split_indices:
+      if 0<=split_index<len(split_ranges) and split_ranges[split_index] is not None and \
+          split_ranges[split_index][3]>split_ranges[split_index][2]:
+        slice_ranges.append(split_ranges[split_index])
+      else:
+        debug('No counts in time slice %i'%split_index)
+        slice_ranges.append(None)
+    used_ranges=[item for item in slice_ranges if item is not None]
+    read_start=0
+    if used_ranges and not read_options['event_chunk_size']:
+      # read the events of all requested slices at once
+      read_start=min([item[2] for item in used_ranges])
+      read_stop=max([item[3] for item in used_ranges])
+      event_ids=asarray(event_ids[read_start:read_stop], dtype=int)
+      event_times=event_times[read_start:read_stop]
+
+    output=[]
+    slice_scaling=callback_scaling/len(split_indices)
+    for i, slice_range in enumerate(slice_ranges):
+      if slice_range is None:
+        output.append(None)
+        continue
+      start_id, stop_id, start_idx, stop_idx=slice_range
+      item=deepcopy(template)
+      item.read_options=read_options
+      item.total_counts=stop_idx-start_idx
+      item.proton_charge=tof_pc[start_id:stop_id+1].sum()
+      item._bin_event_range(event_ids, event_times, start_idx-read_start, stop_idx-read_start,
+                            tof_edges, dimension,
+                            callback, callback_offset+i*slice_scaling, slice_scaling)
+      output.append(item)
+    return output
+
+  def _get_event_tof_edges(self, data, tof_overwrite=None):
+    '''
+    Create the ToF edges for event mode binning according to the read options.
+    '''
+    if tof_overwrite is not None:
+      return tof_overwrite
+    bin_type=self.read_options['bin_type']
+    bins=self.read_options['bins']
+    lcenter=data['DASlogs/LambdaRequest/value'].value[0]
+    # ToF region for this specific central wavelength
+    tmin=self.dist_mod_det/H_OVER_M_NEUTRON*(lcenter-1.6)*1e-4
+    tmax=self.dist_mod_det/H_OVER_M_NEUTRON*(lcenter+1.6)*1e-4
+    if bin_type==0: # constant Δλ
+      tof_edges=linspace(tmin, tmax, bins+1)
+    elif bin_type==1: # constant ΔQ
+      tof_edges=1./linspace(1./tmin, 1./tmax, bins+1)
+    elif bin_type==2: # constant Δλ/λ
+      tof_edges=tmin*(((tmax/tmin)**(1./bins))**arange(bins+1))
+    else:
+      raise ValueError, 'Unknown bin type %i'%bin_type
+    return tof_edges
+
+  @staticmethod
+  def _get_event_split_ranges(data, split_bins, total_duration=None):
+    '''
+    Calculate the pulse and event index ranges of all time slices from the pulse times
+    and the event_index boundaries of the file.
+    
+    :param int split_bins: Number of time slices
+    :param float total_duration: Total measurement time, if None the last pulse time is used
+    
+    :returns: list of (start pulse, stop pulse, start event, stop event) for each slice
+              or None for slices without pulses
+    '''
+    # read the relative time in seconds from measurement start to each pulse
+    tof_real_time=data['bank1_events/event_time_zero'].value
+    tof_idx_to_id=data['bank1_events/event_index'].value
+    if total_duration is None:
+      split_step=float(tof_real_time[-1]+0.01)/split_bins
+    else:
+      split_step=float(total_duration+0.01)/split_bins
+    # pulse times are ordered, so the slice boundaries can be searched directly
+    split_edges=arange(split_bins+1)*split_step
+    start_ids=searchsorted(tof_real_time, split_edges[:-1], side='left')
+    stop_ids=searchsorted(tof_real_time, split_edges[1:], side='left')-1
+    output=[]
+    for split_index, (start_id, stop_id) in enumerate(zip(start_ids, stop_ids)):
+      if stop_id<start_id:
+        output.append(None)
+        continue
+      if start_id==0:
+        start_idx=0
+      else:
+        start_idx=int(tof_idx_to_id[start_id-1])
+      stop_idx=int(tof_idx_to_id[stop_id])
+      debug('Event split with %.1f<=t<%.1f yielding pulse/tof indices: [%i:%i]/[%i:%i]'
+            %(split_edges[split_index], split_edges[split_index+1],
+              start_id, stop_id+1, start_idx, stop_idx)
+            )
+      output.append((start_id, stop_id, start_idx, stop_idx))
     return output
 
+  def _bin_event_range(self, event_ids, event_times, start_idx, stop_idx, tof_edges, dimension,
+                       callback=None, callback_offset=0., callback_scaling=1.):
+    '''
+    Histogram the events from start_idx to stop_idx and store the resulting
+    3D dataset together with its projections.
+    '''
+    if self.read_options['event_chunk_size']:
+      Ixyt=MRDataset.bin_events_chunked(event_ids, event_times, start_idx, stop_idx,
+                                        self.read_options['event_chunk_size'],
+                                        tof_edges, dimension,
+                                        callback, callback_offset, callback_scaling)
+    else:
+      tof_ids=asarray(event_ids[start_idx:stop_idx], dtype=int)
+      tof_time=event_times[start_idx:stop_idx]
+      Ixyt=MRDataset.bin_events(tof_ids, tof_time, tof_edges, dimension,
+                                callback, callback_offset, callback_scaling)
+
+    # store the data, the 2D projections are calculated on first access
+    self.tof_edges=tof_edges
+    self.data=Ixyt # 3D dataset
+
   @classmethod
   @log_call
   def from_xml(cls, xyfile, tofxfile, daslogs,
@@ -921,51 +1608,73 @@ class MRDataset(object):
   def bin_events(tof_ids, tof_time, tof_edges, dimension,
                  callback=None, callback_offset=0., callback_scaling=1.):
     '''
-    Filter events outside the tof_edges region and calculate the binning with devide_bin.
+    Filter events outside the tof_edges region and histogram the remaining ones
+    in a single pass. Each event is mapped to a flat (pixel, ToF-bin) index
+    so one numpy bincount call fills the whole 3D array.
+    
+    :param tof_ids: Array of positional indices for each event
+    :param tof_time: Array of time of flight for each event
+    :param tof_edges: The edges of bins to be used for the histogram
+    :param dimension: x,y pixel size of detector
+    :keyword callback: Optional callback function for the progress
+    :keyword callback_offset: Offset for calling the function
+    :keyword callback_scaling: Factor to multiply the relative progress when calling the function
     
     @return: 3D array of dimensions (x, y, tof)
     '''
+    bins=len(tof_edges)-1
+    pixels=dimension[0]*dimension[1]
+    if callback is not None:
+      callback(callback_offset)
     region=(tof_time>=tof_edges[0])&(tof_time<=tof_edges[-1])
-    result=array(MRDataset.devide_bin(tof_ids[region], tof_time[region], tof_edges, dimension,
-                                callback, callback_offset, callback_scaling/len(tof_edges)))
-    return result.transpose((1, 2, 0))
+    tof_time=tof_time[region]
+    # bin index of each event, events on the last edge belong to the last bin,
+    # edges are compared with the precision of the event times
+    tof_bin=searchsorted(asarray(tof_edges, dtype=tof_time.dtype), tof_time, side='right')-1
+    tof_bin[tof_bin==bins]=bins-1
+    flat_idx=tof_ids[region].astype(int64)*bins
+    flat_idx+=tof_bin
+    del(tof_time, tof_bin)
+    if callback is not None:
+      callback(callback_offset+callback_scaling*0.5)
+    result=bincount(flat_idx, minlength=pixels*bins)
+    if callback is not None:
+      callback(callback_offset+callback_scaling)
+    return result.reshape(dimension[0], dimension[1], bins)
 
   @staticmethod
-  def devide_bin(tof_ids, tof_time, tof_edges, dimension,
-                 callback=None, callback_offset=0., callback_scaling=1., cbidx=0):
+  def bin_events_chunked(event_ids, event_times, start_idx, stop_idx, chunk_size,
+                         tof_edges, dimension,
+                         callback=None, callback_offset=0., callback_scaling=1.):
     '''
-    Use a divide and conquer strategy to bin the data. For the actual binning the
-    numpy bincount function is used, as it is much faster then histogram for
-    counting of integer values.
+    Read the events from the HDF5 datasets in slices of chunk_size items and
+    accumulate the binned result, so the memory usage does not depend on
+    the number of events in the file.
     
-    :param tof_ids: Array of positional indices for each event
-    :param tof_time: Array of time of flight for each event
+    :param event_ids: HDF5 dataset of positional indices for each event
+    :param event_times: HDF5 dataset of time of flight for each event
+    :param int start_idx: Index of the first event to be used
+    :param int stop_idx: Index after the last event to be used
+    :param int chunk_size: Number of events to be read and binned at once
     :param tof_edges: The edges of bins to be used for the histogram
     :param dimension: x,y pixel size of detector
     :keyword callback: Optional callback function for the progress
     :keyword callback_offset: Offset for calling the function
-    :keyword callback_scaling: Factor to multiply the counting index when calling the function
-    :keyword cbidx: Current counting index for this recursive call
+    :keyword callback_scaling: Factor to multiply the relative progress when calling the function
     
-    :return: 3D list of dimensions (tof, x, y)
-    '''
-    if len(tof_edges)==2:
-      # deepest recursion reached, all items should be within the two ToF edges
-      if callback is not None:
-        callback(callback_offset+callback_scaling*cbidx)
-      return [bincount(tof_ids, minlength=dimension[0]*dimension[1]).reshape(
-                                                  dimension[0], dimension[1]).tolist()]
-    # split all events into two time of flight regions
-    split_idx=len(tof_edges)//2
-    left_region=tof_time<tof_edges[split_idx]
-    left_list=MRDataset.devide_bin(tof_ids[left_region], tof_time[left_region],
-                              tof_edges[:split_idx+1], dimension,
-                              callback, callback_offset, callback_scaling, cbidx)
-    right_region=logical_not(left_region)
-    right_list=MRDataset.devide_bin(tof_ids[right_region], tof_time[right_region],
-                              tof_edges[split_idx:], dimension,
-                              callback, callback_offset, callback_scaling, split_idx+cbidx)
-    return left_list+right_list
+    @return: 3D array of dimensions (x, y, tof)
+    '''
+    chunk_size=int(chunk_size)
+    result=zeros((dimension[0], dimension[1], len(tof_edges)-1), dtype=int)
+    chunk_starts=range(start_idx, stop_idx, chunk_size)
+    chunk_scaling=callback_scaling/max(1, len(chunk_starts))
+    for i, chunk_start in enumerate(chunk_starts):
+      chunk_stop=min(chunk_start+chunk_size, stop_idx)
+      tof_ids=array(event_ids[chunk_start:chunk_stop], dtype=int)
+      tof_time=event_times[chunk_start:chunk_stop]
+      result+=MRDataset.bin_events(tof_ids, tof_time, tof_edges, dimension,
+                                   callback, callback_offset+i*chunk_scaling, chunk_scaling)
+    return result
 
   def _collect_info(self, data):
     '''
@@ -1090,13 +1799,48 @@ class MRDataset(object):
     output+='</table>'
     return output
 
+  def close(self):
+    '''
+    Close the histogram file of a lazy dataset, it gets reopened when needed.
+    '''
+    if self._h5file is not None:
+      self._h5file.close()
+      self._h5file=None
+
+  def __getstate__(self):
+    state=dict(self.__dict__)
+    # open files can't be pickled, they get reopened when needed
+    state.pop('_h5file', None)
+    return state
+
+  def _read_h5_window(self, x_from=None, x_to=None, y_from=None, y_to=None):
+    '''
+    Read a region in x and y for all ToF channels from the histogram file
+    of a lazy dataset.
+    '''
+    if self._h5file is None:
+      self._h5file=h5py.File(self._h5_source[0], mode='r')
+    dataset=self._h5file[self._h5_source[1]]
+    x_start, x_stop, ignore=slice(x_from, x_to).indices(dataset.shape[0])
+    y_start, y_stop, ignore=slice(y_from, y_to).indices(dataset.shape[1])
+    if x_stop<=x_start or y_stop<=y_start:
+      return zeros((max(0, x_stop-x_start), max(0, y_stop-y_start), dataset.shape[2]),
+                   dtype=dataset.dtype)
+    return dataset[x_start:x_stop, y_start:y_stop, :]
+
   def __iadd__(self, other):
     '''
     Add the data of one dataset to this dataset.
     '''
-    self.data+=other.data
-    self.xydata+=other.xydata
-    self.xtofdata+=other.xtofdata
+    # projections that have not been calculated, yet, will be derived from the summed data
+    if self._xydata is not None:
+      self.xydata=self.xydata+other.xydata
+    if self._xtofdata is not None:
+      self.xtofdata=self.xtofdata+other.xtofdata
+    # prevent overflow of the compact integer types
+    data=self.data.astype(result_type(self.data, other.data, int64))
+    data+=other.data
+    self.data=data
     self.total_counts+=other.total_counts
     self.proton_charge+=other.proton_charge
     if type(self.number) is list:
@@ -1117,44 +1861,216 @@ class MRDataset(object):
     return output
 
   if USE_COMPRESSION:
-    # data compressed in memory properties, last dataset data is cached for better GUI response
-    _data_zipped=None
+    # data compressed in memory in blocks of x-pixels, so a region can be read
+    # without decompressing the whole dataset
+    _data_blocks=None
+    _data_compressor=COMPRESSOR
     _data_dtype=float
     _data_shape=(0,)
-    _cached_object=None
-    _cached_data=None
+    # last decompressed datasets are cached for better GUI response
+    _decompressed=OrderedDict()
+    _decompressed_lock=Lock()
     @property
     def data(self):
-      if MRDataset._cached_object is self:
-        return MRDataset._cached_data
-      data=fromstring(zlib.decompress(self._data_zipped), dtype=self._data_dtype)
-      data=data.reshape(self._data_shape)
-      MRDataset._cached_data=data
-      MRDataset._cached_object=self
+      '''3D array of counts in X, Y and ToF, stored as smallest possible integer type'''
+      with MRDataset._decompressed_lock:
+        data=MRDataset._decompressed.pop(self, None)
+      if data is None:
+        if self._data_blocks is None:
+          if self._h5_source is not None:
+            # keep the data after a full read instead of reading it again
+            self.data=self._read_h5_window()
+            self.close()
+            return self.data
+          return None
+        data=self._decompress_blocks(0, len(self._data_blocks))
+      self._set_decompressed(data)
       return data
     @data.setter
     def data(self, data):
-      self._data_zipped=zlib.compress(data.tostring(), 1)
+      data=self._compact_counts(data)
+      self._h5_source=None
+      compress=COMPRESSORS[COMPRESSOR][0]
+      self._data_blocks=[compress(data[i:i+COMPRESSION_BLOCK])
+                         for i in range(0, data.shape[0], COMPRESSION_BLOCK)]
+      self._data_compressor=COMPRESSOR
       self._data_dtype=data.dtype
       self._data_shape=data.shape
-      MRDataset._cached_data=data
-      MRDataset._cached_object=self
+      self._set_decompressed(data)
+      MRDataset._summed_areas.pop(self, None)
+
+    def data_window(self, x_from=None, x_to=None, y_from=None, y_to=None):
+      '''
+      Return the counts of a region in x and y for all ToF channels.
+      Only the blocks containing the x region are decompressed.
+      '''
+      data=MRDataset._decompressed.get(self, None)
+      if data is not None:
+        return data[x_from:x_to, y_from:y_to, :]
+      if self._data_blocks is None and self._h5_source is not None:
+        return self._read_h5_window(x_from, x_to, y_from, y_to)
+      start, stop, ignore=slice(x_from, x_to).indices(self._data_shape[0])
+      if stop<=start:
+        return zeros((0,)+tuple(self._data_shape[1:]),
+                     dtype=self._data_dtype)[:, y_from:y_to, :]
+      first_block=start//COMPRESSION_BLOCK
+      data=self._decompress_blocks(first_block, (stop-1)//COMPRESSION_BLOCK+1)
+      offset=first_block*COMPRESSION_BLOCK
+      return data[start-offset:stop-offset, y_from:y_to, :]
+
+    def _decompress_blocks(self, first, last):
+      decompress=COMPRESSORS[self._data_compressor][1]
+      blocks=[decompress(block, self._data_dtype)
+              for block in self._data_blocks[first:last]]
+      if len(blocks)==0:
+        return zeros(self._data_shape, dtype=self._data_dtype)
+      return concatenate(blocks).reshape((-1,)+tuple(self._data_shape[1:]))
+
+    def _set_decompressed(self, data):
+      # add to the decompressed cache as most recently used item
+      with MRDataset._decompressed_lock:
+        MRDataset._decompressed.pop(self, None)
+        MRDataset._decompressed[self]=data
+        while len(MRDataset._decompressed)>MAX_DECOMPRESSED:
+          MRDataset._decompressed.popitem(last=False)
+  else:
+    @property
+    def data(self):
+      '''3D array of counts in X, Y and ToF, stored as smallest possible integer type'''
+      if self._data is None and self._h5_source is not None:
+        # keep the data after a full read instead of reading it again
+        self.data=self._read_h5_window()
+        self.close()
+      return self._data
+    @data.setter
+    def data(self, data):
+      self._data=self._compact_counts(data)
+      self._h5_source=None
+      MRDataset._summed_areas.pop(self, None)
+
+    def data_window(self, x_from=None, x_to=None, y_from=None, y_to=None):
+      '''
+      Return the counts of a region in x and y for all ToF channels.
+      '''
+      if self._data is None and self._h5_source is not None:
+        return self._read_h5_window(x_from, x_to, y_from, y_to)
+      return self._data[x_from:x_to, y_from:y_to, :]
+
+  # summed-area tables of the last datasets used for region sums
+  _summed_areas=OrderedDict()
+  _summed_area_lock=Lock()
+
+  def sum_region(self, x_from=None, x_to=None, y_from=None, y_to=None, sum_x=True):
+    '''
+    Return the counts of a region in x and y summed for each ToF channel.
+    Integer counts are summed using a summed-area table, created on first use,
+    so changing the region only needs a few operations per ToF channel.
+    
+    :param bool sum_x: If False only sum over y and return one spectrum for each x-pixel
+    '''
+    table=self._get_summed_area()
+    if table is None:
+      data=self.data_window(x_from, x_to, y_from, y_to).astype(float)
+      if sum_x:
+        return data.sum(axis=0).sum(axis=0)
+      return data.sum(axis=1)
+    x_start, x_stop, ignore=slice(x_from, x_to).indices(table.shape[0]-1)
+    y_start, y_stop, ignore=slice(y_from, y_to).indices(table.shape[1]-1)
+    x_stop=max(x_start, x_stop)
+    y_stop=max(y_start, y_stop)
+    # unsigned integer overflows cancel out in the differences
+    if sum_x:
+      result=(table[x_stop, y_stop]-table[x_start, y_stop]-
+              table[x_stop, y_start]+table[x_start, y_start])
+    else:
+      lines=table[x_start:x_stop+1, y_stop]-table[x_start:x_stop+1, y_start]
+      result=lines[1:]-lines[:-1]
+    return result.astype(float)
+
+  def _get_summed_area(self):
+    '''
+    Return the table of counts summed over x and y from the origin, with
+    an additional zero row and column in front, or None for non-integer or lazy data.
+    '''
+    if self._h5_source is not None:
+      return None
+    with MRDataset._summed_area_lock:
+      table=MRDataset._summed_areas.pop(self, None)
+    if table is None:
+      data=self.data
+      if data is None or data.dtype.kind not in 'iu':
+        return None
+      if data.sum()<2**32:
+        dtype=uint32
+      else:
+        dtype=int64
+      table=zeros((data.shape[0]+1, data.shape[1]+1, data.shape[2]), dtype=dtype)
+      cumsum(data, axis=0, dtype=dtype, out=table[1:, 1:])
+      cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    with MRDataset._summed_area_lock:
+      MRDataset._summed_areas[self]=table
+      while len(MRDataset._summed_areas)>MAX_SUMMED_AREA:
+        MRDataset._summed_areas.popitem(last=False)
+    return table
+
+  @staticmethod
+  def _compact_counts(data):
+    '''
+    Convert integer counts to the smallest unsigned integer type that can hold them.
+    Other data is returned unchanged.
+    '''
+    if data.dtype.kind not in 'iu' or data.size==0 or data.min()<0:
+      return data
+    max_count=data.max()
+    for dtype in [uint8, uint16, uint32]:
+      if max_count<=iinfo(dtype).max:
+        if data.dtype!=dtype:
+          data=data.astype(dtype)
+        return data
+    return data
+
+  @property
+  def xydata(self):
+    '''2D array of intensity projected on X-Y'''
+    if self._xydata is None:
+      counts=self.data
+      if counts is None:
+        return None
+      self._xydata=counts.sum(axis=2).transpose().astype(float)
+    elif self._xydata.dtype!=float:
+      self._xydata=self._xydata.astype(float)
+    return self._xydata
+  @xydata.setter
+  def xydata(self, data):
+    self._xydata=data
+
+  @property
+  def xtofdata(self):
+    '''2D array of intensity projected on X-ToF'''
+    if self._xtofdata is None:
+      counts=self.data
+      if counts is None:
+        return None
+      self._xtofdata=counts.sum(axis=1).astype(float)
+    elif self._xtofdata.dtype!=float:
+      self._xtofdata=self._xtofdata.astype(float)
+    return self._xtofdata
+  @xtofdata.setter
+  def xtofdata(self, data):
+    self._xtofdata=data
 
   ################## Properties for easy data access ##########################
   # return the size of the data stored in memory for this dataset
   @property
-  def nbytes(self): return (len(self._data_zipped)+
-                            self.xydata.nbytes+self.xtofdata.nbytes)
+  def nbytes(self):
+    if USE_COMPRESSION:
+      nbytes=sum([0]+[len(block) for block in (self._data_blocks or [])])
+    else:
+      nbytes=getattr(self._data, 'nbytes', 0)
+    return nbytes+getattr(self._xydata, 'nbytes', 0)+getattr(self._xtofdata, 'nbytes', 0)
   @property
   def rawbytes(self): return (self.data.nbytes+self.xydata.nbytes+self.xtofdata.nbytes)
 
-  if USE_COMPRESSION:
-    @property
-    def nbytes(self): return (len(self._data_zipped)+
-                              self.xydata.nbytes+self.xtofdata.nbytes)
-  else:
-    nbytes=rawbytes
-
   @property
   def xdata(self): return self.xydata.mean(axis=0)
 
@@ -1235,6 +2151,30 @@ class MRDataset(object):
     return AttributePloter(self, ['xdata', 'xydata', 'ydata', 'xtofdata', 'tofdata', 'data'])
 
 
+def _read_channel(args):
+  '''
+  Read one channel of a Nexus file, used as worker function for NXSData._read_channels_pooled.
+  
+  :param tuple args: Item index and tuple of filename, channel, read options and total duration
+  
+  :returns: item index and MRDataset object or None if there are no counts in the channel
+  '''
+  i, (filename, channel, read_options, total_duration)=args
+  nxs=h5py.File(filename, mode='r')
+  try:
+    raw_data=nxs[channel]
+    if filename.endswith('event.nxs'):
+      data=MRDataset.from_event(raw_data, read_options,
+                                tof_overwrite=read_options['event_tof_overwrite'],
+                                total_duration=total_duration)
+    elif filename.endswith('histo.nxs'):
+      data=MRDataset.from_histogram(raw_data, read_options)
+    else:
+      data=MRDataset.from_old_format(raw_data, read_options)
+  finally:
+    nxs.close()
+  return i, data
+
 def time_from_header(filename, nxs=None):
   '''
   Read just an nxs header to get the time of a measurement in seconds.
@@ -1291,6 +2231,78 @@ def locate_file(number, histogram=True, old_format=False, verbose=True):
     else:
       return None
 
+def create_sensitivity(dataset):
+  '''
+  Create a detector sensitivity map I(x,y) from a flood field measurement,
+  normalized to a mean of one. Pixels without counts are not corrected.
+  
+  :param quicknxs.qreduce.MRDataset dataset: Flood field dataset
+  '''
+  Isens=dataset.xydata.transpose().astype(float)
+  Isens/=Isens[Isens>0].mean()
+  Isens[Isens<=0]=1.
+  return Isens
+
+def save_sensitivity(name, Isens, path=None):
+  '''
+  Store a detector sensitivity map as binary .npy file in the sensitivity folder
+  to be used with the sensitivity_correction=name option of Reflectivity.
+  
+  :param str name: Name of the map
+  :param numpy.ndarray Isens: Sensitivity map I(x,y)
+  :param str path: Folder to store the map in, defaults to instrument.sensitivity_path
+  '''
+  if path is None:
+    path=instrument.sensitivity_path
+  if not os.path.exists(path):
+    os.makedirs(path)
+  Isens=asarray(Isens, dtype=float)
+  # write to a temporary file first so other processes never load partial maps
+  fd, tmp_name=tempfile.mkstemp(suffix='.npy', dir=path)
+  try:
+    with os.fdopen(fd, 'wb') as fh:
+      save(fh, Isens)
+    os.rename(tmp_name, os.path.join(path, name+'.npy'))
+  except:
+    os.remove(tmp_name)
+    raise
+  DETECTOR_SENSITIVITY[name]=Isens
+
+def load_sensitivity(name, path=None):
+  '''
+  Load a detector sensitivity map stored with save_sensitivity.
+  Returns None if no map with this name exists.
+  
+  :param str name: Name of the map
+  :param str path: Folder of the maps, defaults to instrument.sensitivity_path
+  '''
+  if path is None:
+    path=instrument.sensitivity_path
+  filename=os.path.join(path, name+'.npy')
+  if not os.path.exists(filename):
+    return None
+  debug('Loading sensitivity map %s'%filename)
+  Isens=load(filename)
+  DETECTOR_SENSITIVITY[name]=Isens
+  return Isens
+
+def _points_in_polygon(px, py, polygon):
+  '''
+  Return a boolean array marking the points (px, py) inside a polygon given as
+  list of (x, y) vertices. Uses the same crossing test as matplotlib.path.Path.contains_points,
+  so points on the polygon edges are treated the same way.
+  '''
+  inside=zeros(px.shape, dtype=bool)
+  vertices=[(float(x), float(y)) for x, y in polygon]
+  for (vtx0, vty0), (vtx1, vty1) in zip(vertices, vertices[1:]+vertices[:1]):
+    yflag0=(vty0>=py)
+    yflag1=(vty1>=py)
+    # the edge crosses the +x ray of the point if it ends on both sides
+    # of the point in y and the intersection is right of the point
+    crossing=(yflag0!=yflag1)&((((vty1-py)*(vtx0-vtx1))>=((vtx1-px)*(vty0-vty1)))==yflag1)
+    inside^=crossing
+  return inside
+
 class Reflectivity(object):
   """
   Extraction of reflectivity from MRDatatset object storing all data
@@ -1322,6 +2334,7 @@ class Reflectivity(object):
        gisans_gridy=50,
        gisans_gridz=50,
        gisans_no_DP=True,
+       gisans_lean=False,
        )
   _OPTIONS_DESCRTIPTION=dict(
        x_pos='X-pixel position of the reflected beam on the detector',
@@ -1340,17 +2353,60 @@ class Reflectivity(object):
        bg_poly_regions='use polygon regions in x/λ to determine which points to use for the background',
        bg_scale_xfit='use a linear fit on x-axes projection to scale the background',
        bg_scale_factor='scale the background by this constant before subtraction',
-       sensitivity_correction='Detector sensitivity correction to be used',
+       sensitivity_correction='Detector sensitivity correction to be used, polynomial or the name of a stored map',
        P0='Number of points to remove from the low-Q side of the reflectivity',
        PN='Number of points to remove from the high-Q side of the reflectivity',
        number='Index of the origin dataset used for naming etc. when exported',
        gisans_gridy='When extracting GISANS data, this is the number of pixels in Qz',
        gisans_gridz='When extracting GISANS data, this is the number of pixels in Qy',
        gisans_no_DP='Remove the ToF bin which contains the direct pulse background',
+       gisans_lean='Only keep the intensities and calculate Q when needed to reduce memory usage',
        )
 
+  # masks of the last polygon background regions used
+  _bg_masks=OrderedDict()
+  _bg_mask_lock=Lock()
+
   @log_input
   def __init__(self, dataset, **options):
+    self._init_options(dataset, options)
+    if self.options['extract_fan'] and self.options['normalization'] is not None:
+      self._calc_fan(dataset)
+    else:
+      self._calc_normal(dataset)
+
+  @classmethod
+  @log_call
+  def from_channels(cls, data, channels=None, **options):
+    '''
+    Extract the reflectivity of several channels of one file with the same options.
+    Angles, wavelength, Q and resolution are calculated only once for all
+    channels with the same geometry and the reflectivity of these channels
+    is calculated as one array.
+    Returns a list of objects equal to the ones created for each channel separately.
+    
+    :param quicknxs.qreduce.NXSData data: The file data to use for extraction
+    :param list channels: Names or indices of the channels to use, defaults to all
+    '''
+    if channels is None:
+      channels=range(len(data))
+    datasets=[data[channel] for channel in channels]
+    if cls is not Reflectivity or (options.get('extract_fan', False) and
+                                   options.get('normalization', None) is not None):
+      return [cls(dataset, **options) for dataset in datasets]
+    output=[]
+    groups=OrderedDict()
+    for dataset in datasets:
+      refl=cls.__new__(cls)
+      refl._init_options(dataset, options)
+      output.append(refl)
+      groups.setdefault(refl._geometry_key(dataset), []).append((refl, dataset))
+    for items in groups.values():
+      cls._calc_normal_channels([item[0] for item in items],
+                                [item[1] for item in items])
+    return output
+
+  def _init_options(self, dataset, options):
     all_options=dict(Reflectivity.DEFAULT_OPTIONS)
     for key, value in options.items():
       if not key in all_options:
@@ -1372,10 +2428,14 @@ class Reflectivity(object):
                 (dataset.slit2_width, dataset.slit2_dist),
                 (dataset.slit3_width, dataset.slit3_dist)]
 
-    if all_options['extract_fan'] and all_options['normalization'] is not None:
-      self._calc_fan(dataset)
-    else:
-      self._calc_normal(dataset)
+  def _geometry_key(self, dataset):
+    '''
+    Values defining the angles and wavelengths of the extracted reflectivity.
+    '''
+    return (self.options['x_pos'], self.options['tth'], self.options['dpix'],
+            tuple(self.slits), dataset.det_size_x, dataset.dist_sam_det,
+            dataset.dist_mod_det, dataset.xydata.shape[1],
+            dataset.tof_edges.tostring())
 
   def __repr__(self):
     if type(self.origin) is list:
@@ -1436,21 +2496,54 @@ class Reflectivity(object):
     return StringRepr('self.options='+repr(self.options), output)
 
 
+  def _get_region(self, dataset, x_from, x_to, y_from, y_to):
+    '''
+    Return the sensitivity corrected intensity of a pixel region for all ToF channels.
+    Only the data of this region is decompressed and corrected.
+    '''
+    data=dataset.data_window(x_from, x_to, y_from, y_to).astype(float)
+    if self.options['sensitivity_correction'] is None:
+      return data
+    Isens=self._get_sensitivity(dataset)
+    return data/Isens[x_from:x_to, y_from:y_to, newaxis]
+
+  def _sum_region(self, dataset, x_from, x_to, y_from, y_to, sum_x=True):
+    '''
+    Return the sensitivity corrected intensity of a pixel region summed over y
+    and, if sum_x is True, over x for all ToF channels.
+    '''
+    if self.options['sensitivity_correction'] is None:
+      return dataset.sum_region(x_from, x_to, y_from, y_to, sum_x)
+    data=self._get_region(dataset, x_from, x_to, y_from, y_to)
+    if sum_x:
+      return data.sum(axis=0).sum(axis=0)
+    return data.sum(axis=1)
+
   @log_call
-  def _correct_sensitivity(self, data):
-    if self.options['sensitivity_correction'] in DETECTOR_SENSITIVITY:
-      return data/DETECTOR_SENSITIVITY[self.options['sensitivity_correction']][:, :, newaxis]
-    elif self.options['sensitivity_correction']=='polynomial':
+  def _get_sensitivity(self, dataset):
+    '''
+    Return the detector sensitivity map I(x,y) selected by the sensitivity_correction option.
+    Maps are generated (polynomial) or loaded from the sensitivity_path on first use.
+    '''
+    name=self.options['sensitivity_correction']
+    shape=dataset.xydata.shape[::-1]
+    if name in DETECTOR_SENSITIVITY:
+      Isens=DETECTOR_SENSITIVITY[name]
+    elif name=='polynomial':
       # use polynomial form to generate sensitivity map
-      X, Y=meshgrid(arange(data.shape[0]), arange(data.shape[1]))
+      X, Y=meshgrid(arange(shape[0]), arange(shape[1]))
       X, Y=X.T.astype(float), Y.T.astype(float)
       ax, ay, bx, by, c=POLY_CORR_PARAMS
       Isens=ax*X**2+ay*Y**2+bx*X+by*Y+c
       Isens/=Isens.mean()
-      DETECTOR_SENSITIVITY[self.options['sensitivity_correction']]=Isens
-      return data/Isens[:, :, newaxis]
+      DETECTOR_SENSITIVITY[name]=Isens
     else:
-      raise NotImplementedError, 'sensitivity correction %s not known'%self.options['sensitivity_correction']
+      Isens=load_sensitivity(name)
+      if Isens is None:
+        raise NotImplementedError, 'sensitivity correction %s not known'%name
+    if Isens.shape!=shape:
+      raise ValueError, 'sensitivity map %s has shape %s, data has %s'%(name, Isens.shape, shape)
+    return Isens
 
   #############################################################################
 
@@ -1466,15 +2559,29 @@ class Reflectivity(object):
     
     :param quicknxs.qreduce.MRDataset dataset: The dataset to use for extraction
     """
+    self._calc_normal_channels([self], [dataset])
+
+  @staticmethod
+  def _calc_normal_channels(refls, datasets):
+    """
+    Extract the reflectivity of several datasets sharing the same options and
+    geometry, see _calc_normal. Values independent of the intensity are only
+    calculated once and the intensities are processed as one array with
+    one row per dataset.
+    
+    :param list refls: Reflectivity objects to store the results in
+    :param list datasets: The datasets to use for extraction
+    """
+    first=refls[0]
+    options=first.options
+    dataset=datasets[0]
     tof_edges=dataset.tof_edges
-    data=dataset.data
-    if self.options['sensitivity_correction'] is not None:
-      data=self._correct_sensitivity(data)
-    x_pos=self.options['x_pos']
-    x_width=self.options['x_width']
-    y_pos=self.options['y_pos']
-    y_width=self.options['y_width']
-    scale=1./dataset.proton_charge # scale by user factor
+    x_pos=options['x_pos']
+    x_width=options['x_width']
+    y_pos=options['y_pos']
+    y_width=options['y_width']
+    # scale by user factor, one row per dataset
+    scale=array([1./item.proton_charge for item in datasets])[:, newaxis]
 
     # Get regions in pixels as integers
     reg=map(lambda item: int(round(item)),
@@ -1484,62 +2591,81 @@ class Reflectivity(object):
 
     # get incident angle of reflected beam
     rad_per_pixel=dataset.det_size_x/dataset.dist_sam_det/dataset.xydata.shape[1]
-    relpix=self.options['dpix']-x_pos
-    tth=(self.options['tth']*pi/180.+relpix*rad_per_pixel)
-    self.ai=tth/2.
+    relpix=options['dpix']-x_pos
+    tth=(options['tth']*pi/180.+relpix*rad_per_pixel)
+    ai=tth/2.
+    first.ai=ai
     # calculate resolution from slits, sample size and incident angle
-    dai=self.get_resolution()
-    debug('alpha_i=%s+/-%s'%(self.ai, dai))
+    dai=first.get_resolution()
+    debug('alpha_i=%s+/-%s'%(ai, dai))
 
-    self._calc_bg(dataset)
+    for refl, item in zip(refls, datasets):
+      refl.ai=ai
+      refl._calc_bg(item)
 
-    # restrict the intensity and background data to the given regions
-    Idata=data[reg[0]:reg[1], reg[2]:reg[3], :]
     # calculate region size for later use
     size_I=float((reg[3]-reg[2])*(reg[1]-reg[0]))
     # calculate ROI intensities and normalize by number of points
-    self.Iraw=Idata.sum(axis=0).sum(axis=0)
-    self.I=self.Iraw/(size_I/scale)
-    self.dIraw=sqrt(self.Iraw)
-    self.dI=self.dIraw/(size_I/scale)
-    debug("Intensity scale is %s/%s=%s"%(scale, size_I, scale/size_I))
+    Iraw=array([refl._sum_region(item, reg[0], reg[1], reg[2], reg[3])
+                for refl, item in zip(refls, datasets)])
+    I=Iraw/(size_I/scale)
+    dIraw=sqrt(Iraw)
+    dI=dIraw/(size_I/scale)
+    debug("Intensity scale is %s/%s=%s"%(scale[:, 0], size_I, scale[:, 0]/size_I))
 
     v_edges=dataset.dist_mod_det/tof_edges*1e6 #m/s
     lamda_edges=H_OVER_M_NEUTRON/v_edges*1e10 #A
     # store the ToF as well for comparison etc.
-    self.tof=(tof_edges[:-1]+tof_edges[1:])/2. # µs
-    self.lamda=(lamda_edges[:-1]+lamda_edges[1:])/2.
+    tof=(tof_edges[:-1]+tof_edges[1:])/2. # µs
+    lamda=(lamda_edges[:-1]+lamda_edges[1:])/2.
     # resolution for lambda is digital range with equal probability
     # therefore it is the bin size divided by sqrt(12)
-    self.dlamda=abs(lamda_edges[:-1]-lamda_edges[1:])/sqrt(12)
+    dlamda=abs(lamda_edges[:-1]-lamda_edges[1:])/sqrt(12)
 
     # for reflectivity use Q as x
-    self.Q=4.*pi/self.lamda*sin(self.ai)
+    Q=4.*pi/lamda*sin(ai)
     # error propagation from lambda and angular resolution
-    self.dQ=4*pi*sqrt((self.dlamda/self.lamda**2*sin(self.ai))**2+
-                      (cos(self.ai)*dai/self.lamda)**2)
-    debug("Q=%s"%repr(self.Q))
+    dQ=4*pi*sqrt((dlamda/lamda**2*sin(ai))**2+
+                      (cos(ai)*dai/lamda)**2)
+    debug("Q=%s"%repr(Q))
     # finally scale reflectivity by the given factor and beam width
-    self.Rraw=(self.I-self.BG) # used for normalization files
-    self.dRraw=sqrt(self.dI**2+self.dBG**2)
-    if self.ai>0.0002:
-      sin_scale=0.005/sin(self.ai) # scale by beam-footprint
+    BG=array([refl.BG for refl in refls])
+    dBG=array([refl.dBG for refl in refls])
+    Rraw=(I-BG) # used for normalization files
+    dRraw=sqrt(dI**2+dBG**2)
+    if ai>0.0002:
+      sin_scale=0.005/sin(ai) # scale by beam-footprint
     else:
       sin_scale=1.
-    self.R=sin_scale*self.options['scale']*self.Rraw
-    self.dR=sin_scale*self.options['scale']*self.dRraw
+    R=sin_scale*options['scale']*Rraw
+    dR=sin_scale*options['scale']*dRraw
 
-    if self.options['normalization']:
-      norm=self.options['normalization']
+    if options['normalization']:
+      norm=options['normalization']
       debug("Performing normalization from %s"%norm)
       idxs=norm.Rraw>0.
-      self.dR[idxs]=sqrt(
-                   (self.dR[idxs]/norm.Rraw[idxs])**2+
-                   (self.R[idxs]/norm.Rraw[idxs]**2*norm.dRraw[idxs])**2
+      dR[:, idxs]=sqrt(
+                   (dR[:, idxs]/norm.Rraw[idxs])**2+
+                   (R[:, idxs]/norm.Rraw[idxs]**2*norm.dRraw[idxs])**2
                    )
-      self.R[idxs]/=norm.Rraw[idxs]
-      self.R[logical_not(idxs)]=0.
-      self.dR[logical_not(idxs)]=0.
+      R[:, idxs]/=norm.Rraw[idxs]
+      R[:, logical_not(idxs)]=0.
+      dR[:, logical_not(idxs)]=0.
+
+    for i, refl in enumerate(refls):
+      refl.Iraw=Iraw[i]
+      refl.I=I[i]
+      refl.dIraw=dIraw[i]
+      refl.dI=dI[i]
+      refl.Rraw=Rraw[i]
+      refl.dRraw=dRraw[i]
+      refl.R=R[i]
+      refl.dR=dR[i]
+      refl.tof=tof.copy()
+      refl.lamda=lamda.copy()
+      refl.dlamda=dlamda.copy()
+      refl.Q=Q.copy()
+      refl.dQ=dQ.copy()
 
   @log_call
   def _calc_fan(self, dataset):
@@ -1556,9 +2682,6 @@ class Reflectivity(object):
     :param quicknxs.qreduce.MRDataset dataset: The dataset to use for extraction
     """
     tof_edges=dataset.tof_edges
-    data=dataset.data
-    if self.options['sensitivity_correction'] is not None:
-      data=self._correct_sensitivity(data)
     x_pos=self.options['x_pos']
     x_width=self.options['x_width']
     y_pos=self.options['y_pos']
@@ -1571,7 +2694,6 @@ class Reflectivity(object):
     debug('Reflectivity region: %s'%str(reg))
 
     rad_per_pixel=dataset.det_size_x/dataset.dist_sam_det/dataset.xydata.shape[1]
-    Idata=data[reg[0]:reg[1], reg[2]:reg[3], :]
     x_region=arange(reg[0], reg[1])
     relpix=self.options['dpix']-x_region
     tth=(self.options['tth']*pi/180.+relpix*rad_per_pixel)
@@ -1593,7 +2715,7 @@ class Reflectivity(object):
 
     # calculate ROI intensities and normalize by number of points
     # still keeping it as 2D dataset
-    self.Iraw=Idata.sum(axis=1)
+    self.Iraw=self._sum_region(dataset, reg[0], reg[1], reg[2], reg[3], sum_x=False)
     I=self.Iraw/(reg[3]-reg[2])*scale
     self.dIraw=sqrt(self.Iraw)
     dI=self.dIraw/(reg[3]-reg[2])*scale
@@ -1626,49 +2748,65 @@ class Reflectivity(object):
     #Qz_start=Qz_edges[0,-1]
     Qz_start=Qz_edges[0, where(norm.Rraw>0)[0][-1]]
     Qz_end=Qz_edges[-1, where(norm.Rraw>0)[0][0]]
-    Q=[]
-    dQ=[]
-    Rsum=[]
-    ddRsum=[]
     Qz_edges_first=Qz_edges[0]
     Qz_edges_last=Qz_edges[-1]
     lines=range(Qz_edges.shape[0])
     ddR=dR**2
-    for Qz_bin_low in reversed(Qz_edges_first[(Qz_edges_first<=Qz_end)&(Qz_edges_first>=Qz_start)]):
-      # create a bin where at least one point from every
-      # line is present
-      try:
-        # at least one point at the end can't be made into a bin this way
-        Qz_bin_high=Qz_edges_last[Qz_edges_last>=Qz_bin_low][-2]
-      except IndexError:
-        break
-      Q.append((Qz_bin_high+Qz_bin_low)/2.)
-      # error is calculated from the relative binning size and angle resolutions
-      dQ_rel=(Qz_bin_high-Qz_bin_low)/sqrt(12.)/Q[-1]
-      dQ.append(sqrt(dQ_rel**2+dai_rel**2)*Q[-1])
-      Rsumi=[]
-      ddRsumi=[]
-      for line in lines:
-        # each line is treated equally in weight but there can be more than
-        # one point per line in the same bin, so these are averaged
-        select=(Qz_centers[line]>=Qz_bin_low)&(Qz_centers[line]<=Qz_bin_high)
-        Rselect=R[line, select]
-        ddRselect=ddR[line, select]
-        Rsumi.append(Rselect.sum()/len(Rselect))
-        ddRsumi.append(ddRselect.sum()/len(Rselect)**2)
-      Rsum.append(array(Rsumi).sum())
-      ddRsum.append(array(ddRsumi).sum())
-
-    # sort the lists according to the default order from normal readout
-    # and store them as numpy arrays
-    Q.reverse()
-    dQ.reverse()
-    Rsum.reverse()
-    ddRsum.reverse()
-    self.dQ=array(dQ)
-    self.Q=array(Q)
-    self.R=array(Rsum)/len(lines)
-    self.dR=sqrt(array(ddRsum))/len(lines)
+    # lower bin edges in increasing order, the upper edge of each bin is
+    # the second to last edge of the last line above the lower one
+    Qz_bins_low=Qz_edges_first[(Qz_edges_first<=Qz_end)&(Qz_edges_first>=Qz_start)][::-1]
+    above=Qz_edges_last[newaxis, :]>=Qz_bins_low[:, newaxis]
+    n_above=above.sum(axis=1)
+    if (n_above<2).any():
+      # at least one point at the end can't be made into a bin this way
+      nbins=argmax(n_above<2)
+      Qz_bins_low=Qz_bins_low[:nbins]
+      above=above[:nbins]
+      n_above=n_above[:nbins]
+    high_idx=argmax(above&(above.cumsum(axis=1)==(n_above-1)[:, newaxis]), axis=1)
+    Qz_bins_high=Qz_edges_last[high_idx]
+    nbins=len(Qz_bins_low)
+    nlines=len(lines)
+
+    # find the range of points of each line inside each bin, as the bins
+    # overlap the same point can be part of two neighboring bins
+    order=argsort(Qz_centers, axis=1)
+    start=zeros((nbins, nlines), dtype=int)
+    stop=zeros((nbins, nlines), dtype=int)
+    for line in lines:
+      Qz_sorted=Qz_centers[line, order[line]]
+      start[:, line]=searchsorted(Qz_sorted, Qz_bins_low, side='left')
+      stop[:, line]=searchsorted(Qz_sorted, Qz_bins_high, side='right')
+    counts=(stop-start).flatten()
+    # list all (bin, line, point) combinations, grouped by bin and line
+    groups=repeat(arange(nbins*nlines), counts)
+    group_start=repeat(counts.cumsum()-counts, counts)
+    line_idx=groups%nlines
+    point_idx=order[line_idx, repeat(start.flatten(), counts)+arange(counts.sum())-group_start]
+    # sum the points of each group in their original order
+    sort_idx=lexsort((point_idx, groups))
+    groups=groups[sort_idx]
+    line_idx=line_idx[sort_idx]
+    point_idx=point_idx[sort_idx]
+    # each line is treated equally in weight but there can be more than
+    # one point per line in the same bin, so these are averaged
+    Rsumi=bincount(groups, weights=R[line_idx, point_idx],
+                   minlength=nbins*nlines)/counts
+    ddRsumi=bincount(groups, weights=ddR[line_idx, point_idx],
+                     minlength=nbins*nlines)/counts**2
+    Rsum=Rsumi.reshape(nbins, nlines).sum(axis=1)
+    ddRsum=ddRsumi.reshape(nbins, nlines).sum(axis=1)
+
+    Q=(Qz_bins_high+Qz_bins_low)/2.
+    # error is calculated from the relative binning size and angle resolutions
+    dQ_rel=(Qz_bins_high-Qz_bins_low)/sqrt(12.)/Q
+    dQ=sqrt(dQ_rel**2+dai_rel**2)*Q
+
+    # sort the arrays according to the default order from normal readout
+    self.dQ=dQ[::-1].copy()
+    self.Q=Q[::-1].copy()
+    self.R=Rsum[::-1]/len(lines)
+    self.dR=sqrt(ddRsum[::-1])/len(lines)
 
   @log_call
   def _calc_bg(self, dataset):
@@ -1678,9 +2816,6 @@ class Reflectivity(object):
     
     :param quicknxs.qreduce.MRDataset dataset: The dataset to use for extraction
     '''
-    data=dataset.data
-    if self.options['sensitivity_correction'] is not None:
-      data=self._correct_sensitivity(data)
     y_pos=self.options['y_pos']
     y_width=self.options['y_width']
     bg_pos=self.options['bg_pos']
@@ -1698,33 +2833,9 @@ class Reflectivity(object):
     if bg_poly:
       # create the background region from given polygons
       # for ToF channels without polygon region the normal positions are use
-      import matplotlib
-      x=dataset.x
-      lamda=dataset.lamda
-      X, Lamda=meshgrid(x, lamda)
-      points=vstack([Lamda.flatten(), X.flatten()]).transpose()
-      points_in_region=zeros(X.shape, dtype=bool).flatten()
-      # matplotlib 1.2 deprecates nxutils and 1.3 removes it
-      if matplotlib.__version__>='1.2':
-        debug('Using matplotlib.path for polygon checking')
-        from matplotlib.path import Path
-        for poly in bg_poly:
-          poly_path=Path(poly)
-          points_in_region|=poly_path.contains_points(points)
-      else:
-        debug('Using matplotlib.nxutils for polygon checking')
-        from matplotlib.nxutils import points_inside_poly #@UnresolvedImport
-        for poly in bg_poly:
-          points_in_region|=points_inside_poly(points, poly)
-      points_in_region=points_in_region.reshape(X.shape)
-      lamda_regions=unique(Lamda[points_in_region].flatten())
-      # add missing lambda items from normal bg region
-      for lamdai in lamda:
-        if not lamdai in lamda_regions:
-          points_in_region[:, reg[0]:reg[1]]|=(Lamda[:, reg[0]:reg[1]]==lamdai)
-      points_in_region=points_in_region.astype(float)
+      points_in_region=self._get_bg_mask(bg_poly, dataset.x, dataset.lamda, reg[0], reg[1])
       # sum over y
-      bgydata=data[:, reg[2]:reg[3], :].sum(axis=1).transpose()
+      bgydata=self._sum_region(dataset, None, None, reg[2], reg[3], sum_x=False).transpose()
       # sum over x in the given region and devide by number of x-points used
       unscaled_bgdata=(bgydata*points_in_region).sum(axis=1)
       scaling_data=points_in_region.sum(axis=1)*float(reg[3]-reg[2])
@@ -1732,12 +2843,10 @@ class Reflectivity(object):
       self.dBGraw=sqrt(unscaled_bgdata)/scaling_data*scale
       debug("Background scale is %s"%(scale/scaling_data))
     else:
-      # restrict the intensity and background data to the given regions
-      bgdata=data[reg[0]:reg[1], reg[2]:reg[3], :]
       # calculate region size for later use
       size_BG=float((reg[3]-reg[2])*(reg[1]-reg[0]))
       # calculate ROI intensities and normalize by number of points
-      self.BGraw=bgdata.sum(axis=0).sum(axis=0)
+      self.BGraw=self._sum_region(dataset, reg[0], reg[1], reg[2], reg[3])
       self.dBGraw=sqrt(self.BGraw)/(size_BG/scale)
       self.BGraw/=size_BG/scale
       debug("Background scale is %s"%(scale/size_BG))
@@ -1765,6 +2874,37 @@ class Reflectivity(object):
     self.BG*=self.options['bg_scale_factor']
     self.dBG*=self.options['bg_scale_factor']
 
+  @classmethod
+  def _get_bg_mask(cls, bg_poly, x, lamda, x_from, x_to):
+    '''
+    Return the float mask of points in the x/λ plane used for the background,
+    which are all points inside the polygons and the x-range from x_from to x_to
+    for wavelengths without polygon region.
+    Masks are cached for the last used polygons and grids.
+    '''
+    key=(tuple([tuple(map(tuple, poly)) for poly in bg_poly]),
+         x.tostring(), lamda.tostring(), x_from, x_to)
+    with cls._bg_mask_lock:
+      if key in cls._bg_masks:
+        mask=cls._bg_masks.pop(key)
+        cls._bg_masks[key]=mask
+        return mask
+    X, Lamda=meshgrid(x, lamda)
+    points_in_region=zeros(X.shape, dtype=bool)
+    for poly in bg_poly:
+      points_in_region|=_points_in_polygon(Lamda, X, poly)
+    lamda_regions=unique(Lamda[points_in_region].flatten())
+    # add missing lambda items from normal bg region
+    missing=logical_not(in1d(lamda, lamda_regions))
+    points_in_region[missing, x_from:x_to]=True
+    mask=points_in_region.astype(float)
+    mask.flags.writeable=False
+    with cls._bg_mask_lock:
+      cls._bg_masks[key]=mask
+      while len(cls._bg_masks)>MAX_BG_MASKS:
+        cls._bg_masks.popitem(last=False)
+    return mask
+
   def rescale(self, scaling):
     old_scale=self.options['scale']
     rescale=scaling/old_scale
@@ -1847,9 +2987,6 @@ class OffSpecular(Reflectivity):
     :param quicknxs.qreduce.MRDataset dataset: The dataset to use for extraction
     """
     tof_edges=dataset.tof_edges
-    data=dataset.data
-    if self.options['sensitivity_correction'] is not None:
-      data=self._correct_sensitivity(data)
     x_pos=self.options['x_pos']
     x_width=self.options['x_width']
     y_pos=self.options['y_pos']
@@ -1863,8 +3000,8 @@ class OffSpecular(Reflectivity):
     debug('Off-Specular region: %s'%str(reg))
 
     rad_per_pixel=dataset.det_size_x/dataset.dist_sam_det/dataset.xydata.shape[1]
-    xtth=self.options['dpix']-arange(data.shape[0])[dataset.active_area_x[0]:
-                                                    dataset.active_area_x[1]]
+    xtth=self.options['dpix']-arange(dataset.xydata.shape[1])[dataset.active_area_x[0]:
+                                                              dataset.active_area_x[1]]
     pix_offset_spec=self.options['dpix']-x_pos
     tth_spec=self.options['tth']*pi/180.+pix_offset_spec*rad_per_pixel
     af=self.options['tth']*pi/180.+xtth*rad_per_pixel-tth_spec/2.
@@ -1891,8 +3028,8 @@ class OffSpecular(Reflectivity):
     self.kf_z=k[newaxis, :]*sin(af)[:, newaxis]
 
     # calculate ROI intensities and normalize by number of points
-    Idata=data[dataset.active_area_x[0]:dataset.active_area_x[1], reg[2]:reg[3], :]
-    self.Iraw=Idata.sum(axis=1)
+    self.Iraw=self._sum_region(dataset, dataset.active_area_x[0], dataset.active_area_x[1],
+                               reg[2], reg[3], sum_x=False)
     self.dIraw=sqrt(self.Iraw)
     # normalize data by width in y and multiply scaling factor
     debug("Intensity scale is %s*%s=%s"%(scale/(reg[3]-reg[2]),
@@ -1950,39 +3087,48 @@ class GISANS(Reflectivity):
   def __repr__(self):
     if type(self.origin) is list:
       fnames='+'.join([os.path.basename(item[0]) for item in self.origin])
-      output='<OffSpecular[%i] "%s/%s"'%(len(self.Qz), fnames,
+      output='<OffSpecular[%i] "%s/%s"'%(len(self.S), fnames,
                                         self.origin[0][1])
     else:
-      output='<OffSpecular[%i] "%s/%s"'%(len(self.Qz), os.path.basename(self.origin[0]),
+      output='<OffSpecular[%i] "%s/%s"'%(len(self.S), os.path.basename(self.origin[0]),
                                         self.origin[1])
     if self.options['normalization'] is None:
       output+=' NOT normalized'
     output+='>'
     return output
 
+  def get_Qyz(self, columns=slice(None)):
+    '''
+    Return Qy and Qz of the given ToF columns of S. In lean mode they are
+    calculated from the stored factors as the full arrays are not kept.
+    '''
+    if self.options['gisans_lean']:
+      k=self._k[newaxis, newaxis, columns]
+      Qy=k*self._qy_factor[:, :, newaxis]
+      Qz=k*self._pi_factor[:, :, newaxis]+k*self._pf_factor[:, :, newaxis]
+      return Qy, Qz
+    return self.Qy[:, :, columns], self.Qz[:, :, columns]
+
   @log_call
   def _calc_gisans(self, dataset):
     """
     :param quicknxs.qreduce.MRDataset dataset: The dataset to use for extraction
     """
     tof_edges=dataset.tof_edges
-    data=dataset.data
-    if self.options['sensitivity_correction'] is not None:
-      data=self._correct_sensitivity(data)
     x_pos=self.options['x_pos']
     y_pos=self.options['y_pos']
     # create a nicer intensity scale by multiplying with the reflectiviy extraction region
     scale=self.options['scale']/dataset.proton_charge # scale by user factor
 
     rad_per_pixel=dataset.det_size_x/dataset.dist_sam_det/dataset.xydata.shape[1]
-    xtth=self.options['dpix']-arange(data.shape[0])[dataset.active_area_x[0]:
-                                                    dataset.active_area_x[1]]
+    xtth=self.options['dpix']-arange(dataset.xydata.shape[1])[dataset.active_area_x[0]:
+                                                              dataset.active_area_x[1]]
     pix_offset_spec=self.options['dpix']-x_pos
     tth_spec=self.options['tth']*pi/180.+pix_offset_spec*rad_per_pixel
     af=self.options['tth']*pi/180.+xtth*rad_per_pixel-tth_spec/2.
     ai=ones_like(af)*tth_spec/2.
-    phi=(arange(data.shape[1])[dataset.active_area_y[0]:
-                               dataset.active_area_y[1]]-y_pos)*rad_per_pixel
+    phi=(arange(dataset.xydata.shape[0])[dataset.active_area_y[0]:
+                                         dataset.active_area_y[1]]-y_pos)*rad_per_pixel
     debug('alpha_i=%s'%(tth_spec/2.))
 
     v_edges=dataset.dist_mod_det/tof_edges*1e6 #m/s
@@ -1998,30 +3144,55 @@ class GISANS(Reflectivity):
     # calculate ROI intensities and normalize by number of points
     P0=len(self.tof)-self.options['P0']
     PN=self.options['PN']
-    Idata=data[dataset.active_area_x[0]:dataset.active_area_x[1],
-               dataset.active_area_y[0]:dataset.active_area_y[1],
-               PN:P0]
+    Idata=self._get_region(dataset, dataset.active_area_x[0], dataset.active_area_x[1],
+                           dataset.active_area_y[0], dataset.active_area_y[1])[:, :, PN:P0]
+    k=k[PN:P0]
+    if self.options['normalization']:
+      norm=self.options['normalization']
+      normR=norm.Rraw[PN:P0]
+      normdR=norm.dRraw[PN:P0]
+    if self.options['gisans_no_DP']:
+      fast_n_tof=[i*1.0e6/60. for i in range(4)]
+      tof_edges=dataset.tof_edges[PN:P0]
+      fresult=(tof_edges[1:]<fast_n_tof[0])|(tof_edges[:-1]>fast_n_tof[0])
+      for fnt in fast_n_tof[1:]:
+        fresult&=(tof_edges[1:]<fnt)|(tof_edges[:-1]>fnt)
+      fidx=where(fresult)[0]
+      # apply filtering before any other array is created
+      Idata=Idata[:, :, fidx]
+      k=k[fidx]
+      if self.options['normalization']:
+        normR=normR[fidx]
+        normdR=normdR[fidx]
     # calculate reciprocal space, incident and outgoing perpendicular wave vectors
-    self.Qx=k[newaxis, newaxis, PN:P0]*(cos(phi)*cos(af)[:, newaxis]-cos(ai)[:, newaxis])[:, :, newaxis]
-    self.Qy=k[newaxis, newaxis, PN:P0]*(sin(phi)*cos(af)[:, newaxis])[:, :, newaxis]
-    self.pi=k[newaxis, newaxis, PN:P0]*((0*phi)+sin(ai)[:, newaxis])[:, :, newaxis]
-    self.pf=k[newaxis, newaxis, PN:P0]*((0*phi)+sin(af)[:, newaxis])[:, :, newaxis]
-    self.Qz=self.pi+self.pf
-
-    self.Iraw=Idata
-    self.dIraw=sqrt(self.Iraw)
-    # normalize data by width in y and multiply scaling factor
-    self.I=self.Iraw*scale
-    self.dI=self.dIraw*scale
+    # as k times a factor depending on the pixel position
+    self._k=k
+    self._qy_factor=sin(phi)*cos(af)[:, newaxis]
+    self._pi_factor=(0*phi)+sin(ai)[:, newaxis]
+    self._pf_factor=(0*phi)+sin(af)[:, newaxis]
+    if not self.options['gisans_lean']:
+      self.Qx=k[newaxis, newaxis, :]*(cos(phi)*cos(af)[:, newaxis]-cos(ai)[:, newaxis])[:, :, newaxis]
+      self.Qy=k[newaxis, newaxis, :]*self._qy_factor[:, :, newaxis]
+      self.pi=k[newaxis, newaxis, :]*self._pi_factor[:, :, newaxis]
+      self.pf=k[newaxis, newaxis, :]*self._pf_factor[:, :, newaxis]
+      self.Qz=self.pi+self.pf
+
+    if self.options['gisans_lean']:
+      # only keep the scaled intensities
+      self.S=Idata*scale
+      self.dS=sqrt(Idata)*scale
+    else:
+      self.Iraw=Idata
+      self.dIraw=sqrt(self.Iraw)
+      # normalize data by width in y and multiply scaling factor
+      self.I=self.Iraw*scale
+      self.dI=self.dIraw*scale
+      self.S=array(self.I)
+      self.dS=array(self.dI)
     debug("Intensity scale is %s"%(scale))
 
-    self.S=array(self.I)
-    self.dS=array(self.dI)
     if self.options['normalization']:
-      norm=self.options['normalization']
       debug("Performing normalization from %s"%norm)
-      normR=norm.Rraw[PN:P0]
-      normdR=norm.dRraw[PN:P0]
       idxs=normR>0.
       self.dS[:, :, idxs]=sqrt(
                    (self.dS[:, :, idxs]/normR[idxs][newaxis, newaxis, :])**2+
@@ -2032,36 +3203,48 @@ class GISANS(Reflectivity):
       self.S[:, :, logical_not(idxs)]=0.
       self.dS[:, :, logical_not(idxs)]=0.
 
-    if self.options['gisans_no_DP']:
-      fast_n_tof=[i*1.0e6/60. for i in range(4)]
-      tof_edges=dataset.tof_edges[PN:P0]
-      fresult=(tof_edges[1:]<fast_n_tof[0])|(tof_edges[:-1]>fast_n_tof[0])
-      for fnt in fast_n_tof[1:]:
-        fresult&=(tof_edges[1:]<fnt)|(tof_edges[:-1]>fnt)
-      fidx=where(fresult)[0]
-      # apply filtering to all arrays
-      self.Iraw=self.Iraw[:, :, fidx]
-      self.dIraw=self.dIraw[:, :, fidx]
-      self.I=self.I[:, :, fidx]
-      self.dI=self.dI[:, :, fidx]
-      self.S=self.S[:, :, fidx]
-      self.dS=self.dS[:, :, fidx]
-      self.Qx=self.Qx[:, :, fidx]
-      self.Qy=self.Qy[:, :, fidx]
-      self.Qz=self.Qz[:, :, fidx]
-      self.pi=self.pi[:, :, fidx]
-      self.pf=self.pf[:, :, fidx]
-
     # create grid
-    self.SGrid, qy, qz=histogram2d(self.Qy.flatten(), self.Qz.flatten(),
-                                   bins=(self.options['gisans_gridy'],
-                                         self.options['gisans_gridz']),
-                                   weights=self.S.flatten())
-    npoints, ignore, ignore=histogram2d(self.Qy.flatten(), self.Qz.flatten(),
-                                   bins=(self.options['gisans_gridy'],
-                                         self.options['gisans_gridz']))
-    self.SGrid[npoints>0]/=npoints[npoints>0]
+    bins=(self.options['gisans_gridy'], self.options['gisans_gridz'])
+    if self.options['gisans_lean']:
+      self.SGrid, qy, qz=self._calc_lean_grid(bins)
+    else:
+      self.SGrid, qy, qz=histogram2d(self.Qy.flatten(), self.Qz.flatten(),
+                                     bins=bins, weights=self.S.flatten())
+      npoints, ignore, ignore=histogram2d(self.Qy.flatten(), self.Qz.flatten(), bins=bins)
+      self.SGrid[npoints>0]/=npoints[npoints>0]
     self.SGrid=self.SGrid.transpose()
     qy=(qy[:-1]+qy[1:])/2.
     qz=(qz[:-1]+qz[1:])/2.
     self.QyGrid, self.QzGrid=meshgrid(qy, qz)
+
+  def _calc_lean_grid(self, bins):
+    '''
+    Average S on a Qy/Qz grid with the same bins as histogram2d, calculating
+    Q for a limited number of ToF columns at a time.
+    '''
+    nx, ny, ntof=self.S.shape
+    step=max(1, MAX_GISANS_CHUNK//max(1, nx*ny))
+    chunks=[slice(i, i+step) for i in range(0, ntof, step)]
+    # Q-range of all points
+    qrange=[[inf, -inf], [inf, -inf]]
+    for chunk in chunks:
+      for qrangei, Q in zip(qrange, self.get_Qyz(chunk)):
+        if Q.size>0:
+          qrangei[0]=min(qrangei[0], Q.min())
+          qrangei[1]=max(qrangei[1], Q.max())
+    edges=[]
+    for (qmin, qmax), nbins in zip(qrange, bins):
+      if qmin>qmax:
+        qmin, qmax=0., 1.
+      elif qmin==qmax:
+        qmin, qmax=qmin-0.5, qmax+0.5
+      edges.append(linspace(qmin, qmax, nbins+1))
+    SGrid=zeros(bins)
+    npoints=zeros(bins)
+    for chunk in chunks:
+      Qy, Qz=self.get_Qyz(chunk)
+      SGrid+=histogram2d(Qy.flatten(), Qz.flatten(), bins=edges,
+                         weights=self.S[:, :, chunk].flatten())[0]
+      npoints+=histogram2d(Qy.flatten(), Qz.flatten(), bins=edges)[0]
+    SGrid[npoints>0]/=npoints[npoints>0]
+    return SGrid, edges[0], edges[1]
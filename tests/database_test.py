@@ -0,0 +1,280 @@
+#-*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Event
+from quicknxs import database, qreduce
+from quicknxs.database import ColumnBase
+from quicknxs.database_updater import DatabaseUpdater
+from quicknxs.buzhug import Base
+from quicknxs.config import instrument as config
+
+FIELDS=[('file_id', int), ('file_path', unicode), ('ai', float), ('lambda_center', float)]
+
+def _dummy_record(file_id):
+  '''
+  Replacement for database._create_record that doesn't read any file,
+  datasets with an index divisible by 5 can't be read.
+  '''
+  if file_id%5==0:
+    return file_id, None
+  record=[]
+  for name, field_type in database.DatabaseHandler().fields:
+    if name=='file_id':
+      record.append(file_id)
+    elif field_type is unicode:
+      record.append(u'/SNS/REF_M/REF_M_%i.nxs'%file_id)
+    else:
+      record.append(field_type(file_id%7))
+  return file_id, record
+
+def _dummy_locate(number, histogram=True, old_format=False, verbose=True):
+  if number==8:
+    return None
+  return u'/SNS/REF_M/REF_M_%i.nxs'%number
+
+class ColumnBaseTest(unittest.TestCase):
+  def setUp(self):
+    self.path=tempfile.mkdtemp()
+    self.db=ColumnBase(os.path.join(self.path, 'columns')).create(*FIELDS)
+    self.buzhug=Base(os.path.join(self.path, 'buzhug')).create(*FIELDS)
+    for i in range(20):
+      record=(1000+i, u'/SNS/REF_M/REF_M_%i_ä.nxs'%(1000+i), (i%5)*0.1-0.1, 2.+(i%3)*1.5)
+      self.db.insert(*record)
+      self.buzhug.insert(*record)
+
+  def tearDown(self):
+    self.buzhug.close()
+    shutil.rmtree(self.path)
+
+  def compare(self, res1, res2):
+    self.assertEqual(len(res1), len(res2))
+    res1.sort_by('+file_id')
+    res2.sort_by('+file_id')
+    for rec1, rec2 in zip(res1, res2):
+      for name, ignore in FIELDS:
+        self.assertEqual(getattr(rec1, name), getattr(rec2, name))
+
+  def test_select(self):
+    self.assertEqual(len(self.db), 20)
+    self.compare(self.db(), self.buzhug())
+    self.compare(self.db(file_id=1005), self.buzhug(file_id=1005))
+    self.compare(self.db(ai=[-0.05, 0.15], lambda_center=[2.5, 4.]),
+                 self.buzhug(ai=[-0.05, 0.15], lambda_center=[2.5, 4.]))
+    self.compare(self.db(file_path=u'/SNS/REF_M/REF_M_1003_ä.nxs'),
+                 self.buzhug(file_path=u'/SNS/REF_M/REF_M_1003_ä.nxs'))
+    self.compare(self.db.select(None, 'file_id>=start_id and file_id<end_id', start_id=1003, end_id=1010),
+                 self.buzhug.select(None, 'file_id>=start_id and file_id<end_id', start_id=1003, end_id=1010))
+    self.compare(self.db.select(None, 'not o0<file_id<o1 or ai==o2', o0=1002, o1=1018, o2=0.),
+                 self.buzhug.select(None, 'not o0<file_id<o1 or ai==o2', o0=1002, o1=1018, o2=0.))
+    self.assertEqual(len(self.db.select(None, 'True')), 20)
+
+  def test_sort(self):
+    res=self.db().sort_by('-lambda_center+file_id')
+    self.assertEqual([rec.file_id for rec in res[:3]], [1002, 1005, 1008])
+
+  def test_reopen(self):
+    # interrupted insert where only the string data was written
+    open(os.path.join(self.db.name, 'file_path.str'), 'ab').write('abc')
+    open(os.path.join(self.db.name, 'file_path.col'), 'ab').write('\x00'*8)
+    db=ColumnBase(self.db.name).open()
+    self.assertEqual(len(db), 20)
+    db.insert(file_id=2000, file_path=u'test', ai=0., lambda_center=4.)
+    self.assertEqual(db(file_id=2000)[0].file_path, u'test')
+    self.assertEqual(len(self.db(lambda_center=4.)), 1)
+
+  def test_has_value(self):
+    self.assertTrue(self.db.has_value('file_id', 1019))
+    self.assertFalse(self.db.has_value('file_id', 1020))
+    self.db.insert(1020, u'test', 0., 4.)
+    self.assertTrue(self.db.has_value('file_id', 1020))
+    self.assertTrue(self.db.has_value('file_path', u'/SNS/REF_M/REF_M_1003_ä.nxs'))
+
+  def test_import(self):
+    db=ColumnBase(os.path.join(self.path, 'imported')).create(*FIELDS)
+    db.import_base(self.buzhug)
+    self.compare(db(), self.db())
+
+class BuzhugIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.path=tempfile.mkdtemp()
+    self.indexed=Base(os.path.join(self.path, 'indexed')).create(*FIELDS)
+    self.indexed.create_index('file_id', 'ai')
+    self.plain=Base(os.path.join(self.path, 'plain')).create(*FIELDS)
+    for i in range(100):
+      record=(1000+i, u'/SNS/REF_M/REF_M_%i.nxs'%(1000+i), (i%7)*0.1-0.2, 2.+(i%3)*1.5)
+      self.indexed.insert(*record)
+      self.plain.insert(*record)
+
+  def tearDown(self):
+    self.indexed.close()
+    self.plain.close()
+    shutil.rmtree(self.path)
+
+  def compare(self, **args):
+    res1=self.indexed(**args)
+    res2=self.plain(**args)
+    self.assertEqual(len(res1), len(res2))
+    res1.sort_by('+file_id')
+    res2.sort_by('+file_id')
+    for rec1, rec2 in zip(res1, res2):
+      for name, ignore in FIELDS:
+        self.assertEqual(getattr(rec1, name), getattr(rec2, name))
+
+  def compare_all(self):
+    self.compare(file_id=1005)
+    self.compare(file_id=[1003, 1007])
+    self.compare(ai=[0.05, 0.15], lambda_center=[2.5, 4.])
+    self.compare(ai=[-0.25, -0.15], file_id=[1000, 1050])
+    self.compare(ai=0.2, lambda_center=3.5)
+
+  def test_select(self):
+    self.compare_all()
+
+  def test_modify(self):
+    for base in [self.indexed, self.plain]:
+      base.delete(base(file_id=[1010, 1020]))
+      base.update(base(file_id=1030), ai=0.1)
+      base.update(base(file_id=1031), ai=0.4, file_path=u'moved')
+    self.compare_all()
+    self.assertEqual(len(self.indexed(file_id=1015)), 0)
+    self.assertEqual(self.indexed(file_id=1031)[0].ai, 0.4)
+
+  def test_reopen(self):
+    self.indexed.delete(self.indexed(file_id=1002))
+    self.plain.delete(self.plain(file_id=1002))
+    # changes written by another process
+    other=Base(self.indexed.name).open()
+    other.insert(2000, u'new', 0.1, 2.)
+    self.plain.insert(2000, u'new', 0.1, 2.)
+    other.close()
+    self.compare_all()
+    self.indexed.close()
+    self.indexed=Base(self.indexed.name).open()
+    self.assertEqual(sorted(self.indexed._index.keys()), ['ai', 'file_id'])
+    self.compare_all()
+    self.compare(file_id=[1999, 2001])
+
+  def test_has_value(self):
+    for base in [self.indexed, self.plain]:
+      self.assertTrue(base.has_value('file_id', 1050))
+      self.assertFalse(base.has_value('file_id', 2000))
+      base.delete(base(file_id=1050))
+      self.assertFalse(base.has_value('file_id', 1050))
+    other=Base(self.indexed.name).open()
+    other.insert(2000, u'new', 0.1, 2.)
+    other.close()
+    self.assertTrue(self.indexed.has_value('file_id', 2000))
+
+  def test_stale_index(self):
+    self.plain.create_index('file_id', 'ai')
+    other=Base(self.plain.name).open()
+    # the journal can't be written, e.g. due to missing permissions
+    for index in other._index.values():
+      index.journal_path=os.path.join(self.path, 'missing', os.path.basename(index.journal_path))
+    other.insert(500, u'new', 0.1, 2.)
+    other.update(other(file_id=1010), file_id=501)
+    other.delete(other(file_id=1020))
+    other.close()
+    self.assertFalse(self.plain._index['file_id'].is_current())
+    for base in [self.plain, Base(self.plain.name).open()]:
+      self.assertEqual(len(base(file_id=500)), 1)
+      self.assertEqual(len(base(file_id=[500, 501])), 2)
+      self.assertEqual(len(base(file_id=1010)), 0)
+      self.assertEqual(len(base(file_id=1020)), 0)
+      self.assertTrue(base.has_value('file_id', 501))
+      self.assertFalse(base.has_value('file_id', 1020))
+    # the writing process rebuilds stale indexes
+    self.plain.close()
+    self.plain=Base(self.plain.name).open()
+    self.plain.create_index('file_id', 'ai')
+    self.plain.insert(502, u'new', 0.2, 2.)
+    self.assertTrue(self.plain._index['file_id'].is_current())
+    self.assertEqual(sorted([rec.file_id for rec in self.plain(file_id=[500, 502])]),
+                     [500, 501, 502])
+
+  def test_index_other_handle(self):
+    # handle opened before the indexes were created by another process
+    other=Base(self.plain.name).open()
+    self.plain.create_index('file_id', 'ai')
+    other.insert(500, u'new', 0.1, 2.)
+    self.assertEqual(sorted(other._index.keys()), ['ai', 'file_id'])
+    other.close()
+    self.assertTrue(self.plain._index['file_id'].is_current())
+    self.plain.close()
+    self.plain=Base(self.plain.name).open()
+    self.assertEqual(len(self.plain(file_id=500)), 1)
+    self.assertTrue(self.plain.has_value('file_id', 500))
+
+class AddRecordsTest(unittest.TestCase):
+  def setUp(self):
+    self.path=tempfile.mkdtemp()
+    self._config=(config.database_file, config.database_backend)
+    config.database_file=os.path.join(self.path, 'database')
+    config.database_backend='buzhug'
+    self._create_record=database._create_record
+    self._locate_file=qreduce.locate_file
+    database._create_record=_dummy_record
+    qreduce.locate_file=_dummy_locate
+    self.updater=DatabaseUpdater(start_idx=1)
+    self.handler=self.updater.db
+    self.progress=[]
+
+  def tearDown(self):
+    self.handler.close_db()
+    database._create_record=self._create_record
+    qreduce.locate_file=self._locate_file
+    config.database_file, config.database_backend=self._config
+    shutil.rmtree(self.path)
+
+  def callback(self, *args):
+    self.progress.append(args)
+
+  def stored_ids(self):
+    # records in the order they were inserted
+    return [rec.file_id for rec in self.handler.get_database()]
+
+  def test_order(self):
+    added=self.handler.add_records([12, 3, 10, 7, 4], processes=2, callback=self.callback)
+    self.assertEqual(added, [12, 3, 7, 4])
+    self.assertEqual(self.stored_ids(), [12, 3, 7, 4])
+    self.assertEqual(self.progress, [(12, True, 1, 5), (3, True, 2, 5), (10, False, 3, 5),
+                                     (7, True, 4, 5), (4, True, 5, 5)])
+
+  def test_resume(self):
+    self.handler.add_records([1, 2, 3], processes=2)
+    added=self.handler.add_records(range(1, 8), processes=2, callback=self.callback)
+    self.assertEqual(added, [4, 6, 7])
+    self.assertEqual(self.stored_ids(), [1, 2, 3, 4, 6, 7])
+    # indices already in the database are not read again
+    self.assertEqual([item[0] for item in self.progress], [4, 5, 6, 7])
+
+  def test_stop_event(self):
+    stop_event=Event()
+    def stop(file_id, added, done, total):
+      if done==2:
+        stop_event.set()
+    added=self.handler.add_records(range(1, 10), processes=2, callback=stop,
+                                   stop_event=stop_event)
+    self.assertEqual(added, [1, 2])
+    self.assertEqual(self.handler.add_records(range(1, 10), processes=2), [3, 4, 6, 7, 8, 9])
+    self.assertEqual(self.stored_ids(), [1, 2, 3, 4, 6, 7, 8, 9])
+
+  def test_backfill(self):
+    self.handler.add_records([2, 3], processes=1)
+    # stopped after the first record
+    self.updater.quit_event.set()
+    self.updater.backfill(processes=2, end_index=11)
+    self.assertEqual(self.updater.current_index, 1)
+    self.assertEqual(self.stored_ids(), [2, 3, 1])
+    self.updater.quit_event.clear()
+    self.updater.backfill(processes=2, end_index=11)
+    self.assertEqual(self.updater.current_index, 11)
+    # file 5 can't be read and file 8 doesn't exist
+    self.assertEqual(self.stored_ids(), [2, 3, 1, 4, 6, 7, 9])
+
+suite=unittest.TestLoader().loadTestsFromTestCase(ColumnBaseTest)
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(BuzhugIndexTest))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(AddRecordsTest))
@@ -2,8 +2,10 @@
 
 import unittest
 from numpy import *
+from numpy import testing
 from quicknxs.qcalc import refine_gauss, get_scaling, get_xpos, get_yregion, \
-                             get_total_reflection, smooth_data, DetectorTailCorrector
+                             get_total_reflection, smooth_data, DetectorTailCorrector, \
+                             gisans_slices
 from quicknxs.qreduce import MRDataset, Reflectivity
 
 class FitTest(unittest.TestCase):
@@ -125,9 +127,71 @@ class SmoothTest(unittest.TestCase):
                 axis_sigma_scaling=3)
     self.assertFalse(self._progress is None)
 
+  def test_smooth_values(self):
+    # compare with the weighted mean of all points within the search range
+    for scaling in [None, 1, 2, 3]:
+      Xout, Yout, Iout=smooth_data(self.settings, self.x, self.y, self.I,
+                                   axis_sigma_scaling=scaling, xysigma0=50.)
+      for i, j in [(0, 0), (3, 7), (19, 12)]:
+        xy={None: 50., 1: Xout[i, j], 2: Yout[i, j], 3: Xout[i, j]+Yout[i, j]}[scaling]
+        rij=((self.x-Xout[i, j])**2+(self.y-Yout[i, j])**2)/(9./50.*xy)
+        Pij=exp(-0.5*rij[rij<9.])
+        self.assertAlmostEqual(Iout[i, j], (Pij*self.I[rij<9.]).sum()/Pij.sum(), places=8)
+
   def _cb_test(self, progress):
     self._progress=progress
 
+class FakeGISANS(object):
+  # dummy object with the GISANS attributes used for the projection
+  def get_Qyz(self, columns):
+    return self.Qy[:, :, columns], self.Qz[:, :, columns]
+
+class GISANSTest(unittest.TestCase):
+  def setUp(self):
+    self.datasets=[]
+    for i in range(2):
+      data=FakeGISANS()
+      data.lamda=linspace(2., 8., 30)
+      data.options={'P0': 2, 'PN': 3}
+      shape=(20, 15, 25)
+      data.S=random.rand(*shape)
+      data.dS=random.rand(*shape)
+      data.Qy=random.randn(*shape)*0.01
+      data.Qz=random.rand(*shape)*0.1+0.01*i
+      self.datasets.append(data)
+
+  def test_slices(self):
+    # compare with separate histograms for each slice
+    results=gisans_slices(self.datasets, 2.5, 7.5, 4, grid=(11, 9))
+    self.assertEqual(len(results), 4)
+    for Isum, Qy, Qz, lmin, lmax, dIsum in results:
+      I, dI, qy, qz=[], [], [], []
+      for data in self.datasets:
+        lamda=data.lamda[3:28]
+        region=(lamda>=lmin)&(lamda<=lmax)
+        I.append(data.S[:, :, region].flatten())
+        dI.append(data.dS[:, :, region].flatten())
+        qy.append(data.Qy[:, :, region].flatten())
+        qz.append(data.Qz[:, :, region].flatten())
+      I, dI, qy, qz=map(hstack, [I, dI, qy, qz])
+      Npoints, Qyedges, Qzedges=histogram2d(qy, qz, bins=(11, 9))
+      Iref, ignore, ignore=histogram2d(qy, qz, bins=(11, 9), weights=I)
+      dIref, ignore, ignore=histogram2d(qy, qz, bins=(11, 9), weights=dI**2)
+      self.assertEqual(Isum.shape, (11, 9))
+      testing.assert_allclose(Isum*maximum(Npoints, 1), Iref, rtol=1e-12)
+      testing.assert_allclose(dIsum*maximum(Npoints, 1), sqrt(dIref), rtol=1e-12)
+      testing.assert_allclose(Qy[:, 0], (Qyedges[1:]+Qyedges[:-1])/2., rtol=1e-12)
+      testing.assert_allclose(Qz[0], (Qzedges[1:]+Qzedges[:-1])/2., rtol=1e-12)
+
+  def test_slice_chunks(self):
+    results=gisans_slices(self.datasets, 2.5, 7.5, 5, grid=(11, 9))
+    chunks=gisans_slices(self.datasets, 2.5, 7.5, 5, grid=(11, 9), first=0, last=2)+\
+           gisans_slices(self.datasets, 2.5, 7.5, 5, grid=(11, 9), first=2)
+    self.assertEqual(len(chunks), 5)
+    for result, chunk in zip(results, chunks):
+      for item, chunk_item in zip(result, chunk):
+        testing.assert_array_equal(item, chunk_item)
+
 class DetectorCorrTest(FakeData, unittest.TestCase):
   def test_corr(self):
     c=DetectorTailCorrector(self.ds.xdata)
@@ -137,4 +201,5 @@ suite=unittest.TestLoader().loadTestsFromTestCase(FitTest)
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(StitchTest))
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(PositionTest))
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SmoothTest))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(GISANSTest))
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(DetectorCorrTest))
@@ -1,6 +1,7 @@
 #-*- coding: utf-8 -*-
 
 import os, sys
+import shutil
 import unittest
 import tempfile
 
@@ -114,6 +115,23 @@ class ExportTest(FakeData, unittest.TestCase):
                            'xy_column': 2,
                            })
 
+  def test_smooth_parallel(self):
+    exporter=Exporter(self.ds.keys(), [self.ref1, self.ref2])
+    exporter.extract_offspecular()
+    settings={
+              'grid': (20, 15),
+              'sigma': (0.001, 0.002),
+              'sigmas': 3.,
+              'region': (-0.02, 0.02, 0. , 0.1),
+              'xy_column': 1,
+              }
+    exporter.smooth_offspec(settings)
+    serial=exporter.output_data['OffSpecSmooth']
+    exporter.smooth_offspec(settings, processes=2)
+    parallel=exporter.output_data['OffSpecSmooth']
+    for channel in exporter.channels:
+      testing.assert_array_equal(serial[channel][0], parallel[channel][0])
+
   def test_write_all(self):
     exporter=Exporter(self.ds.keys(), [self.ref1, self.ref2])
     exporter.extract_reflectivity()
@@ -132,6 +150,44 @@ class ExportTest(FakeData, unittest.TestCase):
     exporter.create_genx_file(tempfile.gettempdir(), 'testexport.dat')
     os.remove(expfile)
 
+  def test_stream_offspec(self):
+    path=tempfile.mkdtemp()
+    try:
+      exporter=Exporter(self.ds.keys(), [self.ref1, self.ref2])
+      exporter.extract_offspecular()
+      exporter.export_data(path, 'memory_{item}_{state}.{type}',
+                           multi_ascii=True, combined_ascii=True)
+      streamer=Exporter(self.ds.keys(), [self.ref1, self.ref2], preload=False)
+      streamer.stream_offspecular(path, 'stream_{item}_{state}.{type}',
+                                  multi_ascii=True, combined_ascii=True)
+      self.assertEqual(streamer.raw_data, {})
+      self.assertEqual(streamer.output_data, {})
+      self.assertEqual(streamer.streamed_data['OffSpec']['ki_max'],
+                       exporter.output_data['OffSpec']['ki_max'])
+      for channel in list(self.ds.keys())+['all']:
+        memory=open(os.path.join(path, 'memory_OffSpec_%s.dat'%channel), 'rb').readlines()
+        stream=open(os.path.join(path, 'stream_OffSpec_%s.dat'%channel), 'rb').readlines()
+        # ignore the creation date
+        self.assertEqual(memory[2:], stream[2:])
+    finally:
+      shutil.rmtree(path)
+
+  def test_stream_specular(self):
+    path=tempfile.mkdtemp()
+    try:
+      exporter=Exporter(self.ds.keys(), [self.ref1, self.ref2])
+      exporter.extract_reflectivity()
+      NXSData.clear_cache()
+      streamer=Exporter(self.ds.keys(), [self.ref1, self.ref2], preload=False)
+      streamer.stream_offspecular(path, 'stream_{item}_{state}.{type}', specular=True)
+      # streamed files are not kept in the cache
+      self.assertEqual(NXSData.get_cache_stats()['items'], 0)
+      for channel in self.ds.keys():
+        testing.assert_array_equal(streamer.output_data['Specular'][channel],
+                                   exporter.output_data['Specular'][channel])
+    finally:
+      shutil.rmtree(path)
+
   def test_write_consistent(self):
     exporter=Exporter([self.ds.keys()[0]], [self.ref1])
     exporter.extract_reflectivity()
@@ -1,10 +1,14 @@
 #-*- coding: utf-8 -*-
 
 import os
+import shutil
+import tempfile
 import unittest
 from math import pi
 from quicknxs import qreduce
-from numpy.testing import assert_array_equal
+from numpy import array, linspace, arange, random, histogramdd, uint8, uint16, load, \
+                  sin, sqrt, where, newaxis
+from numpy.testing import assert_array_equal, assert_allclose
 
 TEST_DATASET=os.path.join(os.path.dirname(os.path.abspath(__file__)), u'test1_histo.nxs')
 TEST_EVENT=os.path.join(os.path.dirname(os.path.abspath(__file__)), u'test1_event.nxs')
@@ -50,6 +54,80 @@ class GeneralClassTest(unittest.TestCase):
     obj2=qreduce.NXSData(TEST_DATASET, use_caching=False, bins=50)
     self.assertFalse(obj is obj2)
 
+  def test_cache_options(self):
+    qreduce.NXSData.clear_cache()
+    obj=qreduce.NXSData(TEST_EVENT, use_caching=True, bins=40)
+    obj2=qreduce.NXSData(TEST_EVENT, use_caching=True, bins=50)
+    # both option sets are kept in the cache
+    self.assertTrue(qreduce.NXSData(TEST_EVENT, use_caching=True, bins=40) is obj)
+    self.assertTrue(qreduce.NXSData(TEST_EVENT, use_caching=True, bins=50) is obj2)
+    stats=qreduce.NXSData.get_cache_stats()
+    self.assertEqual(stats['items'], 2)
+    self.assertEqual(stats['hits'], 2)
+    self.assertEqual(stats['nbytes'], obj.nbytes+obj2.nbytes)
+    # projections calculated after the objects were added are counted
+    ignore=obj[0].xydata, obj2[0].xtofdata
+    self.assertEqual(qreduce.NXSData.get_cache_stats()['nbytes'], obj.nbytes+obj2.nbytes)
+    # the least recently used item gets removed when the memory limit is reached
+    max_bytes=qreduce.NXSData.MAX_CACHE_BYTES
+    qreduce.NXSData.MAX_CACHE_BYTES=obj.nbytes+obj2.nbytes
+    try:
+      qreduce.NXSData(TEST_EVENT, use_caching=True, bins=60)
+      self.assertFalse(qreduce.NXSData(TEST_EVENT, use_caching=True, bins=40) is obj)
+    finally:
+      qreduce.NXSData.MAX_CACHE_BYTES=max_bytes
+
+  def test_disk_cache(self):
+    cache_dir=tempfile.mkdtemp()
+    try:
+      obj=qreduce.NXSData(TEST_EVENT, use_caching=False, disk_cache=cache_dir, bins=40)
+      obj2=qreduce.NXSData(TEST_EVENT, use_caching=False, disk_cache=cache_dir, bins=40)
+      self.assertFalse(obj is obj2)
+      self.assertEqual(obj.keys(), obj2.keys())
+      assert_array_equal(obj[0].data, obj2[0].data, verbose=True)
+      self.assertEqual(obj2[0].origin, obj[0].origin)
+      self.assertEqual(sorted(obj2[0].logs.keys()), sorted(obj[0].logs.keys()))
+      # the cache files only contain arrays, which are read without unpickling
+      for name in os.listdir(cache_dir):
+        load(os.path.join(cache_dir, name), allow_pickle=False).close()
+      # different options are stored separately
+      obj3=qreduce.NXSData(TEST_EVENT, use_caching=False, disk_cache=cache_dir, bins=50)
+      self.assertEqual(len(obj3[0].tof), 50)
+      self.assertEqual(len(os.listdir(cache_dir)), 2)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_lazy_histogram(self):
+    obj=qreduce.NXSData(TEST_DATASET, use_caching=False)
+    lazy=qreduce.NXSData(TEST_DATASET, use_caching=False, lazy_histogram=True)
+    self.assertTrue(lazy[0].nbytes<obj[0].nbytes)
+    assert_array_equal(lazy[0].data_window(100, 120, 50, 60), obj[0].data[100:120, 50:60],
+                       verbose=True)
+    lazy.close()
+    self.assertTrue(lazy[0]._h5file is None)
+    # the file is reopened when needed
+    assert_array_equal(lazy[0].data_window(0, 10), obj[0].data[0:10], verbose=True)
+    assert_array_equal(lazy[0].data, obj[0].data, verbose=True)
+    # a full read is kept in memory and the file closed
+    self.assertTrue(lazy[0]._h5_source is None)
+    self.assertTrue(lazy[0]._h5file is None)
+    assert_array_equal(lazy[0].data, obj[0].data, verbose=True)
+
+  def test_header_only(self):
+    obj=qreduce.NXSData(TEST_DATASET, use_caching=False)
+    header=qreduce.NXSData(TEST_DATASET, use_caching=False, header_only=True)
+    self.assertEqual(header.keys(), obj.keys())
+    for ds, hds in zip(obj, header):
+      self.assertTrue(hds.data is None)
+      assert_array_equal(hds.tof, ds.tof)
+      assert_array_equal(hds.xydata, ds.xydata)
+      self.assertEqual(hds.lambda_center, ds.lambda_center)
+      self.assertEqual(hds.number, ds.number)
+    obj=qreduce.NXSData(TEST_EVENT, use_caching=False, bins=40)
+    header=qreduce.NXSData(TEST_EVENT, use_caching=False, bins=40, header_only=True)
+    assert_array_equal(header[0].tof, obj[0].tof)
+    self.assertEqual(header[0].xydata.shape, obj[0].xydata.shape)
+
   def test_callback(self):
     self._progress=None
     qreduce.NXSData(TEST_DATASET, use_caching=False, bins=40, callback=self._cbtest)
@@ -173,6 +251,90 @@ class EventModeTests(unittest.TestCase):
     evnt=qreduce.NXSData(TEST_EVENT, event_tof_overwrite=histo[0].tof_edges)
     assert_array_equal(evnt[0].data, histo[0].data, verbose=True)
 
+  def test_chunked(self):
+    full_ds=qreduce.NXSData(TEST_EVENT, use_caching=False)
+    chunked_ds=qreduce.NXSData(TEST_EVENT, use_caching=False, event_chunk_size=10000)
+    assert_array_equal(chunked_ds[0].data, full_ds[0].data, verbose=True)
+    full_ds=qreduce.NXSData(TEST_EVENT, use_caching=False, event_split_bins=4,
+                            event_split_index=1)
+    chunked_ds=qreduce.NXSData(TEST_EVENT, use_caching=False, event_split_bins=4,
+                               event_split_index=1, event_chunk_size=10000)
+    self.assertEqual(chunked_ds[0].total_counts, full_ds[0].total_counts)
+    assert_array_equal(chunked_ds[0].data, full_ds[0].data, verbose=True)
+
+  def test_channel_pool(self):
+    full_ds=qreduce.NXSData(TEST_EVENT, use_caching=False)
+    for channel_pool in ['thread', 'process']:
+      pooled_ds=qreduce.NXSData(TEST_EVENT, use_caching=False, channel_pool=channel_pool)
+      self.assertEqual(pooled_ds.keys(), full_ds.keys())
+      for key in full_ds.keys():
+        assert_array_equal(pooled_ds[key].data, full_ds[key].data, verbose=True)
+
+  def test_data_window(self):
+    ds=qreduce.MRDataset()
+    data=random.randint(0, 1000, (40, 12, 20))
+    ds.data=data
+    if qreduce.USE_COMPRESSION:
+      # make sure the region is read from the compressed blocks
+      qreduce.MRDataset._decompressed.clear()
+    for x_from, x_to in [(0, 40), (3, 21), (16, 32), (-5, None), (30, 60), (10, 5)]:
+      assert_array_equal(ds.data_window(x_from, x_to, 2, 8), data[x_from:x_to, 2:8, :],
+                         verbose=True)
+    assert_array_equal(ds.data, data, verbose=True)
+
+  def test_sum_region(self):
+    ds=qreduce.MRDataset()
+    data=random.randint(0, 1000, (40, 12, 20))
+    ds.data=data
+    for x_from, x_to, y_from, y_to in [(0, 40, 0, 12), (3, 21, 2, 8), (-5, None, 4, 30),
+                                       (10, 5, 0, 12)]:
+      region=data[x_from:x_to, y_from:y_to, :].astype(float)
+      assert_array_equal(ds.sum_region(x_from, x_to, y_from, y_to),
+                         region.sum(axis=0).sum(axis=0), verbose=True)
+      assert_array_equal(ds.sum_region(x_from, x_to, y_from, y_to, sum_x=False),
+                         region.sum(axis=1), verbose=True)
+
+  def test_projections(self):
+    ds=qreduce.NXSData(TEST_EVENT, use_caching=False)[0]
+    assert_array_equal(ds.xydata, ds.data.sum(axis=2).transpose(), verbose=True)
+    assert_array_equal(ds.xtofdata, ds.data.sum(axis=1), verbose=True)
+    self.assertTrue(ds.data.dtype.kind in 'iu')
+    self.assertEqual(ds.xydata.dtype, float)
+
+  def test_compact_counts(self):
+    ds=qreduce.MRDataset()
+    ds.data=arange(12*8*40).reshape(12, 8, 40)%256
+    self.assertEqual(ds.data.dtype, uint8)
+    ds2=qreduce.MRDataset()
+    ds2.data=ds.data.copy()
+    # sum exceeds the range of the stored type
+    ds+=ds2
+    self.assertEqual(ds.data.dtype, uint16)
+    assert_array_equal(ds.data, 2*(arange(12*8*40).reshape(12, 8, 40)%256), verbose=True)
+    assert_array_equal(ds.xydata, ds.data.sum(axis=2).transpose(), verbose=True)
+
+  def test_read_split(self):
+    split_ds=qreduce.NXSData.read_split(TEST_EVENT, use_caching=False, event_split_bins=4)
+    self.assertEqual(len(split_ds), 4)
+    for i, ds in enumerate(split_ds):
+      single_ds=qreduce.NXSData(TEST_EVENT, use_caching=False, event_split_bins=4,
+                                event_split_index=i)
+      self.assertEqual(ds[0].total_counts, single_ds[0].total_counts)
+      self.assertEqual(ds[0].proton_charge, single_ds[0].proton_charge)
+      assert_array_equal(ds[0].data, single_ds[0].data, verbose=True)
+
+  def test_bin_events(self):
+    tof_edges=linspace(10000., 25000., 41)
+    tof_ids=random.randint(0, 12*8, 10000)
+    tof_time=random.uniform(9000., 26000., 10000)
+    tof_time[:3]=tof_edges[[0, 20, -1]]
+    result=qreduce.MRDataset.bin_events(tof_ids, tof_time, tof_edges, (12, 8))
+    self.assertEqual(result.shape, (12, 8, 40))
+    region=(tof_time>=tof_edges[0])&(tof_time<=tof_edges[-1])
+    compare=histogramdd((tof_ids[region]//8, tof_ids[region]%8, tof_time[region]),
+                        bins=(arange(13), arange(9), tof_edges))[0]
+    assert_array_equal(result, compare, verbose=True)
+
 
 class DataReductionTests(unittest.TestCase):
   def setUp(self):
@@ -212,6 +374,41 @@ class DataReductionTests(unittest.TestCase):
     res2=qreduce.Reflectivity(self.data[0], x_pos=206., tth=0., normalization=res, scale=0.5)
     assert_array_equal(res2.R[res.Rraw>0], 0.5, verbose=True)
 
+  def test_from_channels(self):
+    norm=qreduce.Reflectivity(self.data[0], x_pos=206., tth=0., dpix=206.)
+    res=qreduce.Reflectivity.from_channels(self.data, x_pos=206.,
+                                           normalization=norm, scale=0.5)
+    self.assertEqual(len(res), len(self.data))
+    for i, refl in enumerate(res):
+      single=qreduce.Reflectivity(self.data[i], x_pos=206.,
+                                  normalization=norm, scale=0.5)
+      self.assertEqual(refl.origin, single.origin)
+      self.assertEqual(refl.ai, single.ai)
+      assert_array_equal(refl.Q, single.Q)
+      assert_array_equal(refl.R, single.R)
+      assert_array_equal(refl.dR, single.dR)
+    res=qreduce.Reflectivity.from_channels(self.data, channels=[self.data.keys()[-1]])
+    self.assertEqual(res[0].origin, self.data[-1].origin)
+
+  def test_sensitivity_map(self):
+    path=tempfile.mkdtemp()
+    try:
+      Isens=qreduce.create_sensitivity(self.data[0])
+      self.assertEqual(Isens.shape, self.data[0].data.shape[:2])
+      qreduce.save_sensitivity('test_flood', Isens, path)
+      del qreduce.DETECTOR_SENSITIVITY['test_flood']
+      assert_array_equal(qreduce.load_sensitivity('test_flood', path), Isens)
+      self.assertTrue(qreduce.load_sensitivity('not_there', path) is None)
+      # a flat map doesn't change the result
+      qreduce.DETECTOR_SENSITIVITY['test_flat']=Isens*0.+1.
+      res=qreduce.Reflectivity(self.data[0], x_pos=206., sensitivity_correction='test_flat')
+      res2=qreduce.Reflectivity(self.data[0], x_pos=206.)
+      assert_array_equal(res.R, res2.R)
+    finally:
+      shutil.rmtree(path)
+      qreduce.DETECTOR_SENSITIVITY.pop('test_flood', None)
+      qreduce.DETECTOR_SENSITIVITY.pop('test_flat', None)
+
   def test_background(self):
     res=qreduce.Reflectivity(self.data[0], x_pos=206., x_width=10.,
                                             bg_pos=206., bg_width=10.)
@@ -224,6 +421,16 @@ class DataReductionTests(unittest.TestCase):
                                 bg_tof_constant=True,
                                 bg_poly_regions=[[(2., 100), (2., 120), (4., 120), (4., 100)]])
 
+  def test_background_poly_mask(self):
+    inside=qreduce._points_in_polygon(array([1., 3., 5.]), array([1., 1., 1.]),
+                                      [(2., 0.), (4., 0.), (4., 2.), (2., 2.)])
+    assert_array_equal(inside, [False, True, False])
+    qreduce.Reflectivity._bg_masks.clear()
+    poly=[[(2., 100), (2., 120), (4., 120), (4., 100)]]
+    res=qreduce.Reflectivity(self.data[0], x_pos=206., bg_poly_regions=poly)
+    res2=qreduce.Reflectivity(self.data[0], x_pos=206., bg_poly_regions=poly)
+    self.assertEqual(len(qreduce.Reflectivity._bg_masks), 1)
+    assert_array_equal(res.BG, res2.BG)
 
   def test_angle_calculation(self):
     res=qreduce.Reflectivity(self.data[0], x_pos=206., x_width=10.,
@@ -247,8 +454,123 @@ class DataReductionTests(unittest.TestCase):
     self.assertTrue(isinstance(res2, qreduce.GISANS))
     repr(res2)
 
+  def test_gisans_lean(self):
+    res=qreduce.Reflectivity(self.data[0], x_pos=206., tth=0., dpix=206.)
+    full=qreduce.GISANS(self.data[0], normalization=res)
+    lean=qreduce.GISANS(self.data[0], normalization=res, gisans_lean=True)
+    self.assertFalse(hasattr(lean, 'Qx'))
+    assert_array_equal(lean.S, full.S)
+    assert_array_equal(lean.dS, full.dS)
+    for Qlean, Qfull in zip(lean.get_Qyz(), full.get_Qyz()):
+      assert_array_equal(Qlean, Qfull)
+    assert_array_equal(lean.QyGrid, full.QyGrid)
+    assert_array_equal(lean.QzGrid, full.QzGrid)
+    assert_allclose(lean.SGrid, full.SGrid, rtol=1e-10)
+
+
+class LoopFanReflectivity(qreduce.Reflectivity):
+  '''
+  Fan reflectivity extraction with the Qz rebinning loop of earlier versions.
+  '''
+  def _calc_fan(self, dataset):
+    tof_edges=dataset.tof_edges
+    reg=map(lambda item: int(round(item)),
+            [self.options['x_pos']-self.options['x_width']/2.,
+             self.options['x_pos']+self.options['x_width']/2.+1,
+             self.options['y_pos']-self.options['y_width']/2.,
+             self.options['y_pos']+self.options['y_width']/2.+1])
+    scale=1./dataset.proton_charge
+    rad_per_pixel=dataset.det_size_x/dataset.dist_sam_det/dataset.xydata.shape[1]
+    relpix=self.options['dpix']-arange(reg[0], reg[1])
+    ai=(self.options['tth']*pi/180.+relpix*rad_per_pixel)/2.
+    self.ai=ai.mean()
+    dai_rel=self.get_resolution()/self.ai
+    self._calc_bg(dataset)
+    v_edges=dataset.dist_mod_det/tof_edges*1e6
+    lamda_edges=qreduce.H_OVER_M_NEUTRON/v_edges*1e10
+
+    Iraw=self._sum_region(dataset, reg[0], reg[1], reg[2], reg[3], sum_x=False)
+    I=Iraw/(reg[3]-reg[2])*scale
+    dI=sqrt(Iraw)/(reg[3]-reg[2])*scale
+    R=(I-self.BG[newaxis, :])*self.options['scale']
+    dR=sqrt(dI**2+(self.dBG**2)[newaxis, :])*self.options['scale']
+    if self.ai>0.0002:
+      sin_scale=0.005/sin(self.ai)
+      R*=sin_scale
+      dR*=sin_scale
+    norm=self.options['normalization']
+    normR=where(norm.Rraw>0, norm.Rraw, 1.)
+    dR=sqrt((dR/normR[newaxis, :])**2+(R*(norm.dR/normR**2)[newaxis, :])**2)
+    R/=normR[newaxis, :]
+    Qz_edges=4.*pi/lamda_edges*sin(ai)[:, newaxis]
+    Qz_centers=(Qz_edges[:, :-1]+Qz_edges[:, 1:])/2.
+
+    Qz_start=Qz_edges[0, where(norm.Rraw>0)[0][-1]]
+    Qz_end=Qz_edges[-1, where(norm.Rraw>0)[0][0]]
+    Q=[]
+    dQ=[]
+    Rsum=[]
+    ddRsum=[]
+    Qz_edges_first=Qz_edges[0]
+    Qz_edges_last=Qz_edges[-1]
+    lines=range(Qz_edges.shape[0])
+    ddR=dR**2
+    for Qz_bin_low in reversed(Qz_edges_first[(Qz_edges_first<=Qz_end)&(Qz_edges_first>=Qz_start)]):
+      try:
+        Qz_bin_high=Qz_edges_last[Qz_edges_last>=Qz_bin_low][-2]
+      except IndexError:
+        break
+      Q.append((Qz_bin_high+Qz_bin_low)/2.)
+      dQ_rel=(Qz_bin_high-Qz_bin_low)/sqrt(12.)/Q[-1]
+      dQ.append(sqrt(dQ_rel**2+dai_rel**2)*Q[-1])
+      Rsumi=[]
+      ddRsumi=[]
+      for line in lines:
+        select=(Qz_centers[line]>=Qz_bin_low)&(Qz_centers[line]<=Qz_bin_high)
+        Rselect=R[line, select]
+        ddRselect=ddR[line, select]
+        Rsumi.append(Rselect.sum()/len(Rselect))
+        ddRsumi.append(ddRselect.sum()/len(Rselect)**2)
+      Rsum.append(array(Rsumi).sum())
+      ddRsum.append(array(ddRsumi).sum())
+    Q.reverse()
+    dQ.reverse()
+    Rsum.reverse()
+    ddRsum.reverse()
+    self.dQ=array(dQ)
+    self.Q=array(Q)
+    self.R=array(Rsum)/len(lines)
+    self.dR=sqrt(array(ddRsum))/len(lines)
+
+class FanExtractionTests(unittest.TestCase):
+  def _create_dataset(self, shape=(64, 32, 60)):
+    ds=qreduce.MRDataset()
+    ds.read_options={}
+    ds.data=random.poisson(20., shape)
+    ds.tof_edges=linspace(10000., 40000., shape[2]+1)
+    ds.proton_charge=1e3
+    return ds
+
+  def test_fan_rebinning(self):
+    random.seed(13)
+    direct=self._create_dataset()
+    norm=qreduce.Reflectivity(direct, x_pos=32., tth=0., dpix=32.)
+    ds=self._create_dataset()
+    for x_width, tth in [(1, 2.), (9, 1.), (31, 4.), (41, 6.)]:
+      options=dict(extract_fan=True, normalization=norm, x_pos=32., x_width=x_width,
+                   y_pos=16, y_width=20, bg_pos=8, bg_width=6, tth=tth, dpix=32.)
+      res=qreduce.Reflectivity(ds, **options)
+      ref=LoopFanReflectivity(ds, **options)
+      self.assertTrue(len(ref.Q)>0)
+      assert_array_equal(res.Q, ref.Q, verbose=True)
+      assert_array_equal(res.dQ, ref.dQ, verbose=True)
+      assert_array_equal(res.R, ref.R, verbose=True)
+      assert_array_equal(res.dR, ref.dR, verbose=True)
+
+
 
 suite=unittest.TestLoader().loadTestsFromTestCase(GeneralClassTest)
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(DataConsistencyChecks))
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(DataReductionTests))
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(EventModeTests))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(FanExtractionTests))